@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from collections import OrderedDict
+from config import get_config
+from synthetic import SyntheticReviews
+from dataloader import Char2VecEmbeddings, DataLoader, DataIterator, c2v_encode, w2v_encode
+
+
+# TextRNN GRU backends other than config.rnn_backend (charrnn_*)
+RNN_BACKENDS = ['block', 'cudnn', 'cudnn_compatible']
+
+STAGES = ['clean', 'normalize', 'c2v_encode', 'w2v_index', 'data_iterator',
+          'charcnn_train_step', 'charrnn_train_step', 'charcnn_inference', 'charrnn_inference',
+          'charcnn_numpy', 'charcnn_numpy_int8', 'charcnn_unfused_train_step', 'charcnn_unfused_inference'] + \
+         ['charrnn_%s_%s' % (backend, step) for backend in RNN_BACKENDS for step in ('train_step', 'inference')]
+
+parser = argparse.ArgumentParser(description='benchmarking the pre-processing & train/inference stages')
+parser.add_argument('--n_samples', type=int, help='the number of synthetic reviews', default=20000)
+parser.add_argument('--stages', type=str, help='comma separated stages, default is all', default=','.join(STAGES))
+parser.add_argument('--repeat', type=int, help='best of N runs for each stage', default=3)
+parser.add_argument('--n_steps', type=int, help='the number of timed train/inference steps', default=5)
+parser.add_argument('--output', type=str, help='result json', default='bench.json')
+parser.add_argument('--baseline', type=str, help='baseline json to compare with', default='bench_baseline.json')
+parser.add_argument('--save_baseline', type=bool, help='store the result as the new baseline', default=False)
+parser.add_argument('--tolerance', type=float, help='allowed slow-down ratio before a regression', default=.1)
+parser.add_argument('--parity_tolerance', type=float,
+                    help='max abs diff of the rates, NumPy (fp32) engine & unfused graph against TF', default=1e-3)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+
+def timeit(fn, n_items, repeat=3):
+    """
+    :param fn: function to benchmark, returns nothing
+    :param n_items: the number of items processed by one fn() call, int
+    :param repeat: best of N runs, int
+    :return: dict
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return OrderedDict([('secs', best), ('items', n_items), ('items_per_sec', n_items / best)])
+
+
+def bench_text(stages, reviews):
+    results = OrderedDict()
+
+    raw = [r['comment'] for r in reviews]
+    cleaned = [DataLoader.clean(c) for c in raw]
+    normalized = [DataLoader.rep(DataLoader.emo(c)) for c in cleaned]
+
+    if 'clean' in stages:
+        results['clean'] = timeit(lambda: [DataLoader.clean(c) for c in raw], len(raw), args.repeat)
+
+    if 'normalize' in stages:
+        results['normalize'] = timeit(lambda: [DataLoader.rep(DataLoader.emo(c)) for c in cleaned],
+                                      len(cleaned), args.repeat)
+
+    if 'c2v_encode' in stages:
+        c2v = Char2VecEmbeddings()
+        x_data = np.zeros((len(normalized), config.sequence_length), dtype=np.uint8)
+
+        def encode():
+            for i, c in enumerate(normalized):
+                x_data[i] = c2v_encode(c2v, c, config.sequence_length)
+
+        results['c2v_encode'] = timeit(encode, len(normalized), args.repeat)
+
+    if 'w2v_index' in stages:
+        try:
+            from gensim.models import Word2Vec
+            from dataloader import Word2VecEmbeddings
+        except ImportError:
+            print("[-] gensim is not installed, skip w2v_index")
+            return results
+
+        sg = SyntheticReviews(seed=config.seed)
+        tagged = [sg.tagged(c) for c in normalized]
+
+        # tiny Word2Vec model, only its vocab is used
+        with tempfile.TemporaryDirectory() as tmp:
+            w2v_file = os.path.join(tmp, 'bench_w2v.model')
+            Word2Vec(sentences=tagged, size=16, min_count=1, iter=1, workers=1, seed=config.seed).save(w2v_file)
+            w2v = Word2VecEmbeddings(w2v_file, dims=16)
+
+        x_data = np.zeros((len(tagged), config.sequence_length), dtype=np.int32)
+
+        def index():
+            for i, words in enumerate(tagged):
+                x_data[i] = w2v_encode(w2v, words, config.sequence_length, pad_id=w2v.vocab_size - 1)
+
+        results['w2v_index'] = timeit(index, len(tagged), args.repeat)
+    return results
+
+
+def make_xy(reviews):
+    c2v = Char2VecEmbeddings()
+
+    x_data = np.zeros((len(reviews), config.sequence_length), dtype=np.uint8)
+    for i, r in enumerate(reviews):
+        x_data[i] = c2v_encode(c2v, DataLoader.clean(r['comment']), config.sequence_length)
+
+    rates = np.array([r['rate'] for r in reviews])
+    y_data = rates.reshape(-1, 1) if config.n_classes == 1 else np.eye(config.n_classes)[rates - 1]
+    return x_data, y_data
+
+
+def bench_model(stages, x_data, y_data):
+    import tensorflow as tf
+    from main import build_model
+    from tfutil import session_config
+
+    results = OrderedDict()
+
+    if 'data_iterator' in stages:
+        di = DataIterator(x=x_data, y=y_data, batch_size=config.batch_size)
+        results['data_iterator'] = timeit(lambda: [_ for _ in di.iterate()],
+                                          di.num_batches * config.batch_size, args.repeat)
+
+    bs = config.batch_size
+    x_tr, y_tr = x_data[:bs], y_data[:bs]
+
+    numpy_stages = [stage for stage in ('charcnn_numpy', 'charcnn_numpy_int8') if stage in stages]
+
+    # (stage prefix, model, build_model() overrides)
+    runs = [('charcnn', 'charcnn', {}), ('charrnn', 'charrnn', {}),
+            ('charcnn_unfused', 'charcnn', {'fused_kmax': False})]
+    runs += [('charrnn_' + backend, 'charrnn', {'rnn_backend': backend}) for backend in RNN_BACKENDS]
+
+    reference = None  # initial weights & rates of charcnn, to check the unfused graph gives the same rates
+
+    for prefix, model_name, overrides in runs:
+        train_stage, infer_stage = prefix + '_train_step', prefix + '_inference'
+        use_numpy = prefix == 'charcnn' and numpy_stages
+        if train_stage not in stages and infer_stage not in stages and not use_numpy:
+            continue
+
+        if overrides.get('rnn_backend') == 'cudnn' and not tf.test.is_gpu_available(cuda_only=True):
+            print("[-] there's no GPU, skip %s" % prefix)
+            continue
+
+        tf.reset_default_graph()
+        with tempfile.TemporaryDirectory() as tmp, tf.Session(config=session_config(config.device)) as s:
+            model = build_model(s, Char2VecEmbeddings(), 'c2v', model_name=model_name, summary_dir=tmp,
+                                **overrides)
+            s.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+
+            def run(fetch, do_rate):
+                feed_dict = {model.x: x_tr, model.y: y_tr, model.do_rate: do_rate}
+                for _ in range(args.n_steps):
+                    s.run(fetch, feed_dict=feed_dict)
+
+            max_abs_diff = None
+            if prefix == 'charcnn':
+                variables = tf.global_variables()
+                reference = (dict(zip([v.op.name for v in variables], s.run(variables))),
+                             s.run(model.rates, feed_dict={model.x: x_tr, model.do_rate: 0.}))
+            elif prefix == 'charcnn_unfused' and reference:
+                for v in tf.global_variables():
+                    v.load(reference[0][v.op.name], s)
+
+                rates = s.run(model.rates, feed_dict={model.x: x_tr, model.do_rate: 0.})
+                max_abs_diff = float(np.max(np.abs(rates - reference[1])))
+                print("[*] %s max abs diff with charcnn : %.6f" % (prefix, max_abs_diff))
+
+            train_op = model.train_op if model.accum_op is None else model.accum_op
+
+            run(train_op, config.drop_out)  # warming up
+            if train_stage in stages:
+                results[train_stage] = timeit(lambda: run(train_op, config.drop_out), bs * args.n_steps, args.repeat)
+            if infer_stage in stages:
+                results[infer_stage] = timeit(lambda: run(model.rates, 0.), bs * args.n_steps, args.repeat)
+                if max_abs_diff is not None:
+                    results[infer_stage]['max_abs_diff'] = max_abs_diff
+
+            if use_numpy:
+                results.update(bench_numpy(s, model, numpy_stages, x_tr))
+    return results
+
+
+def bench_numpy(s, model, stages, x_tr):
+    """
+    NumPy TextCNN engine latency & parity with the TF graph
+    :param s: tf.Session
+    :param model: TextCNN
+    :param stages: charcnn_numpy, charcnn_numpy_int8, list
+    :param x_tr: a batch, numpy array
+    :return: dict
+    """
+    from export import engine_hparams
+    from model.textcnn_np import TextCNNEngine, export_weights
+
+    results = OrderedDict()
+
+    weights = export_weights(s, engine_hparams())
+    rates = s.run(model.rates, feed_dict={model.x: x_tr, model.do_rate: 0.})
+
+    for stage in stages:
+        engine = TextCNNEngine(weights, use_int8=stage.endswith('int8'))
+
+        def run():
+            for _ in range(args.n_steps):
+                engine(x_tr)
+
+        results[stage] = timeit(run, len(x_tr) * args.n_steps, args.repeat)
+        results[stage]['max_abs_diff'] = float(np.max(np.abs(engine(x_tr) - rates)))
+        print("[*] %s max abs diff with TF : %.6f" % (stage, results[stage]['max_abs_diff']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: current stage results, dict
+    :param baseline: baseline stage results, dict
+    :param tolerance: allowed slow-down ratio, float
+    :return: list of regressed stages
+    """
+    regressions = []
+
+    print("%-36s %14s %14s %9s" % ('stage', 'items/s', 'baseline', 'speed-up'))
+    for stage, r in results.items():
+        if stage not in baseline:
+            print("%-36s %14.1f %14s %9s" % (stage, r['items_per_sec'], '-', '-'))
+            continue
+
+        ratio = r['items_per_sec'] / baseline[stage]['items_per_sec']
+        flag = ''
+        if ratio < 1. - tolerance:
+            regressions.append(stage)
+            flag = '  <- regression'
+        print("%-36s %14.1f %14.1f %8.2fx%s" % (stage, r['items_per_sec'], baseline[stage]['items_per_sec'],
+                                               ratio, flag))
+    return regressions
+
+
+def main():
+    import warnings
+    warnings.filterwarnings("ignore", category=UserWarning)  # bs4 complains about url-only comments
+
+    stages = set(args.stages.split(','))
+
+    sg = SyntheticReviews(seed=config.seed, max_length=140)
+    reviews = sg.generate(args.n_samples)
+    print("[*] %d synthetic reviews generated (seed %d)" % (len(reviews), config.seed))
+
+    results = bench_text(stages, reviews)
+
+    if stages & set(STAGES[4:]):
+        x_data, y_data = make_xy(reviews)
+        results.update(bench_model(stages, x_data, y_data))
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+            ('python', platform.python_version()),
+            ('machine', platform.machine()),
+            ('n_cpus', os.cpu_count()),
+            ('n_samples', args.n_samples),
+            ('seed', config.seed),
+            ('batch_size', config.batch_size),
+            ('sequence_length', config.sequence_length),
+        ])),
+        ('stages', results),
+    ])
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("[+] result is written to %s" % args.output)
+
+    regressions = []
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['stages']
+        regressions = compare(results, baseline, args.tolerance)
+    else:
+        print("[-] there's no baseline %s to compare with" % args.baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("[+] baseline is updated, %s" % args.baseline)
+
+    # the fp32 engine & the unfused graph should match the TF graph, the int8 one is reported only
+    for stage in ('charcnn_numpy', 'charcnn_unfused_inference'):
+        if results.get(stage, {}).get('max_abs_diff', 0.) > args.parity_tolerance:
+            regressions.append(stage + ' (parity)')
+
+    if regressions:
+        print("[-] regressions : %s" % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
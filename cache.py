@@ -0,0 +1,130 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+
+def checkpoint_fingerprint(path):
+    """
+    :param path: checkpoint prefix or frozen graph file, str
+    :return: tuple, changes whenever the checkpoint is re-written
+    """
+    fn = path + '.index' if os.path.isfile(path + '.index') else path
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return path, 0, 0
+    return path, st.st_mtime_ns, st.st_size
+
+
+class PredictionCache:
+
+    def __init__(self, max_entries=100000, fingerprint=None):
+        """
+        LRU cache of the predictions, keyed on the normalized comment or its encoded ids
+        :param max_entries: the max number of cached predictions, int
+        :param fingerprint: the model the predictions come from, see checkpoint_fingerprint()
+        """
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def validate(self, fingerprint):
+        """
+        dropping every entry when the model is changed
+        :param fingerprint: the model currently served
+        :return: None
+        """
+        with self.lock:
+            if fingerprint == self.fingerprint:
+                return
+
+            self.entries.clear()
+            self.fingerprint = fingerprint
+            self.invalidations += 1
+
+    def lookup(self, keys):
+        """
+        :param keys: list of hashable
+        :return: (cached values, None for misses, indices of the misses)
+        """
+        values, miss_idx = [], []
+        with self.lock:
+            for i, key in enumerate(keys):
+                value = self.entries.get(key)
+                if value is None:
+                    miss_idx.append(i)
+                else:
+                    self.entries.move_to_end(key)
+                values.append(value)
+
+            self.hits += len(keys) - len(miss_idx)
+            self.misses += len(miss_idx)
+        return values, miss_idx
+
+    def put(self, keys, values, fingerprint=None):
+        """
+        :param keys: list of hashable
+        :param values: list
+        :param fingerprint: the model the values come from, stale values are not stored
+        :return: None
+        """
+        with self.lock:
+            if fingerprint is not None and not fingerprint == self.fingerprint:
+                return
+
+            for key, value in zip(keys, values):
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: dict, hit-rate metrics
+        """
+        n_lookups = self.hits + self.misses
+        return OrderedDict([
+            ('cache_size', len(self.entries)),
+            ('cache_hits', self.hits),
+            ('cache_misses', self.misses),
+            ('cache_hit_rate', self.hits / n_lookups if n_lookups else 0.),
+            ('cache_evictions', self.evictions),
+            ('cache_invalidations', self.invalidations),
+        ])
+
+
+def cached_predict(cache, keys, encode_fn, predict_fn, fingerprint=None):
+    """
+    :param cache: PredictionCache
+    :param keys: cache key of each comment, list
+    :param encode_fn: function, indices of the missed comments to the encoded numpy array
+    :param predict_fn: function, encoded numpy array to (n, n_classes) rates
+    :param fingerprint: the model predict_fn runs, see checkpoint_fingerprint()
+    :return: list, rates of each comment
+    """
+    values, miss_idx = cache.lookup(keys)
+    if not miss_idx:
+        return values
+
+    # each distinct missed key is scored once
+    missed = OrderedDict()
+    for i in miss_idx:
+        missed.setdefault(keys[i], []).append(i)
+
+    rates = predict_fn(encode_fn([idx[0] for idx in missed.values()]))
+    for rate, idx in zip(rates, missed.values()):
+        for i in idx:
+            values[i] = rate
+
+    cache.put(list(missed.keys()), list(rates), fingerprint)
+    return values
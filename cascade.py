@@ -0,0 +1,307 @@
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+
+from scipy import sparse
+from collections import OrderedDict
+from config import get_config
+from distill import latency
+from evaluation import Evaluator
+
+
+parser = argparse.ArgumentParser(description='cascade inference, a hashed n-gram linear model before the neural one')
+parser.add_argument('--output', type=str, help='stage-1 weights & the calibrated threshold',
+                    default='./ml_model/cascade.npz')
+parser.add_argument('--ckpt_path', type=str, help='stage-2 checkpoint, default is the best one', default=None)
+parser.add_argument('--frozen', type=str, help='stage-2 frozen graph made by export.py, instead of a checkpoint',
+                    default=None)
+parser.add_argument('--n_buckets', type=int, help='hashed n-gram features', default=2 ** 20)
+parser.add_argument('--ngram', type=int, help='1 ~ ngram grams of the encoded ids', default=3)
+parser.add_argument('--n_train', type=int, help='max train samples of the stage-1 model', default=1000000)
+parser.add_argument('--stage1_epochs', type=int, default=2)
+parser.add_argument('--stage1_lr', type=float, default=.5)
+parser.add_argument('--n_samples', type=int, help='valid samples, half for the calibration, half for the report',
+                    default=20000)
+parser.add_argument('--defer_rates', type=str, help='targeted ratios of the samples going to the stage 2',
+                    default='0,.1,.2,.3,.4,.5,.6,.7,.8,.9,1')
+parser.add_argument('--max_mse_increase', type=float, help='the operating point is the lowest defer rate '
+                                                           'within (1 + it) * MSE of the stage 2', default=.05)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+
+class HashedNGramModel:
+
+    PRIMES = np.array([1000003, 998244353, 1000000007, 2147483647, 4294967291], dtype=np.uint64)
+
+    def __init__(self, n_buckets=2 ** 20, ngram=3, pad_id=0, n_classes=1, weights=None, threshold=np.inf):
+        """
+        multinomial logistic regression over the hashed n-grams of the encoded ids (Char2Vec / Word2Vec)
+        :param n_buckets: the number of hashed features, int
+        :param ngram: 1 ~ ngram grams are used, int
+        :param pad_id: n-grams with the padding are skipped, int
+        :param n_classes: 1 (regression) or 10 (classification) of the neural model, int
+        :param weights: (Optional) (kernel, bias) trained before
+        :param threshold: expected error above it goes to the stage 2, float
+        """
+        assert 1 <= ngram <= len(self.PRIMES)
+
+        self.n_buckets = n_buckets
+        self.ngram = ngram
+        self.pad_id = pad_id
+        self.n_classes = n_classes
+        self.threshold = threshold
+
+        # 10 rates, whatever n_classes is
+        self.kernel, self.bias = weights or (np.zeros((n_buckets, 10), dtype=np.float32),
+                                             np.zeros(10, dtype=np.float32))
+        self.rates = np.arange(1., 11., dtype=np.float32)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as w:
+            hp = json.loads(str(w['hparams']))
+            return cls(weights=(w['kernel'], w['bias']), **hp)
+
+    def save(self, fn):
+        hp = {'n_buckets': self.n_buckets, 'ngram': self.ngram, 'pad_id': self.pad_id,
+              'n_classes': self.n_classes, 'threshold': float(self.threshold)}
+        np.savez(fn, kernel=self.kernel, bias=self.bias, hparams=np.array(json.dumps(hp)))
+
+    def features(self, x):
+        """
+        :param x: encoded comments, (n, sequence_length) numpy array
+        :return: (n, n_buckets) scipy csr matrix, L2 normalized log(1 + count) of the hashed n-grams
+        """
+        x = np.asarray(x).astype(np.uint64)
+        n, length = x.shape
+        is_pad = x == self.pad_id
+
+        rows, cols = [], []
+        for k in range(1, min(self.ngram, length) + 1):
+            steps = length - k + 1
+
+            # uint64 arithmetic wraps around, the order of the n-gram is the seed
+            h = np.full((n, steps), k, dtype=np.uint64)
+            valid = np.ones((n, steps), dtype=np.bool_)
+            for j in range(k):
+                h = h * self.PRIMES[j] + x[:, j:j + steps]
+                valid &= ~is_pad[:, j:j + steps]
+
+            r, c = np.nonzero(valid)
+            rows.append(r)
+            cols.append((h[r, c] % np.uint64(self.n_buckets)).astype(np.int64))
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        feats = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n, self.n_buckets))
+        feats.sum_duplicates()
+
+        feats.data = np.log1p(feats.data)
+        norm = np.sqrt(np.asarray(feats.multiply(feats).sum(axis=1)).ravel())
+        return sparse.diags(1. / np.maximum(norm, 1e-12)).dot(feats).tocsr()
+
+    def probs(self, feats):
+        logits = feats.dot(self.kernel) + self.bias
+        p = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        return p / p.sum(axis=-1, keepdims=True)
+
+    def fit(self, x, y, epochs=2, batch_size=1024, lr=.5, seed=1337):
+        """
+        mini-batch AdaGrad, only the rows of the n-grams in a batch are updated
+        :param x: encoded comments, numpy array
+        :param y: labels, (n, n_classes) numpy array
+        :param epochs: int
+        :param batch_size: int
+        :param lr: float
+        :param seed: int
+        :return: list, mean cross entropy per epoch
+        """
+        labels = (np.clip(np.rint(y[:, 0]), 1, 10) - 1 if self.n_classes == 1 else np.argmax(y, axis=-1))
+        labels = np.asarray(labels, dtype=np.int64)
+
+        g2_kernel = np.full_like(self.kernel, 1e-8)
+        g2_bias = np.full_like(self.bias, 1e-8)
+
+        rng = np.random.RandomState(seed)
+        losses = []
+        for epoch in range(epochs):
+            loss = 0.
+            idx = rng.permutation(len(labels))
+            for i in range(0, len(idx), batch_size):
+                batch = np.sort(idx[i:i + batch_size])
+                feats = self.features(x[batch])
+                p = self.probs(feats)
+
+                loss += -np.log(p[np.arange(len(batch)), labels[batch]] + 1e-12).sum()
+
+                p[np.arange(len(batch)), labels[batch]] -= 1.
+                p /= len(batch)
+
+                # the batch features over its own columns
+                used, cols = np.unique(feats.indices, return_inverse=True)
+                g_kernel = sparse.csr_matrix((feats.data, cols, feats.indptr), shape=(len(batch), len(used))).T.dot(p)
+                g_bias = p.sum(axis=0)
+
+                g2_kernel[used] += g_kernel ** 2
+                g2_bias += g_bias ** 2
+                self.kernel[used] -= lr * g_kernel / np.sqrt(g2_kernel[used])
+                self.bias -= lr * g_bias / np.sqrt(g2_bias)
+
+            losses.append(loss / len(labels))
+            print("[*] stage-1 epoch %d, cross entropy %.4f" % (epoch, losses[-1]))
+        return losses
+
+    def predict(self, x):
+        """
+        :param x: encoded comments, numpy array
+        :return: ((n, n_classes) rates in the neural model's format, (n,) expected error)
+        """
+        p = self.probs(self.features(x))
+        if self.n_classes == 1:
+            # expected rate & its variance, the expected squared error of it
+            rates = p.dot(self.rates)
+            return rates[:, None], (p * (self.rates - rates[:, None]) ** 2).sum(axis=-1)
+        return p, 1. - p.max(axis=-1)
+
+
+class Cascade:
+
+    def __init__(self, stage1, stage2, threshold=None):
+        """
+        :param stage1: HashedNGramModel
+        :param stage2: function, encoded batch -> rates, the neural model
+        :param threshold: expected error above it goes to the stage 2, default is stage1.threshold, float
+        """
+        self.stage1 = stage1
+        self.stage2 = stage2
+        self.threshold = stage1.threshold if threshold is None else threshold
+
+        self.n_samples = 0
+        self.n_deferred = 0
+
+    def __call__(self, x_batch):
+        rates, err = self.stage1.predict(x_batch)
+        rates = rates.astype(np.float32)
+
+        deferred = np.nonzero(err > self.threshold)[0]
+        if len(deferred):
+            rates[deferred] = self.stage2(x_batch[deferred])
+
+        self.n_samples += len(err)
+        self.n_deferred += len(deferred)
+        return rates
+
+    def defer_rate(self):
+        return self.n_deferred / self.n_samples if self.n_samples else 0.
+
+
+def evaluate(predict, x, y):
+    evaluator = Evaluator(len(y), config.n_classes)
+    for i in range(0, len(y), config.batch_size):
+        evaluator.add(predict(x[i:i + config.batch_size]), y[i:i + config.batch_size])
+    return evaluator.summary()
+
+
+def operating_points(stage1, stage2, x_calib, x_test, y_test, defer_rates):
+    """
+    :param stage1: HashedNGramModel
+    :param stage2: function, encoded batch -> rates
+    :param x_calib: encoded comments the thresholds are calibrated on, numpy array
+    :param x_test: held-out encoded comments, numpy array
+    :param y_test: held-out labels, numpy array
+    :param defer_rates: targeted ratios of the samples going to the stage 2, list
+    :return: list of OrderedDict, threshold & the measured defer rate, MSE, accuracy, latency per operating point
+    """
+    _, err = stage1.predict(x_calib)
+
+    points = []
+    for rate in defer_rates:
+        # the (1 - rate) quantile of the expected error defers ~rate of the samples
+        threshold = np.inf if rate <= 0. else -np.inf if rate >= 1. else float(np.quantile(err, 1. - rate))
+
+        cascade = Cascade(stage1, stage2, threshold)
+        summary = evaluate(cascade, x_test, y_test)
+        defer_rate = cascade.defer_rate()
+
+        ms, samples_per_sec = latency(cascade, x_test, config.batch_size)
+        points.append(OrderedDict([('target_defer_rate', rate), ('threshold', threshold),
+                                   ('defer_rate', defer_rate),
+                                   ('mse', summary['mse']), ('accuracy', summary['accuracy']),
+                                   ('ms_per_batch', ms), ('samples_per_sec', samples_per_sec)]))
+    return points
+
+
+def main():
+    from sklearn.model_selection import train_test_split
+    from main import load_trained_embeds, load_dataset
+    from server import Predictor
+
+    embed_type = config.use_pre_trained_embeds
+    if embed_type == 'd2v':
+        raise NotImplementedError("[-] only Char2Vec, Word2Vec are supported")
+
+    vectors = load_trained_embeds(embed_type)
+
+    # the same train/valid split as main.py (without refine_data)
+    x_data, y_data, _, _ = load_dataset(vectors, embed_type)
+    train_idx, valid_idx = train_test_split(np.arange(len(x_data)), random_state=config.seed,
+                                            test_size=config.test_size, shuffle=True)
+    train_idx = np.sort(train_idx[:args.n_train])
+    valid_idx = np.sort(valid_idx[:args.n_samples])
+
+    # Stage 1 : the hashed n-gram linear model
+    stage1 = HashedNGramModel(args.n_buckets, args.ngram,
+                              pad_id=0 if embed_type == 'c2v' else vectors.vocab_size - 1,
+                              n_classes=config.n_classes)
+    stage1.fit(x_data[train_idx], np.asarray(y_data[train_idx]), epochs=args.stage1_epochs,
+               batch_size=config.batch_size, lr=args.stage1_lr, seed=config.seed)
+
+    x_valid, y_valid = np.asarray(x_data[valid_idx]), np.asarray(y_data[valid_idx])
+    x_calib, x_test, y_test = x_valid[0::2], x_valid[1::2], y_valid[1::2]
+
+    # Stage 2 : the neural model, calibrating the thresholds on a half & reporting on the other
+    defer_rates = [float(r) for r in args.defer_rates.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        stage2 = Predictor(vectors, embed_type, tmp, frozen=args.frozen, ckpt_path=args.ckpt_path)
+        print("[+] %s loaded" % stage2.checkpoint)
+
+        try:
+            ms, samples_per_sec = latency(stage2, x_test, config.batch_size)
+            neural = evaluate(stage2, x_test, y_test)
+            points = operating_points(stage1, stage2, x_calib, x_test, y_test, defer_rates)
+        finally:
+            stage2.close()
+
+    print("[*] cascade operating points on %d held-out samples" % len(y_test))
+    print("    %-8s %12s %8s %9s %7s %10s %11s" %
+          ('target', 'threshold', 'defer', 'MSE', 'acc', 'ms/batch', 'samples/s'))
+    for p in points:
+        print("    %-8.2f %12.4f %8.3f %9.4f %7.4f %10.2f %11.1f" %
+              (p['target_defer_rate'], p['threshold'], p['defer_rate'], p['mse'], p['accuracy'],
+               p['ms_per_batch'], p['samples_per_sec']))
+    print("    %-8s %12s %8s %9.4f %7.4f %10.2f %11.1f" %
+          (config.model, '', '', neural['mse'], neural['accuracy'], ms, samples_per_sec))
+
+    # the lowest defer rate close enough to the neural model alone
+    chosen = next((p for p in points if p['mse'] <= neural['mse'] * (1. + args.max_mse_increase)), points[-1])
+    stage1.threshold = chosen['threshold']
+    print("[+] operating point : threshold %.4f, %.1f%% deferred, %.2fx throughput of %s" %
+          (chosen['threshold'], chosen['defer_rate'] * 100., chosen['samples_per_sec'] / samples_per_sec,
+           config.model))
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    stage1.save(args.output)
+
+    with open(os.path.splitext(args.output)[0] + '.json', 'w') as f:
+        json.dump(OrderedDict([('stage2', OrderedDict([('mse', neural['mse']), ('accuracy', neural['accuracy']),
+                                                       ('ms_per_batch', ms),
+                                                       ('samples_per_sec', samples_per_sec)])),
+                               ('operating_points', points), ('chosen', chosen)]), f, indent=2)
+    print("[+] stage-1 weights & the threshold are saved at %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
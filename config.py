@@ -5,6 +5,19 @@ args_list = []
 parser = argparse.ArgumentParser()
 
 
+def str2bool(v):
+    """
+    type=str2bool takes any non-empty string (even 'False') as True
+    :param v: true/false, yes/no or 1/0, str
+    :return: bool
+    """
+    if v.lower() in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if v.lower() in ('false', 'f', 'no', 'n', '0', ''):
+        return False
+    raise argparse.ArgumentTypeError("boolean value expected, %s" % v)
+
+
 def add_arg_group(name):
     """
     :param name: argument group, str
@@ -26,11 +39,12 @@ def export_config(fn='config.txt'):
     param_list = ['mode', 'model', 'n_classes', 'model', 'fc_unit', 'drop_out', 'use_leaky_relu', 'act_threshold',
                   'score_function', 'use_multi_channel', 'use_se_module', 'se_ratio', 'se_type',
                   'embed_size', 'sequence_length', 'batch_size',
-                  'optimizer', 'grad_clip', 'lr', 'lr_decay']
+                  'optimizer', 'embed_optimizer', 'grad_clip', 'grad_accum_steps', 'lr', 'lr_decay',
+                  'distill_teacher', 'distill_alpha', 'distill_temperature']
     if getattr(params, 'model') == 'charcnn':
         param_list.extend(['kernel_size', 'filter_size'])
     else:
-        param_list.extend(['n_gru_cells', 'n_gru_layers', 'n_attention_size'])
+        param_list.extend(['rnn_backend', 'n_gru_cells', 'n_gru_layers', 'n_attention_size'])
 
     with open(fn, 'w') as f:
         for param in param_list:
@@ -49,6 +63,10 @@ network_arg.add_argument('--n_gru_cells', type=int, default=128,
 network_arg.add_argument('--n_gru_layers', type=int, default=2,
                          help='the number of layers of CuDNNGRU')
 network_arg.add_argument('--n_attention_size', type=int, default=128)
+network_arg.add_argument('--rnn_backend', type=str, default='gru',
+                         choices=['gru', 'block', 'cudnn', 'cudnn_compatible'],
+                         help='block : fused GRU kernel (CPU), the same checkpoints as gru. '
+                              'cudnn (GPU only) & cudnn_compatible (CPU) share the checkpoints')
 network_arg.add_argument('--kernel_size', type=list, default=[10, 9, 7, 5, 3],
                          help='conv1d kernel size')
 # For Word2Vec, [2, 3, 4, 5] is recommended
@@ -58,20 +76,28 @@ network_arg.add_argument('--filter_size', type=int, default=256,
 network_arg.add_argument('--fc_unit', type=int, default=1024)
 network_arg.add_argument('--drop_out', type=float, default=.7,
                          help='dropout rate')
-network_arg.add_argument('--use_leaky_relu', type=bool, default=False)
+network_arg.add_argument('--use_leaky_relu', type=str2bool, default=False)
 network_arg.add_argument('--act_threshold', type=float, default=1e-6,
                          help='used at ThresholdReLU')
 network_arg.add_argument('--score_function', type=str, default='tanh', choices=['tanh', 'sigmoid'])
-network_arg.add_argument('--use_multi_channel', type=bool, default=False)
-network_arg.add_argument('--use_se_module', type=bool, default=False)
+network_arg.add_argument('--use_multi_channel', type=str2bool, default=False)
+network_arg.add_argument('--use_se_module', type=str2bool, default=False)
 network_arg.add_argument('--se_ratio', type=int, default=16)
 network_arg.add_argument('--se_type', type=str, default='B', choices=['A', 'B', 'C'])
+network_arg.add_argument('--fused_kmax', type=str2bool, default=True,
+                         help='TextCNN, ThresholdReLU after k-max pooling (the same outputs), except per-branch SE')
 
 # DataSet
 data_arg = add_arg_group('DataSet')
 data_arg.add_argument('--embed_size', type=int, default=384,  # 300
                       help='the size of Doc2Vec embedding vector')
 data_arg.add_argument('--vocab_size', type=int, default=391587, help='default is w2v vocab size')
+data_arg.add_argument('--use_compressed_vocab', type=str2bool, default=False,
+                      help='top-N words + hashed OOV buckets (vocab_file) instead of the whole w2v vocab')
+data_arg.add_argument('--vocab_file', type=str, default='./w2v/ko_vocab.json',
+                      help='compressed vocab, made by preprocessing.py --vector vocab')
+data_arg.add_argument('--vocab_top_n', type=int, default=50000, help='the number of the most frequent words to keep')
+data_arg.add_argument('--vocab_buckets', type=int, default=10000, help='the number of hashed OOV buckets')
 data_arg.add_argument('--character_size', type=int, default=251, help='number of korean chars')
 data_arg.add_argument('--sequence_length', type=int, default=400,
                       help='the length of the sentence, default is c2v max words cnt')
@@ -80,26 +106,62 @@ data_arg.add_argument('--sequence_length', type=int, default=400,
 data_arg.add_argument('--batch_size', type=int, default=128)
 data_arg.add_argument('--n_threads', type=int, default=8,
                       help='the number of workers for speeding up')
+data_arg.add_argument('--use_data_cache', type=str2bool, default=False,
+                      help='keeping the encoded dataset as .npy next to the processed dataset, memory-mapped later')
+data_arg.add_argument('--use_dedup', type=str2bool, default=False,
+                      help='dropping duplicated comments, duplicate counts are saved as sample weights')
+data_arg.add_argument('--use_sample_weights', type=str2bool, default=False,
+                      help='weighting the train loss of each comment by its duplicate count (--use_dedup)')
+data_arg.add_argument('--dedup_near', type=str2bool, default=True,
+                      help='MinHash near-duplicate detection as well as the exact one')
+data_arg.add_argument('--dedup_threshold', type=float, default=.8,
+                      help='min jaccard similarity (char bi-grams) of near duplicates')
 
 # Train/Test hyper-parameters
 train_arg = add_arg_group('Training')
-train_arg.add_argument('--is_train', type=bool, default=True)
+train_arg.add_argument('--is_train', type=str2bool, default=True)
 train_arg.add_argument('--epochs', type=int, default=10)
 train_arg.add_argument('--logging_step', type=int, default=500)
+train_arg.add_argument('--save_interval_secs', type=int, default=0,
+                       help='saving the latest checkpoint every N secs as well as every logging_step, 0 to disable')
 train_arg.add_argument('--optimizer', type=str, default='adam', choices=['adam', 'sgd', 'adadelta'])
+train_arg.add_argument('--embed_optimizer', type=str, default='dense', choices=['dense', 'lazy_adam', 'adagrad'],
+                       help='sparse (touched rows only) updates for the non-static embeddings, dense is --optimizer')
 train_arg.add_argument('--grad_clip', type=float, default=5.)
+train_arg.add_argument('--grad_accum_steps', type=int, default=1,
+                       help='accumulating gradients over N micro-batches, effective batch size is N * batch_size')
 train_arg.add_argument('--lr', type=float, default=2e-4)
 train_arg.add_argument('--lr_decay', type=float, default=.75)
 train_arg.add_argument('--lr_lower_boundary', type=float, default=2e-5)
 train_arg.add_argument('--test_size', type=float, default=.2)
 
+# Knowledge Distillation
+distill_arg = add_arg_group('Distillation')
+distill_arg.add_argument('--distill_teacher', type=str, default='',
+                         help='frozen graph of the teacher (export.py), training the configured model as its student')
+distill_arg.add_argument('--distill_alpha', type=float, default=.5,
+                         help='the weight of the teacher rates in the loss, 1 - alpha for the true rates')
+distill_arg.add_argument('--distill_temperature', type=float, default=2.,
+                         help='softening the teacher & student distributions, classification only')
+
+# Distributed (data-parallel) Training
+dist_arg = add_arg_group('Distributed')
+dist_arg.add_argument('--n_workers', type=int, default=1,
+                      help='the number of data-parallel worker processes, 1 for single process training')
+dist_arg.add_argument('--job_name', type=str, default='', choices=['', 'ps', 'worker'],
+                      help='set by the localhost cluster launcher, leave it empty')
+dist_arg.add_argument('--task_index', type=int, default=0,
+                      help='set by the localhost cluster launcher')
+dist_arg.add_argument('--cluster_port', type=int, default=2222,
+                      help='the first port of the localhost cluster')
+
 # Korean words Pre-Processing
 nlp_model = add_arg_group('NLP')
 nlp_model.add_argument('--analyzer', type=str, default='mecab', choices=['mecab', 'hannanum', 'twitter'],
                        help='korean pos analyzer')
-nlp_model.add_argument('--use_correct_spacing', type=bool, default=False,
+nlp_model.add_argument('--use_correct_spacing', type=str2bool, default=False,
                        help='resolving sentence spacing problem but taking lots of time...')
-nlp_model.add_argument('--use_normalize', type=bool, default=True)
+nlp_model.add_argument('--use_normalize', type=str2bool, default=True)
 nlp_model.add_argument('--vec_lr', type=float, default=2.5e-2)
 nlp_model.add_argument('--vec_min_lr', type=float, default=2.5e-2)
 nlp_model.add_argument('--vec_lr_decay', type=float, default=2e-3)
@@ -107,6 +169,8 @@ nlp_model.add_argument('--vec_lr_decay', type=float, default=2e-3)
 # Misc
 misc_arg = add_arg_group('Misc')
 misc_arg.add_argument('--device', type=str, default='gpu')
+misc_arg.add_argument('--tf_threads', type=int, default=0,
+                      help='intra/inter-op threads of the training session, 0 for all the cores')
 misc_arg.add_argument('--query_path', type=str, default='./comments/')
 misc_arg.add_argument('--dataset', type=str, default='data.csv')
 misc_arg.add_argument('--processed_dataset', type=str, default='tagged_data.csv',
@@ -116,7 +180,12 @@ misc_arg.add_argument('--w2v_model', type=str, default='./w2v/ko_w2v.model')
 misc_arg.add_argument('--d2v_model', type=str, default='./w2v/ko_d2v.model')
 misc_arg.add_argument('--seed', type=int, default=1337)
 misc_arg.add_argument('--jvm_path', type=str, default="C:\\Program Files\\Java\\jre-9\\bin\\server\\jvm.dll")
-misc_arg.add_argument('--verbose', type=bool, default=True)
+misc_arg.add_argument('--verbose', type=str2bool, default=True)
+misc_arg.add_argument('--profile_steps', type=str, default='',
+                      help='comma separated steps to trace, like 100,1000. timeline & op table are written')
+misc_arg.add_argument('--profile_dir', type=str, default='./profile/')
+misc_arg.add_argument('--metrics_file', type=str, default='metrics.jsonl',
+                      help='throughput & stage-time log, JSON-lines, saved in the pretrained path')
 
 # DB
 db_arg = add_arg_group('DB')
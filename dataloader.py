@@ -1,27 +1,43 @@
 # lgtm [py/encoding-error]
+import os
 import gc
 import csv
+import json
+import time
 import h5py
+import hashlib
 import numpy as np
 
+from array import array
 from tqdm import tqdm
+from collections import Counter
 from soynlp.normalizer import *
 from bs4 import BeautifulSoup as bs
+from metrics import StageTimer
 
 
 class Word2VecEmbeddings:
 
-    def __init__(self, w2v_model, dims=300):
+    def __init__(self, w2v_model, dims=300, vocab=None):
+        """
+        :param w2v_model: gensim Word2Vec model file, str
+        :param dims: embedding size, int
+        :param vocab: (Optional) CompressedVocab, the full w2v vocab is used by default
+        """
         self.model = w2v_model
 
         self.dims = dims
+        self.vocab = vocab
 
         self.w2v_model = None
         self.embeds = None
 
         self.load_model()
 
-        self.vocab_size = len(self.w2v_model.wv.vocab) + 1  # 1 for zero embedding for unknown
+        if self.vocab is None:
+            self.vocab_size = len(self.w2v_model.wv.vocab) + 1  # 1 for zero embedding for unknown
+        else:
+            self.vocab_size = self.vocab.vocab_size
 
         self.build_embeds()
 
@@ -32,6 +48,10 @@ class Word2VecEmbeddings:
     def build_embeds(self):
         self.embeds = np.zeros((self.vocab_size, self.dims))
 
+        if self.vocab is not None:
+            self.build_compressed_embeds()
+            return
+
         for i in tqdm(range(self.vocab_size - 1)):
             vec = self.w2v_model.wv[self.w2v_model.wv.index2word[i]]
             if vec is not None:
@@ -40,6 +60,22 @@ class Word2VecEmbeddings:
         # zero embedding
         self.embeds[self.vocab_size - 1] = np.zeros((1, self.dims))
 
+    def build_compressed_embeds(self):
+        # kept words get their own w2v vectors, each bucket starts from the mean of the w2v words hashed into it
+        bucket_counts = np.zeros((self.vocab.n_buckets,), dtype=np.int64)
+
+        wv = self.w2v_model.wv
+        for word in tqdm(wv.index2word):
+            idx = self.vocab.index(word)
+            if idx < len(self.vocab.words):
+                self.embeds[idx] = wv[word]
+            elif idx < self.vocab_size - 1:
+                self.embeds[idx] += wv[word]
+                bucket_counts[idx - len(self.vocab.words)] += 1
+
+        buckets = slice(len(self.vocab.words), self.vocab_size - 1)
+        self.embeds[buckets] /= np.maximum(bucket_counts, 1)[:, None]
+
     def word_to_vec(self, input_word):
         """
         :param input_word: word, str
@@ -52,11 +88,13 @@ class Word2VecEmbeddings:
         :param input_words: list
         :return: list containing numpy arrays
         """
+        if self.vocab is not None:
+            return [self.vocab.index(word) for word in input_words]
         return [self.w2v_model.wv.vocab[word].index if word in self.w2v_model.wv.vocab else self.vocab_size - 1
                 for word in input_words]
 
     def __len__(self):
-        return len(self.w2v_model.wv.vocab) + 1
+        return self.vocab_size
 
     def __str__(self):
         return "Word2Vec"
@@ -323,6 +361,248 @@ class EmbeddingVectorLoader:
         ])
 
 
+class Deduplicator:
+
+    MERSENNE_PRIME = (1 << 31) - 1
+
+    def __init__(self, use_near=True, n_perms=16, n_bands=8, threshold=.8, ngram=2, min_length=10,
+                 exact_slots=2 ** 23, lsh_slots=2 ** 17, lsh_ways=4, window=2 ** 19, seed=1337):
+        """
+        streaming exact & near duplicate detection over fixed-size tables, whatever the number of comments is.
+        the oldest entries are evicted when a slot is taken, so duplicates far apart may both be kept
+        :param use_near: MinHash near-duplicate detection or exact only, bool
+        :param n_perms: MinHash signature size, int
+        :param n_bands: LSH bands, n_perms / n_bands rows per band, int
+        :param threshold: min (estimated) jaccard similarity of the char n-grams of near duplicates, float
+        :param ngram: char n-gram size, int
+        :param min_length: comments shorter than it are de-duplicated exactly only, int
+        :param exact_slots: slots of the exact hash table, 8 bytes each, int
+        :param lsh_slots: LSH buckets per band, int
+        :param lsh_ways: the most recent candidates kept per LSH bucket, int
+        :param window: signatures of the most recently kept comments, the near-duplicate candidates, int
+        :param seed: random seed of the MinHash permutations, int
+        """
+        assert n_perms % n_bands == 0
+
+        self.use_near = use_near
+        self.n_perms = n_perms
+        self.n_bands = n_bands
+        self.rows = n_perms // n_bands
+        self.min_agree = int(np.ceil(threshold * n_perms))
+        self.ngram = ngram
+        self.min_length = min_length
+
+        # (a * x + b) mod p permutations
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, self.MERSENNE_PRIME, size=n_perms).astype(np.uint64)
+        self.b = rng.randint(0, self.MERSENNE_PRIME, size=n_perms).astype(np.uint64)
+
+        # direct-mapped (rate, text) hash table, a 32-bit tag (0 is empty) & the kept index per slot
+        self.exact_tags = np.zeros(exact_slots, dtype=np.uint32)
+        self.exact_idx = np.zeros(exact_slots, dtype=np.int32)
+
+        # ring buffer of the recent signatures & the LSH buckets of their positions, -1 is empty
+        self.window = window
+        self.sigs = np.zeros((window if use_near else 0, n_perms), dtype=np.uint32)
+        self.sig_rates = np.zeros(window if use_near else 0, dtype=np.uint32)
+        self.sig_idx = np.zeros(window if use_near else 0, dtype=np.int32)
+        self.lsh = np.full((n_bands, lsh_slots if use_near else 0, lsh_ways), -1, dtype=np.int32)
+        self.n_sigs = 0
+
+        self.counts = array('i')  # comments merged into each kept comment, the output like the labels
+        self.n_exact = 0
+        self.n_near = 0
+
+    @staticmethod
+    def hash64(text):
+        if isinstance(text, str):
+            text = text.encode('utf8')
+        return int.from_bytes(hashlib.blake2b(text, digest_size=8).digest(), 'little')
+
+    def minhash(self, text):
+        """
+        :param text: normalized comment, str
+        :return: numpy array (uint32), MinHash signature over the char n-grams
+        """
+        grams = {text[i:i + self.ngram] for i in range(len(text) - self.ngram + 1)}
+        hashes = np.array([self.hash64(g) % self.MERSENNE_PRIME for g in grams], dtype=np.uint64)
+
+        # 31-bit hashes & coefficients never overflow uint64
+        return ((np.outer(hashes, self.a) + self.b) % self.MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+    def add(self, text, rate, weight=1):
+        """
+        :param text: normalized comment, str
+        :param rate: label, duplicates with the different rates are kept apart
+        :param weight: the number of comments it stands for, int
+        :return: bool, it's a duplicate (and should be dropped) or not
+        """
+        rate = str(rate).strip()
+        text = ''.join(text.split())
+
+        h = self.hash64(rate + '\x00' + text)
+        slot, tag = h % len(self.exact_tags), (h >> 32) | 1
+        if self.exact_tags[slot] == tag:
+            self.counts[self.exact_idx[slot]] += weight
+            self.n_exact += 1
+            return True
+
+        idx = len(self.counts)
+
+        if self.use_near and len(text) >= self.min_length:
+            sig = self.minhash(text)
+            rate_tag = self.hash64(rate) & 0xffffffff
+            buckets = [self.hash64(rate.encode('utf8') + bytes([b]) + sig[b * self.rows:(b + 1) * self.rows].tobytes())
+                       % self.lsh.shape[1] for b in range(self.n_bands)]
+
+            for b, bucket in enumerate(buckets):
+                for pos in self.lsh[b, bucket]:
+                    if pos < 0:
+                        break
+                    if self.sig_rates[pos] == rate_tag and np.count_nonzero(sig == self.sigs[pos]) >= self.min_agree:
+                        cand_idx = self.sig_idx[pos]
+                        self.counts[cand_idx] += weight
+                        self.exact_tags[slot], self.exact_idx[slot] = tag, cand_idx  # the same text again is exact
+                        self.n_near += 1
+                        return True
+
+            # the oldest signature is overwritten, its stale bucket entries are checked against the new one
+            pos = self.n_sigs % self.window
+            self.sigs[pos], self.sig_rates[pos], self.sig_idx[pos] = sig, rate_tag, idx
+            self.n_sigs += 1
+
+            for b, bucket in enumerate(buckets):
+                entries = self.lsh[b, bucket]
+                entries[1:] = entries[:-1].copy()
+                entries[0] = pos
+
+        self.exact_tags[slot], self.exact_idx[slot] = tag, idx
+        self.counts.append(weight)
+        return False
+
+    def weights(self):
+        """
+        :return: numpy array (int32), duplicate count of each kept comment, usable as sample weights
+        """
+        return np.frombuffer(self.counts, dtype=np.int32).copy() if len(self.counts) else np.zeros(0, np.int32)
+
+    def nbytes(self):
+        """
+        :return: int, memory of the fixed-size tables
+        """
+        return sum(t.nbytes for t in (self.exact_tags, self.exact_idx, self.sigs, self.sig_rates, self.sig_idx,
+                                      self.lsh))
+
+    def __str__(self):
+        return "%d kept, %d exact & %d near duplicates dropped, %.1f MB tables" % \
+               (len(self.counts), self.n_exact, self.n_near, self.nbytes() / 2 ** 20)
+
+
+class CompressedVocab:
+
+    def __init__(self, words, counts, n_buckets=0, n_types=None, n_tokens=None):
+        """
+        the top-N frequent words keep their own ids, the rest of the words share n_buckets hashed ids
+        ids : [0, N) words, [N, N + n_buckets) buckets, N + n_buckets padding (zero embedding)
+        :param words: kept words, the most frequent first, list
+        :param counts: frequency of each kept word, list
+        :param n_buckets: the number of hashed OOV buckets, 0 maps every OOV to the padding, int
+        :param n_types: the number of distinct words of the corpus, int
+        :param n_tokens: the number of words of the corpus, int
+        """
+        self.words = list(words)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.n_buckets = n_buckets
+        self.n_types = n_types or len(self.words)
+        self.n_tokens = n_tokens or int(self.counts.sum())
+
+        self.word2id = {word: i for i, word in enumerate(self.words)}
+        self.vocab_size = len(self.words) + self.n_buckets + 1  # 1 for padding
+
+        self.freqs = None  # every word frequency, only when it's built from a corpus
+
+    @classmethod
+    def build(cls, sentences, top_n=50000, n_buckets=10000):
+        """
+        :param sentences: analyzed (tagged) words of each sentence, list
+        :param top_n: the number of the most frequent words to keep, int
+        :param n_buckets: the number of hashed OOV buckets, int
+        :return: CompressedVocab
+        """
+        freq = Counter()
+        for words in tqdm(sentences):
+            freq.update(words)
+
+        kept = freq.most_common(top_n)
+        vocab = cls([w for w, _ in kept], [c for _, c in kept], n_buckets,
+                    n_types=len(freq), n_tokens=sum(freq.values()))
+        vocab.freqs = np.sort(np.fromiter(freq.values(), dtype=np.int64, count=len(freq)))[::-1]
+        return vocab
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'r', encoding='utf8') as f:
+            meta = json.load(f)
+        return cls(meta['words'], meta['counts'], meta['n_buckets'], meta['n_types'], meta['n_tokens'])
+
+    def save(self, fn):
+        with open(fn, 'w', encoding='utf8') as f:
+            json.dump({'n_buckets': self.n_buckets, 'n_types': self.n_types, 'n_tokens': self.n_tokens,
+                       'words': self.words, 'counts': self.counts.tolist()}, f, ensure_ascii=False)
+
+    def index(self, word):
+        """
+        :param word: analyzed word, str
+        :return: int, word id, bucket id or padding id
+        """
+        idx = self.word2id.get(word)
+        if idx is not None:
+            return idx
+        if self.n_buckets:
+            return len(self.words) + Deduplicator.hash64(word) % self.n_buckets
+        return self.vocab_size - 1
+
+    def coverage(self):
+        """
+        :return: (token coverage, type coverage), ratio of the words having their own ids, float
+        """
+        return self.counts.sum() / max(self.n_tokens, 1), len(self.words) / max(self.n_types, 1)
+
+    def report(self, dims=300, n_slots=2, top_ns=(10000, 25000, 50000, 100000, 200000)):
+        """
+        :param dims: embedding size, int
+        :param n_slots: optimizer slots per weight, 2 for adam & adadelta, 0 for sgd, int
+        :param top_ns: top-N candidates to compare with, only when it's built from a corpus, tuple
+        :return: str, memory of the embeddings (fp32 + slots) against coverage
+        """
+        def mb(n_ids):
+            return n_ids * dims * 4 * (1 + n_slots) / 2 ** 20
+
+        full_mb = mb(self.n_types + 1)
+        token_cov, type_cov = self.coverage()
+
+        lines = ["[*] vocab : %d -> %d ids (%d words + %d buckets + 1 padding)" %
+                 (self.n_types + 1, self.vocab_size, len(self.words), self.n_buckets),
+                 "[*] coverage : %.2f%% tokens, %.2f%% types have their own ids" % (token_cov * 100., type_cov * 100.),
+                 "[*] embeddings (%d dims, fp32 + %d slots) : %.1fMB -> %.1fMB (%.1f%% saved)" %
+                 (dims, n_slots, full_mb, mb(self.vocab_size), (1. - mb(self.vocab_size) / full_mb) * 100.)]
+
+        if self.freqs is not None:
+            cum = np.cumsum(self.freqs)
+            lines.append("    %8s %10s %10s %8s" % ('top-N', 'tokens', 'MB', 'saved'))
+            for n in sorted({min(n, len(self.freqs)) for n in top_ns} | {len(self.words)}):
+                size = mb(n + self.n_buckets + 1)
+                lines.append("    %8d %9.2f%% %10.1f %7.1f%%" %
+                             (n, cum[n - 1] / cum[-1] * 100., size, (1. - size / full_mb) * 100.))
+        return '\n'.join(lines)
+
+    def __len__(self):
+        return self.vocab_size
+
+    def __str__(self):
+        return "CompressedVocab"
+
+
 class DataLoader:
 
     def __init__(self, file, n_classes=10, analyzer='mecab',
@@ -332,8 +612,6 @@ class DataLoader:
         self.file = file
         self.n_classes = n_classes
 
-        self.data = []
-
         self.sentences = []
         self.labels = []
         self.max_sent_len = 0
@@ -351,8 +629,18 @@ class DataLoader:
 
         self.config = config
 
+        # elapsed time of each pre-processing stage
+        self.timer = StageTimer()
+        self.save_secs = 0.
+        self.dedup_secs = 0.
+
         # Sanity Checks
         assert self.config
+
+        # (Optional) dropping exact/near duplicated comments, duplicate counts are kept as sample weights
+        self.dedup = Deduplicator(use_near=self.config.dedup_near,
+                                  threshold=self.config.dedup_threshold) if self.config.use_dedup else None
+        self.weights = None
         if not self.load_from == 'db':
             assert not self.file.find('.csv') == -1
         if self.use_save:
@@ -378,23 +666,28 @@ class DataLoader:
 
         # Already Analyzed Data
         if self.is_analyzed:
+            read_start = time.perf_counter()
             self.naive_load()  # just load data from .csv
+            self.timer.add('read', time.perf_counter() - read_start - self.dedup_secs)
         else:
+            # Stage 1 ~ 3 are chained generators, a row at a time goes through them, never the whole table
+
             # Stage 1 : read data from 'db' or 'csv'
             print("[*] loaded from %s" % self.load_from)
             if self.load_from == 'db':
-                self.read_from_db()
+                rows = self.read_from_db()
             else:
-                self.read_from_csv()  # currently unstable...
+                rows = self.read_from_csv()  # currently unstable...
+            rows = self.timer.iterate(rows, 'read')
 
             # Stage 2-1 : remove dirty stuffs
             print("[*] cleaning words...")
-            self.words_cleaning()
+            rows = self.words_cleaning(rows)
 
             # Stage 2-2 : (Optional) Correcting spacing
             if self.use_correct_spacing:
                 print("[*] correcting spacing problem...")
-                self.correct_spacing()
+                rows = self.correct_spacing(rows)
 
             if self.use_save:
                 self.csv_file = open(self.fn_to_save, 'w', encoding='utf8', newline='')
@@ -403,14 +696,30 @@ class DataLoader:
 
             # Stage 3 : build data (pos/morphs analyze)
             print("[*] start the analyzer")
+            tokenize_start = time.perf_counter()
             if self.analyzer == 'char':
                 print("[*] skip analyzer. no need to analyze for 'char2vec'. just saving...")
-                self.char_tokenize()
+                self.char_tokenize(rows)
             else:
-                self.word_tokenize()
+                self.word_tokenize(rows)
 
-            del self.data  # remove unused var # for saving memory
-            gc.collect()
+            # the upstream stages, writing .csv & de-duplicating are timed inside the stream
+            upstream = sum(self.timer.elapsed.get(name, 0.) for name in ('read', 'clean', 'spacing'))
+            self.timer.add('tokenize',
+                           time.perf_counter() - tokenize_start - upstream - self.save_secs - self.dedup_secs)
+            if self.use_save:
+                self.timer.add('save', self.save_secs)
+
+            if self.dedup and self.use_save:
+                np.save(self.counts_file(self.fn_to_save), self.dedup.weights())
+
+        if self.dedup:
+            self.timer.add('dedup', self.dedup_secs)
+            self.weights = self.dedup.weights()
+            print("[*] de-duplicated : %s" % self.dedup)
+
+        if self.config.verbose:
+            print("[*] pre-processing elapsed : %s" % self.timer)
 
         # if it's not binary class, convert into one-hot vector
         if not self.n_classes == 1:
@@ -427,6 +736,31 @@ class DataLoader:
     def normalize(self, x, n_rep=3):
         return self.rep(self.emo(x, n_rep), n_rep) if self.use_normalize else x
 
+    @staticmethod
+    def counts_file(fn):
+        """
+        :param fn: processed dataset, str
+        :return: str, where the duplicate counts of the processed dataset are saved
+        """
+        return os.path.splitext(fn)[0] + '-counts.npy'
+
+    def is_duplicate(self, text, rate, weight=1):
+        if not self.dedup:
+            return False
+
+        dedup_start = time.perf_counter()
+        is_dup = self.dedup.add(text, rate, weight)
+        self.dedup_secs += time.perf_counter() - dedup_start
+        return is_dup
+
+    @staticmethod
+    def clean(comment):
+        """
+        :param comment: raw comment, str
+        :return: comment without html tags, null chars, new lines and quotes, str
+        """
+        return bs(comment, "lxml").text.replace('\x00', '').replace('\n', '').strip('"').strip()
+
     def read_from_db(self):
         import pymysql
 
@@ -436,87 +770,106 @@ class DataLoader:
             'password': self.config.password,
             'db': self.config.db,
             'charset': self.config.charset,
-            'cursorclass': pymysql.cursors.DictCursor,
+            'cursorclass': pymysql.cursors.SSDictCursor,  # unbuffered, rows are fetched as they're consumed
         }
         db_conn = pymysql.connect(**db_info)
 
-        with db_conn.cursor() as cur:
-            cur.execute("select rate, comment from movie")
-            self.data = cur.fetchall()
+        try:
+            with db_conn.cursor() as cur:
+                cur.execute("select rate, comment from movie")
+                for row in cur:
+                    yield row
+        finally:
+            db_conn.close()
 
     def read_from_csv(self):
         with open(self.file, 'r', encoding='utf8') as f:
             csv_f = csv.reader(f)
+            next(csv_f)  # header
 
-            idx = 0
-            for line in tqdm(csv_f):
-                if idx == 0:
-                    idx += 1
-                    continue
+            for line in csv_f:
+                yield {'rate': line[0], 'comment': bs(line[1], 'lxml').text}
 
-                self.data.append({'rate': line[0], 'comment': bs(line[1], 'lxml').text})
-                idx += 1
-
-    def words_cleaning(self):
+    def words_cleaning(self, rows):
+        """
+        :param rows: dict of rate & comment, iterable
+        :return: generator, the cleaned rows
+        """
         import warnings
         warnings.filterwarnings("ignore", category=UserWarning, module='bs4')
 
         import validators
 
-        drop_list = []
-        len_data = len(self.data)
-        for idx in tqdm(range(len_data)):
-            self.data[idx]['comment'] = bs(self.data[idx]['comment'], "lxml").text.replace('\x00', '').\
-                replace('\n', '').strip('"').strip()
+        n_drops = 0
+        for d in rows:
+            clean_start = time.perf_counter()
+            d['comment'] = self.clean(d['comment'])
 
             # There're lots of meaningless comments like url... So, I'll drop it from data
-            if validators.url(self.data[idx]['comment']):
-                drop_list.append(idx)
+            is_url = validators.url(d['comment'])
+            self.timer.add('clean', time.perf_counter() - clean_start)
+
+            if is_url:
+                n_drops += 1
+                continue
+            yield d
 
-        print("[*] deleting data which contains only meaningless url")
-        for drop in tqdm(sorted(drop_list, reverse=True)):
-            del self.data[drop]
+        print("[*] %d rows which contain only meaningless url are deleted" % n_drops)
 
-    def correct_spacing(self):
+    def correct_spacing(self, rows):
+        """
+        :param rows: dict of rate & comment, iterable
+        :return: generator, the spacing-corrected rows
+        """
         try:
             from pykospacing import spacing
         except ImportError:
             raise ImportError("[-] plz installing KoSpacing package first!")
 
-        len_data = len(self.data)
-        for idx in tqdm(range(len_data)):
-            self.data[idx]['comment'] = spacing(self.data[idx]['comment'])
+        for d in rows:
+            spacing_start = time.perf_counter()
+            d['comment'] = spacing(d['comment'])
+            self.timer.add('spacing', time.perf_counter() - spacing_start)
+            yield d
 
-    def word_tokenize(self):
-        len_data = len(self.data)
-        for idx, d in tqdm(enumerate(self.data)):
-            pos = list(map(lambda x: '/'.join(x), self.analyzer.pos(self.normalize(d['comment']))))
+    def word_tokenize(self, rows):
+        for idx, d in enumerate(tqdm(rows)):
+            comment = self.normalize(d['comment'])
+            if self.is_duplicate(comment, d['rate']):  # before the costly pos analysis
+                continue
+
+            pos = list(map(lambda x: '/'.join(x), self.analyzer.pos(comment)))
 
             if self.use_save:
+                save_start = time.perf_counter()
                 self.csv_file.writelines(str(d['rate']) + ',' + ' '.join(pos) + '\n')
+                self.save_secs += time.perf_counter() - save_start
 
             self.sentences.append(pos)
             self.labels.append(d['rate'])
 
-            if idx and idx % (len_data // 100) == 0:
-                print("[*] %d/%d" % (idx, len_data), pos)
+            if idx and idx % 100000 == 0:
+                print("[*] %d" % idx, pos)
             del pos
 
         self.csv_file.close()
 
-    def char_tokenize(self):
-        len_data = len(self.data)
-        for idx, d in tqdm(enumerate(self.data)):
+    def char_tokenize(self, rows):
+        for idx, d in enumerate(tqdm(rows)):
             pos = self.normalize(d['comment'])
+            if self.is_duplicate(pos, d['rate']):
+                continue
 
             if self.use_save:
+                save_start = time.perf_counter()
                 self.csv_file.writelines(str(d['rate']) + ',' + ' '.join(pos) + '\n')
+                self.save_secs += time.perf_counter() - save_start
 
             self.sentences.append(pos)
             self.labels.append(d['rate'])
 
-            if idx and idx % (len_data // 100) == 0:
-                print("[*] %d/%d" % (idx, len_data), pos)
+            if idx and idx % 100000 == 0:
+                print("[*] %d" % idx, pos)
             del pos
 
         self.csv_file.close()
@@ -537,9 +890,16 @@ class DataLoader:
             if self.config.verbose:
                 print("[*] %s loaded!" % self.file)
 
-            for line in tqdm(f.readlines()[1:]):
+            # duplicate counts of the de-duplicated dataset
+            counts = np.load(self.counts_file(self.file)) if os.path.isfile(self.counts_file(self.file)) else None
+
+            next(f)  # header
+            for row, line in tqdm(enumerate(f)):
                 d = line.split(',')
                 try:
+                    if self.is_duplicate(d[1], d[0], int(counts[row]) if counts is not None else 1):
+                        continue
+
                     sent = d[1].split(' ')
                     if len(sent) > self.max_sent_len:
                         self.max_sent_len = len(sent)
@@ -549,6 +909,9 @@ class DataLoader:
                 except IndexError:
                     print("[-] ", line)
 
+        if counts is not None and not self.dedup:
+            self.weights = counts
+
         if self.config.verbose:
             print("[*] the number of words in sentence : %d" % self.max_sent_len)
 
@@ -574,20 +937,182 @@ class DataLoader:
         return len(self.sentences)
 
 
+def load_embeddings(embed_mode, config):
+    """
+    :param embed_mode: embedding mode, d2v or w2v or c2v, str
+    :param config: configuration
+    :return: Doc2VecEmbeddings or Word2VecEmbeddings or Char2VecEmbeddings
+    """
+    if embed_mode == 'd2v':
+        vec = Doc2VecEmbeddings(config.d2v_model, config.embed_size)  # Doc2Vec Loader
+        if config.verbose:
+            print("[+] Doc2Vec loaded! Total %d pre-trained sentences, %d dims" % (len(vec), config.embed_size))
+    elif embed_mode == 'w2v':
+        vocab = CompressedVocab.load(config.vocab_file) if config.use_compressed_vocab else None
+
+        vec = Word2VecEmbeddings(config.w2v_model, config.embed_size, vocab=vocab)  # WOrd2Vec Loader
+        if config.verbose:
+            print("[+] Word2Vec loaded! Total %d pre-trained words, %d dims" % (len(vec), config.embed_size))
+
+        if vocab is not None:
+            # padding id & the model vocab size follow the compressed vocab
+            config.vocab_size = vec.vocab_size - 1
+            if config.verbose:
+                print("[*] compressed vocab %s, vocab_size is set to %d" % (config.vocab_file, config.vocab_size))
+    else:
+        vec = Char2VecEmbeddings()
+        if config.verbose:
+            print("[+] Using Char2Vec, %d dims" % config.embed_size)
+    return vec
+
+
+def c2v_encode(vec, sentence, sequence_length):
+    """
+    :param vec: Char2VecEmbeddings
+    :param sentence: str
+    :param sequence_length: int
+    :return: numpy array, zero-padded char indices
+    """
+    sent = vec.decompose_str_as_one_hot(sentence, warning=False)[:sequence_length]
+    return np.pad(sent, (0, sequence_length - len(sent)), 'constant', constant_values=0)
+
+
+def w2v_encode(vec, words, sequence_length, pad_id):
+    """
+    :param vec: Word2VecEmbeddings
+    :param words: analyzed words, list
+    :param sequence_length: int
+    :param pad_id: padding index, int
+    :return: numpy array (int32), padded word indices
+    """
+    sent = np.asarray(vec.words_to_index(words[:sequence_length]), dtype=np.int32)
+    return np.pad(sent, (0, sequence_length - len(sent)), 'constant', constant_values=pad_id)
+
+
+# config.py arguments main.encode_dataset() depends on, besides the embedding type & the processed dataset
+DATA_CACHE_ARGS = {
+    # Char2Vec, the processed dataset is made (normalized, spacing corrected) in the same run if it doesn't exist
+    'c2v': ['sequence_length', 'n_classes', 'use_dedup', 'dedup_near', 'dedup_threshold',
+            'use_normalize', 'use_correct_spacing'],
+    # Word2Vec, the word ids & the padding id come from the (compressed) vocab
+    'w2v': ['sequence_length', 'n_classes', 'use_dedup', 'dedup_near', 'dedup_threshold',
+            'w2v_model', 'use_compressed_vocab', 'vocab_file', 'vocab_size'],
+}
+
+
+def data_cache_files(config, embed_type):
+    """
+    :param config: configuration, after load_embeddings() (the compressed vocab sets vocab_size)
+    :param embed_type: c2v or w2v, str
+    :return: (x, y, sample weights, teacher) .npy files next to the processed dataset,
+             keyed by a hash of DATA_CACHE_ARGS
+    """
+    settings = json.dumps([getattr(config, name) for name in DATA_CACHE_ARGS['c2v' if embed_type == 'c2v' else 'w2v']])
+    key = hashlib.sha1(settings.encode('utf8')).hexdigest()[:10]
+
+    base = "%s-%s-%d-%s" % (os.path.splitext(config.processed_dataset)[0], embed_type, config.sequence_length, key)
+    return base + '-x.npy', base + '-y.npy', base + '-w.npy', base + '-teacher.npy'
+
+
+class TextEncoder:
+
+    def __init__(self, vec, sequence_length, pad_id=0, analyzer=None, use_normalize=True):
+        """
+        raw comment to the model input, the same way as the training data is made
+        :param vec: Char2VecEmbeddings or Word2VecEmbeddings
+        :param sequence_length: int
+        :param pad_id: padding index, 0 for Char2Vec, vocab_size for Word2Vec, int
+        :param analyzer: korean pos analyzer (konlpy), only for Word2Vec
+        :param use_normalize: soynlp emoticon/repeat normalization, bool
+        """
+        self.vec = vec
+        self.sequence_length = sequence_length
+        self.pad_id = pad_id
+        self.analyzer = analyzer
+        self.use_normalize = use_normalize
+
+        self.is_c2v = str(self.vec) == 'Char2Vec'
+        self.dtype = np.uint8 if self.is_c2v else np.int32
+
+        if not self.is_c2v and self.analyzer is None:
+            from konlpy.tag import Mecab
+            self.analyzer = Mecab()
+
+    def normalize(self, comment):
+        """
+        :param comment: raw comment, str
+        :return: cleaned & normalized comment, str
+        """
+        comment = DataLoader.clean(comment)
+        return DataLoader.rep(DataLoader.emo(comment)) if self.use_normalize else comment
+
+    def encode_normalized(self, text):
+        """
+        :param text: normalized comment, str
+        :return: numpy array
+        """
+        if self.is_c2v:
+            # chars are space-separated in the train data (see char_tokenize)
+            return c2v_encode(self.vec, ' '.join(text), self.sequence_length)
+        words = ['/'.join(pos) for pos in self.analyzer.pos(text)]
+        return w2v_encode(self.vec, words, self.sequence_length, self.pad_id)
+
+    def encode(self, comment):
+        return self.encode_normalized(self.normalize(comment))
+
+    def encode_batch(self, comments, normalized=False):
+        """
+        :param comments: raw comments, list
+        :param normalized: comments are already normalized, bool
+        :return: numpy array, (len(comments), sequence_length)
+        """
+        encode = self.encode_normalized if normalized else self.encode
+
+        x = np.zeros((len(comments), self.sequence_length), dtype=self.dtype)
+        for i, comment in enumerate(comments):
+            x[i] = encode(comment)
+        return x
+
+
+class MappedSubset:
+
+    def __init__(self, data, idx):
+        """
+        rows of a (memory-mapped) array by index, gathered only when they're read
+        :param data: numpy array or memmap
+        :param idx: row indices, numpy array
+        """
+        self.data = data
+        self.idx = np.asarray(idx)
+        self.shape = (len(self.idx),) + data.shape[1:]
+        self.dtype = data.dtype
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, key):
+        return np.asarray(self.data[self.idx[key]])
+
+
 class DataIterator:
 
-    def __init__(self, x, y, batch_size):
-        # x, y should be numpy obj
+    def __init__(self, x, y, batch_size, t=None, w=None):
+        # x, y should be numpy obj (or MappedSubset)
         assert not isinstance(x, list) and not isinstance(y, list)
 
         self.x = x
         self.y = y
+        self.t = t  # (Optional) teacher rates, (x, y, t) batches
+        self.w = w  # (Optional) sample weights, (x, y[, t], w) batches
 
         self.batch_size = batch_size
         self.num_examples = num_examples = x.shape[0]
         self.num_batches = num_examples // batch_size
         self.pointer = 0
 
+        # shuffling the order, not the data, batches are gathered by it
+        self.order = np.arange(num_examples)
+
         assert (self.batch_size <= self.num_examples)
 
     def next_batch(self):
@@ -595,18 +1120,15 @@ class DataIterator:
         self.pointer += self.batch_size
 
         if self.pointer > self.num_examples:
-            perm = np.arange(self.num_examples)
-            np.random.shuffle(perm)
-
-            self.x = self.x[perm]
-            self.y = self.y[perm]
+            np.random.shuffle(self.order)
 
             start = 0
             self.pointer = self.batch_size
 
         end = self.pointer
 
-        return self.x[start:end], self.y[start:end]
+        idx = self.order[start:end]
+        return tuple(d[idx] for d in (self.x, self.y, self.t, self.w) if d is not None)
 
     def iterate(self):
         for step in range(self.num_batches):
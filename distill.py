@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import numpy as np
+
+from tqdm import tqdm
+from collections import OrderedDict
+from evaluation import Evaluator
+
+
+class Teacher:
+
+    def __init__(self, frozen, device='gpu'):
+        """
+        :param frozen: frozen graph of the teacher model, made by export.py, str
+        :param device: gpu or cpu, str
+        """
+        import tensorflow as tf
+        from tfutil import session_config, load_frozen_graph
+
+        self.frozen = frozen
+
+        graph, self.x, self.rates = load_frozen_graph(frozen)
+        self.s = tf.Session(graph=graph, config=session_config(device))
+
+    def __call__(self, x_batch):
+        return self.s.run(self.rates, feed_dict={self.x: x_batch})
+
+    def predict(self, x, fn, batch_size=1024, sources=()):
+        """
+        teacher rates of the whole dataset, computed once & memory-mapped
+        :param x: encoded comments, numpy array
+        :param fn: .npy file to keep the rates, re-computed when it's older than the teacher or the sources
+        :param batch_size: int
+        :param sources: files the dataset is made from, list
+        :return: numpy memmap, (len(x), n_classes) rates
+        """
+        sources = [self.frozen] + [src for src in sources if os.path.isfile(src)]
+        if os.path.isfile(fn) and all(os.path.getmtime(fn) >= os.path.getmtime(src) for src in sources):
+            rates = np.load(fn, mmap_mode='r')
+            if len(rates) == len(x):
+                print("[+] teacher rates loaded from %s" % fn)
+                return rates
+            print("[-] %s doesn't match the dataset, re-computing" % fn)
+
+        n_classes = self(x[:1]).shape[-1]
+
+        tmp = "%s.%d.tmp" % (fn, os.getpid())
+        rates = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(x), n_classes))
+        for i in tqdm(range(0, len(x), batch_size)):
+            rates[i:i + batch_size] = self(x[i:i + batch_size])
+        rates.flush()
+        del rates
+
+        os.replace(tmp, fn)  # never leaves a half-written file behind
+        print("[+] teacher rates are written to %s" % fn)
+        return np.load(fn, mmap_mode='r')
+
+    def close(self):
+        self.s.close()
+
+
+def latency(predict, x, batch_size, max_batches=50):
+    """
+    :param predict: function, encoded batch -> rates
+    :param x: encoded comments, numpy array
+    :param batch_size: int
+    :param max_batches: the number of timed batches, int
+    :return: (ms per batch, samples per sec)
+    """
+    batches = [x[i:i + batch_size] for i in range(0, len(x), batch_size)][:max_batches]
+
+    predict(batches[0])  # warming up
+
+    start = time.perf_counter()
+    n = 0
+    for x_batch in batches:
+        predict(x_batch)
+        n += len(x_batch)
+    secs = time.perf_counter() - start
+    return secs / len(batches) * 1e3, n / secs
+
+
+def distill_report(student, teacher, x_valid, y_valid, t_valid, batch_size, n_classes=1, fn=None):
+    """
+    accuracy & latency of the student against the teacher, over the same valid samples
+    :param student: function, encoded batch -> rates
+    :param teacher: Teacher
+    :param x_valid: encoded comments, numpy array
+    :param y_valid: labels, numpy array
+    :param t_valid: precomputed teacher rates, numpy array
+    :param batch_size: int
+    :param n_classes: int
+    :param fn: (Optional) JSON file to write the report, str
+    :return: str
+    """
+    evaluators = OrderedDict([('teacher', Evaluator(len(y_valid), n_classes)),
+                              ('student', Evaluator(len(y_valid), n_classes))])
+    for i in range(0, len(y_valid), batch_size):
+        evaluators['teacher'].add(t_valid[i:i + batch_size], y_valid[i:i + batch_size])
+        evaluators['student'].add(student(x_valid[i:i + batch_size]), y_valid[i:i + batch_size])
+
+    report = OrderedDict()
+    for name, predict in (('teacher', teacher), ('student', student)):
+        summary = evaluators[name].summary()
+        ms, samples_per_sec = latency(predict, x_valid, batch_size)
+        report[name] = OrderedDict([('mse', summary['mse']), ('mae', summary['mae']),
+                                    ('accuracy', summary['accuracy']),
+                                    ('ms_per_batch', ms), ('samples_per_sec', samples_per_sec)])
+    report['speed_up'] = report['student']['samples_per_sec'] / report['teacher']['samples_per_sec']
+
+    if fn:
+        with open(fn, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    lines = ["    %-8s %9s %9s %7s %10s %11s" % ('', 'MSE', 'MAE', 'acc', 'ms/batch', 'samples/s')]
+    for name in ('teacher', 'student'):
+        r = report[name]
+        lines.append("    %-8s %9.4f %9.4f %7.4f %10.2f %11.1f" %
+                     (name, r['mse'], r['mae'], r['accuracy'], r['ms_per_batch'], r['samples_per_sec']))
+    lines.append("    => student is %.2fx faster (batch size %d)" % (report['speed_up'], batch_size))
+    return '\n'.join(lines)
@@ -0,0 +1,165 @@
+import json
+import numpy as np
+
+from collections import OrderedDict
+
+
+class Evaluator:
+    """
+    0-3: bad
+    4-7: normal
+    7-10: good
+    """
+
+    BUCKETS = ["bad", "normal", "good"]
+    BUCKET_EDGES = [3, 7]
+
+    def __init__(self, n_samples, n_classes=1):
+        """
+        predictions are kept in the preallocated arrays, every sample is covered
+        :param n_samples: the number of samples to evaluate, int
+        :param n_classes: 1 for regression, 10 for classification, int
+        """
+        self.n_samples = n_samples
+        self.n_classes = n_classes
+
+        self.y_pred = np.zeros((n_samples,), dtype=np.float32)  # rate, 1 ~ 10
+        self.y_true = np.zeros((n_samples,), dtype=np.float32)
+        self.loss_sum = 0.
+        self.pointer = 0
+
+    def to_rate(self, y):
+        """
+        :param y: (n, n_classes) rates, probabilities or one-hot labels, numpy array
+        :return: numpy array, (n,) rate
+        """
+        y = np.asarray(y).reshape(-1, self.n_classes)
+        return y[:, 0] if self.n_classes == 1 else np.argmax(y, axis=-1) + 1.
+
+    def add(self, rates, y, loss=None):
+        """
+        :param rates: model outputs of a batch, numpy array
+        :param y: labels of a batch, numpy array
+        :param loss: (Optional) mean loss of a batch, float
+        :return: None
+        """
+        n = len(y)
+        assert self.pointer + n <= self.n_samples
+
+        self.y_pred[self.pointer:self.pointer + n] = self.to_rate(rates)
+        self.y_true[self.pointer:self.pointer + n] = self.to_rate(y)
+        if loss is not None:
+            self.loss_sum += loss * n
+        self.pointer += n
+
+    def buckets(self, y):
+        return np.digitize(y, self.BUCKET_EDGES)
+
+    def confusion_matrix(self, normalize=False):
+        """
+        :param normalize: each row (true label) sums up to 1, bool
+        :return: numpy array, (3, 3), rows are true & columns are predicted buckets
+        """
+        n_buckets = len(self.BUCKETS)
+
+        y_true = self.buckets(self.y_true[:self.pointer])
+        y_pred = self.buckets(self.y_pred[:self.pointer])
+
+        cnf_mat = np.bincount(y_true * n_buckets + y_pred, minlength=n_buckets ** 2).reshape(n_buckets, n_buckets)
+        if normalize:
+            cnf_mat = cnf_mat / np.maximum(cnf_mat.sum(axis=1, keepdims=True), 1)
+        return cnf_mat
+
+    def is_correct(self, y_pred, y_true):
+        # the same as model.accuracy, within 1.0 for regression
+        return np.abs(y_pred - y_true) <= 1. if self.n_classes == 1 else y_pred == y_true
+
+    def summary(self):
+        """
+        :return: dict, loss, MSE, MAE, accuracy, per-rate count/MSE/accuracy & the confusion matrix
+        """
+        y_pred, y_true = self.y_pred[:self.pointer], self.y_true[:self.pointer]
+
+        err = y_pred - y_true
+        correct = self.is_correct(y_pred, y_true)
+
+        # per (true) rate, 1 ~ 10
+        rate_idx = np.clip(np.rint(y_true).astype(np.int64) - 1, 0, 9)
+        counts = np.bincount(rate_idx, minlength=10)
+        n = np.maximum(counts, 1)
+
+        return OrderedDict([
+            ('n_samples', int(self.pointer)),
+            ('loss', self.loss_sum / self.pointer if self.pointer else 0.),
+            ('mse', float(np.mean(err ** 2)) if self.pointer else 0.),
+            ('mae', float(np.mean(np.abs(err))) if self.pointer else 0.),
+            ('accuracy', float(np.mean(correct)) if self.pointer else 0.),
+            ('per_rate', OrderedDict([
+                ('count', counts.tolist()),
+                ('mse', (np.bincount(rate_idx, weights=err ** 2, minlength=10) / n).tolist()),
+                ('accuracy', (np.bincount(rate_idx, weights=correct, minlength=10) / n).tolist()),
+            ])),
+            ('confusion_matrix', self.confusion_matrix().tolist()),
+        ])
+
+    def report(self, fn=None):
+        """
+        :param fn: (Optional) JSON file to write the summary, str
+        :return: str
+        """
+        summary = self.summary()
+        if fn:
+            with open(fn, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+        lines = ["    => loss : {:.8f} MSE : {:.8f} MAE : {:.4f} acc : {:.4f}".format(
+            summary['loss'], summary['mse'], summary['mae'], summary['accuracy']),
+            "    rate  count       MSE    acc"]
+        per_rate = summary['per_rate']
+        for r in range(10):
+            lines.append("    %4d %6d %9.4f %6.4f" %
+                         (r + 1, per_rate['count'][r], per_rate['mse'][r], per_rate['accuracy'][r]))
+        return '\n'.join(lines)
+
+    def plot_confusion_matrix(self, img='./confusion_matrix.png', normalize=True, show=False):
+        """
+        :param img: save to, str
+        :param normalize: bool
+        :param show: showing the plot window (blocking) or not, bool
+        :return: numpy array, the confusion matrix
+        """
+        import matplotlib
+        if not show:
+            matplotlib.use('Agg')  # headless, never blocks
+        import matplotlib.pyplot as plt
+
+        cnf_mat = self.confusion_matrix(normalize=normalize)
+
+        plt.figure()
+
+        plt.imshow(cnf_mat, interpolation='nearest', cmap=plt.cm.Blues)
+        plt.title("Confusion Matrix")
+        plt.colorbar()
+
+        tick_marks = np.arange(len(self.BUCKETS))
+        plt.xticks(tick_marks, self.BUCKETS, rotation=45)
+        plt.yticks(tick_marks, self.BUCKETS)
+
+        thresh = cnf_mat.max() / 2.
+        for i in range(cnf_mat.shape[0]):
+            for j in range(cnf_mat.shape[1]):
+                plt.text(j, i, format(cnf_mat[i, j], '.2f' if normalize else 'd'),
+                         horizontalalignment="center",
+                         color="white" if cnf_mat[i, j] > thresh else "black")
+
+        plt.ylabel('True label')
+        plt.xlabel('Predicted label')
+        plt.tight_layout()
+
+        plt.savefig(img)
+
+        if show:
+            plt.show()
+        plt.close()
+
+        return cnf_mat
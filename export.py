@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from config import get_config
+from tfutil import session_config, find_checkpoint, freeze_graph, optimize_graph, load_frozen_graph
+from main import load_trained_embeds, build_model
+from model.textcnn_np import TextCNNEngine, export_weights
+
+
+parser = argparse.ArgumentParser(description='exporting an inference-only frozen graph')
+parser.add_argument('--ckpt_path', type=str, help='checkpoint to export, default is the best one', default=None)
+parser.add_argument('--output', type=str, help='frozen GraphDef (or .npz weights) to write',
+                    default='./export/model.pb')
+parser.add_argument('--format', type=str, help='frozen graph or weights for the NumPy TextCNN engine',
+                    default='pb', choices=['pb', 'npz'])
+parser.add_argument('--parity_tolerance', type=float,
+                    help='max abs diff of the rates, the exported NumPy (fp32) engine against TF', default=1e-3)
+parser.add_argument('--n_parity_samples', type=int, help='seeded random comments for the parity check', default=256)
+parser.add_argument('--use_int8', type=bool, help='also writing the int8 weights (+ scales) to <output>-int8.npz',
+                    default=False)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+INPUT_NAME = 'x-sentence'
+OUTPUT_NAME = 'outputs/rates'
+
+
+def engine_hparams():
+    """
+    :return: dict, TextCNN hyper-parameters the NumPy engine needs besides the weights
+    """
+    return {
+        'kernel_sizes': [int(fs) for fs in config.kernel_size],
+        'th': config.act_threshold,
+        'score_function': config.score_function,
+        'use_multi_channel': config.use_multi_channel,
+    }
+
+
+def check_parity(s, model, fn, int8_fn=None, n_samples=256, tolerance=1e-3):
+    """
+    the exported NumPy engine against the TF graph, over the seeded random comments
+    :param s: tf.Session, the restored model
+    :param model: TextCNN
+    :param fn: .npz file made by export_weights(), str
+    :param int8_fn: (Optional) .npz file made by export_weights(use_int8=True), fn is quantized at load otherwise, str
+    :param n_samples: int
+    :param tolerance: max abs diff of the fp32 engine, float
+    :return: dict, max abs diff of the fp32 & int8 engines
+    """
+    engine = TextCNNEngine.load(fn)
+    int8_engine = TextCNNEngine.load(int8_fn or fn, use_int8=True)
+
+    rng = np.random.RandomState(config.seed)
+    x = rng.randint(0, engine.vocab_size, size=(n_samples, config.sequence_length))
+    x = x.astype(model.x.dtype.as_numpy_dtype)
+
+    rates = s.run(model.rates, feed_dict={model.x: x, model.do_rate: 0.})
+
+    diffs = {'fp32': float(np.max(np.abs(engine(x) - rates))),
+             'int8': float(np.max(np.abs(int8_engine(x) - rates)))}
+    print("[*] max abs diff with TF : fp32 %.6f, int8 %.6f (reported only)" % (diffs['fp32'], diffs['int8']))
+    print("[*] engine weights in memory : fp32 %.2f MB, int8 %.2f MB" %
+          (engine.nbytes / 2 ** 20, int8_engine.nbytes / 2 ** 20))
+
+    if diffs['fp32'] > tolerance:
+        raise ValueError("[-] the NumPy engine doesn't match the TF graph, %.6f > %.6f" % (diffs['fp32'], tolerance))
+    return diffs
+
+
+def export_npz(s, model, ckpt):
+    if not config.model == 'charcnn':
+        raise NotImplementedError("[-] only TextCNN is supported by the NumPy engine")
+
+    export_weights(s, engine_hparams(), args.output)
+    print("[+] %s weights, %.2f MB, written to %s" % (ckpt, os.path.getsize(args.output) / 2 ** 20, args.output))
+
+    int8_output = None
+    if args.use_int8:
+        int8_output = os.path.splitext(args.output)[0] + '-int8.npz'
+        export_weights(s, engine_hparams(), int8_output, use_int8=True)
+        print("[+] int8 weights, %.2f MB, written to %s" % (os.path.getsize(int8_output) / 2 ** 20, int8_output))
+
+    # startup time of the serving side
+    start = time.perf_counter()
+    TextCNNEngine.load(args.output)
+    print("[*] loading the exported weights takes %.3fs" % (time.perf_counter() - start))
+
+    check_parity(s, model, args.output, int8_output, args.n_parity_samples, args.parity_tolerance)
+
+
+def main():
+    embed_type = config.use_pre_trained_embeds
+    vectors = load_trained_embeds(embed_type)
+
+    with tempfile.TemporaryDirectory() as tmp, tf.Session(config=session_config('cpu')) as s:
+        model = build_model(s, vectors, embed_type, summary_dir=tmp)
+
+        ckpt = args.ckpt_path or find_checkpoint(config.pretrained, config.model, best=True)
+        if not ckpt:
+            raise FileNotFoundError("[-] No checkpoint file found in %s" % config.pretrained)
+
+        model.init_embeddings()  # static pre-trained embeddings aren't in the checkpoint
+        model.saver.restore(s, ckpt)
+        print("[+] %s restored" % ckpt)
+
+        if args.format == 'npz':
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            export_npz(s, model, ckpt)
+            return
+
+        n_train_nodes = len(s.graph.as_graph_def().node)
+
+        # x -> rates only, drop out fixed to 0
+        graph_def = freeze_graph(s, [OUTPUT_NAME], constant_inputs={'do-rate': 0.})
+        graph_def = optimize_graph(graph_def, [INPUT_NAME], [OUTPUT_NAME])
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with tf.gfile.GFile(args.output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    # everything the serving side needs to know
+    meta = {
+        'checkpoint': ckpt,
+        'model': config.model,
+        'embed_type': embed_type,
+        'n_classes': config.n_classes,
+        'sequence_length': config.sequence_length,
+        'input': INPUT_NAME,
+        'output': OUTPUT_NAME,
+    }
+    with open(os.path.splitext(args.output)[0] + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    print("[+] %d nodes (train graph %d nodes), %.2f MB, written to %s" %
+          (len(graph_def.node), n_train_nodes, os.path.getsize(args.output) / 2 ** 20, args.output))
+
+    # startup time of the serving side
+    start = time.perf_counter()
+    graph, _, _ = load_frozen_graph(args.output, INPUT_NAME, OUTPUT_NAME)
+    with tf.Session(graph=graph, config=session_config('cpu')):
+        pass
+    print("[*] loading the exported graph takes %.3fs" % (time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import os
+import csv
+import json
+import time
+import zlib
+import argparse
+import numpy as np
+import multiprocessing as mp
+
+from config import get_config
+from evaluation import Evaluator
+from dataloader import Char2VecEmbeddings
+
+
+parser = argparse.ArgumentParser(description='fastText-style hashed n-gram baseline, Hogwild SGD over the corpus')
+parser.add_argument('--output', type=str, help='trained weights', default='./ml_model/fasttext.npz')
+parser.add_argument('--dims', type=int, help='n-gram embedding dims', default=100)
+parser.add_argument('--n_buckets', type=int, help='hashed n-gram embeddings', default=2 ** 21)
+parser.add_argument('--word_ngrams', type=int, help='1 ~ N grams of the (Mecab) tokens', default=2)
+parser.add_argument('--char_ngrams', type=int, help='N grams of the Char2Vec jamo ids, 0 to disable', default=3)
+parser.add_argument('--ft_epochs', type=int, help='passes over the corpus', default=5)
+parser.add_argument('--ft_lr', type=float, help='initial lr, linearly decayed to 0', default=.1)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+
+class FastText:
+
+    SEEDS = {'word': 0x9e3779b1, 'char': 0x85ebca6b, 'eos': 0xc2b2ae35}
+    PRIME = 1000000007
+
+    def __init__(self, n_buckets=2 ** 21, dims=100, n_classes=1, word_ngrams=2, char_ngrams=3,
+                 weights=None, shared=False):
+        """
+        averaged hashed word & jamo n-gram embeddings, then a linear (n_classes 1) or softmax (10) head
+        :param n_buckets: the number of hashed n-gram embeddings, int
+        :param dims: embedding dims, int
+        :param n_classes: 1 or 10, like the neural models, int
+        :param word_ngrams: 1 ~ N grams of the tokens, int
+        :param char_ngrams: N grams of the jamo ids (Char2Vec), 0 to disable, int
+        :param weights: (Optional) (embeddings, kernel, bias) trained before
+        :param shared: weights on shared memory, updated by the Hogwild workers, bool
+        """
+        self.n_buckets = n_buckets
+        self.dims = dims
+        self.n_classes = n_classes
+        self.word_ngrams = word_ngrams
+        self.char_ngrams = char_ngrams
+
+        self.c2v = Char2VecEmbeddings()
+
+        shapes = [(n_buckets, dims), (dims, n_classes), (n_classes,)]
+        if shared:
+            # fork()-ed workers write to the same pages, without any lock
+            self.embeddings, self.kernel, self.bias = [
+                np.frombuffer(mp.RawArray('f', int(np.prod(shape))), dtype=np.float32).reshape(shape)
+                for shape in shapes]
+        else:
+            self.embeddings, self.kernel, self.bias = [np.zeros(shape, dtype=np.float32) for shape in shapes]
+
+        if weights:
+            for w, value in zip((self.embeddings, self.kernel, self.bias), weights):
+                w[...] = value
+        else:
+            rng = np.random.RandomState(config.seed)
+            self.embeddings[...] = rng.uniform(-1. / dims, 1. / dims, size=shapes[0])
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as w:
+            hp = json.loads(str(w['hparams']))
+            return cls(weights=(w['embeddings'], w['kernel'], w['bias']), **hp)
+
+    def save(self, fn):
+        hp = {'n_buckets': self.n_buckets, 'dims': self.dims, 'n_classes': self.n_classes,
+              'word_ngrams': self.word_ngrams, 'char_ngrams': self.char_ngrams}
+        np.savez(fn, embeddings=self.embeddings, kernel=self.kernel, bias=self.bias,
+                 hparams=np.array(json.dumps(hp)))
+
+    def features(self, tokens):
+        """
+        :param tokens: analyzed tokens (word/POS) or space-separated chars of a comment, list
+        :return: (unique n-gram ids, their counts), numpy arrays
+        """
+        # crc32 is stable across the processes, unlike hash()
+        words = [zlib.crc32(token.encode('utf8')) for token in tokens if token]
+        ids = [self.SEEDS['eos']]
+        for n in range(1, self.word_ngrams + 1):
+            for i in range(len(words) - n + 1):
+                h = self.SEEDS['word'] + n
+                for w in words[i:i + n]:
+                    h = (h * self.PRIME + w) & 0xffffffffffffffff
+                ids.append(h)
+
+        if self.char_ngrams:
+            jamo = np.asarray(self.c2v.decompose_str_as_one_hot(''.join(t.split('/')[0] for t in tokens),
+                                                                warning=False), dtype=np.uint64)
+            steps = len(jamo) - self.char_ngrams + 1
+            if steps > 0:
+                h = np.full(steps, self.SEEDS['char'], dtype=np.uint64)
+                for j in range(self.char_ngrams):
+                    h = h * np.uint64(self.PRIME) + jamo[j:j + steps]  # wraps around
+                ids.extend(h.tolist())
+
+        return np.unique(np.asarray(ids, dtype=np.uint64) % np.uint64(self.n_buckets), return_counts=True)
+
+    def hidden(self, ids, counts):
+        return counts.dot(self.embeddings[ids]) / counts.sum()
+
+    def outputs(self, h):
+        out = h.dot(self.kernel) + self.bias
+        if self.n_classes == 1:
+            return out * 4.5 + 5.5  # 1 ~ 10, roughly
+        out = np.exp(out - out.max(axis=-1, keepdims=True))
+        return out / out.sum(axis=-1, keepdims=True)
+
+    def update(self, ids, counts, rate, lr):
+        """
+        a SGD step on a comment
+        :param ids: unique n-gram ids, numpy array
+        :param counts: their counts, numpy array
+        :param rate: label, 1 ~ 10, int or float
+        :param lr: float
+        :return: float, loss (squared error or cross entropy)
+        """
+        n = counts.sum()
+        h = counts.dot(self.embeddings[ids]) / n
+
+        out = h.dot(self.kernel) + self.bias
+        if self.n_classes == 1:
+            g = out - (rate - 5.5) / 4.5
+            loss = float(g[0] ** 2)
+        else:
+            p = np.exp(out - out.max())
+            p /= p.sum()
+            loss = -float(np.log(p[int(rate) - 1] + 1e-12))
+            p[int(rate) - 1] -= 1.
+            g = p
+
+        g_h = self.kernel.dot(g)
+        self.kernel -= lr * np.outer(h, g)
+        self.bias -= lr * g
+        self.embeddings[ids] -= (lr / n) * counts[:, None] * g_h
+        return loss
+
+    def predict(self, batch_tokens):
+        """
+        :param batch_tokens: tokens of each comment, list
+        :return: (n, n_classes) numpy array, rates in the neural model's format
+        """
+        return self.outputs(np.stack([self.hidden(*self.features(tokens)) for tokens in batch_tokens]))
+
+    def __call__(self, batch_tokens):
+        return self.predict(batch_tokens)
+
+
+def stream_corpus(fn, worker=0, n_workers=1, split='train', valid_every=0):
+    """
+    :param fn: processed dataset (rate, comment), str
+    :param worker: index of the worker, int
+    :param n_workers: rows are interleaved over the workers, int
+    :param split: train or valid, str
+    :param valid_every: every N-th row is held out for the valid, 0 for none, int
+    :return: generator, (rate, tokens)
+    """
+    with open(fn, 'r', encoding='utf8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)  # header
+
+        idx = 0
+        for row_no, row in enumerate(reader):
+            if len(row) < 2:
+                continue
+
+            is_valid = valid_every > 0 and row_no % valid_every == 0
+            if is_valid != (split == 'valid'):
+                continue
+
+            if idx % n_workers == worker:
+                yield float(row[0]), row[1].split(' ')
+            idx += 1
+
+
+def train_worker(model, fn, worker, n_workers, epochs, lr, total, counter, valid_every):
+    """
+    Hogwild, each worker updates the shared weights with its own rows of the stream
+    :param counter: the number of rows processed by all the workers, for the linear lr decay, mp.Value
+    """
+    n, loss, start = 0, 0., time.perf_counter()
+    for epoch in range(epochs):
+        for rate, tokens in stream_corpus(fn, worker, n_workers, valid_every=valid_every):
+            progress = counter.value / total
+            loss += model.update(*model.features(tokens), rate=rate, lr=lr * max(1. - progress, 1e-4))
+
+            n += 1
+            if n % 1000 == 0:
+                counter.value += 1000  # racy, it's only the lr schedule
+                if worker == 0 and n % 100000 == 0:
+                    print("[*] epoch %d, %.1f%%, loss %.4f, %.1f rows/s per worker" %
+                          (epoch, progress * 100., loss / 100000, n / (time.perf_counter() - start)))
+                    loss = 0.
+
+
+def count_rows(fn):
+    with open(fn, 'rb') as f:
+        return sum(buf.count(b'\n') for buf in iter(lambda: f.read(2 ** 20), b'')) - 1
+
+
+def main():
+    if not os.path.isfile(config.processed_dataset):
+        raise FileNotFoundError("[-] %s is not found, run main.py first" % config.processed_dataset)
+
+    n_workers = config.n_threads
+    valid_every = max(2, int(round(1. / config.test_size))) if config.test_size > 0. else 0
+
+    n_rows = count_rows(config.processed_dataset)
+    n_train = n_rows - (n_rows // valid_every + 1 if valid_every else 0)
+    print("[*] %d rows (%d train), %d Hogwild workers" % (n_rows, n_train, n_workers))
+
+    model = FastText(args.n_buckets, args.dims, config.n_classes, args.word_ngrams, args.char_ngrams, shared=True)
+
+    # fork()-ed workers share the weights (RawArray) with the parent
+    ctx = mp.get_context('fork')
+    counter = ctx.Value('l', 0, lock=False)
+    workers = [ctx.Process(target=train_worker,
+                           args=(model, config.processed_dataset, i, n_workers, args.ft_epochs, args.ft_lr,
+                                 max(1, n_train * args.ft_epochs), counter, valid_every))
+               for i in range(n_workers)]
+
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    if any(w.exitcode for w in workers):
+        raise RuntimeError("[-] worker failed, exit codes %s" % [w.exitcode for w in workers])
+
+    print("[+] %d epochs, %.1fs, %.1fs/epoch, %.1f rows/s" %
+          (args.ft_epochs, elapsed, elapsed / args.ft_epochs, n_train * args.ft_epochs / elapsed))
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    model.save(args.output)
+    print("[+] weights are saved at %s" % args.output)
+
+    if not valid_every:
+        return
+
+    # every valid_every-th row, not the same split as main.py
+    evaluator = Evaluator(n_rows // valid_every + 1, config.n_classes)
+
+    def evaluate(batch, rates):
+        y = np.asarray(rates).reshape(-1, 1)
+        evaluator.add(model(batch), y if config.n_classes == 1 else np.eye(10)[y[:, 0].astype(np.int64) - 1])
+
+    batch, rates = [], []
+    for rate, tokens in stream_corpus(config.processed_dataset, split='valid', valid_every=valid_every):
+        batch.append(tokens)
+        rates.append(rate)
+        if len(batch) == config.batch_size:
+            evaluate(batch, rates)
+            batch, rates = [], []
+    if batch:
+        evaluate(batch, rates)
+
+    print(evaluator.report(os.path.splitext(args.output)[0] + '-eval.json'))
+
+
+if __name__ == '__main__':
+    main()
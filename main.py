@@ -1,21 +1,30 @@
 import os
+import sys
 import time
 import argparse
 import numpy as np
 import tensorflow as tf
 
 from tqdm import tqdm
+from collections import OrderedDict
 from config import get_config, export_config
 from model.textcnn import TextCNN
-from model.textrnn import TextRNN
+from model.textrnn import TextRNN, cudnn_round_trip
+from metrics import StageTimer, MetricsLogger, peak_rss_mb
+from evaluation import Evaluator
+from distill import Teacher, distill_report
+from tfutil import local_cluster_spec, launch_local_cluster, sync_replicas_init, wait_for_variables, StepProfiler
+from tfutil import chief_ready_flag, session_config, AsyncCheckpointer
 from sklearn.model_selection import train_test_split
-from dataloader import Word2VecEmbeddings, Doc2VecEmbeddings, Char2VecEmbeddings, DataLoader, DataIterator
+from dataloader import DataLoader, DataIterator, MappedSubset
+from dataloader import c2v_encode, w2v_encode, load_embeddings, data_cache_files
 
 
 parser = argparse.ArgumentParser(description='train/test movie review classification model')
 parser.add_argument('--checkpoint', type=str, help='pre-trained model', default=None)
 parser.add_argument('--refine_data', type=bool, help='solving data imbalance problem', default=False)
-args = parser.parse_args()
+parser.add_argument('--show_plots', type=bool, help='showing the plots (blocking), saved only by default', default=False)
+args, _ = parser.parse_known_args()
 
 # parsed args
 checkpoint = args.checkpoint
@@ -61,89 +70,105 @@ def data_distribution(y_, size=10, img='dist.png'):
     return y_dist
 
 
-def data_confusion_matrix(y_pred, y_true, labels, normalize=True):
-    import itertools
-    import matplotlib.pyplot as plt
-    from sklearn.metrics import confusion_matrix
-
-    """
-    0-3: bad
-    4-7: normal
-    7-10: good
-    """
-
-    def labeling(y):
-        if 0 <= y < 3:
-            return 0
-        elif 3 <= y < 7:
-            return 1
-        else:
-            return 2
-
-    y_pred = np.array([labeling(y) for y in y_pred])
-    y_true = np.array([labeling(y[0]) for y in y_true])[:-20]
-
-    assert y_pred.shape[0] == y_true.shape[0]
-
-    cnf_mat = confusion_matrix(y_pred, y_true)
-    np.set_printoptions(precision=2)
-
-    if normalize:
-        cnf_mat = cnf_mat.astype('float') / cnf_mat.sum(axis=1)[:, np.newaxis]
-
-    plt.figure()
-
-    plt.imshow(cnf_mat, interpolation='nearest', cmap=plt.cm.Blues)
-    plt.title("Confusion Matrix")
-    plt.colorbar()
-
-    tick_marks = np.arange(len(labels))
-    plt.xticks(tick_marks, labels, rotation=45)
-    plt.yticks(tick_marks, labels)
-
-    thresh = cnf_mat.max() / 2.
-    for i, j in itertools.product(range(cnf_mat.shape[0]), range(cnf_mat.shape[1])):
-        plt.text(j, i, format(cnf_mat[i, j], '.2f'),
-                 horizontalalignment="center",
-                 color="white" if cnf_mat[i, j] > thresh else "black")
-
-    plt.ylabel('True label')
-    plt.xlabel('Predicted label')
-    plt.tight_layout()
-
-    plt.savefig("./confusion_matrix.png")
-
-    plt.show()
-
-
 def load_trained_embeds(embed_mode='char'):
     """
     :param embed_mode: embedding mode, str
     :return: embedding vector, numpy array
     """
-    if embed_mode == 'd2v':
-        vec = Doc2VecEmbeddings(config.d2v_model, config.embed_size)  # Doc2Vec Loader
-        if config.verbose:
-            print("[+] Doc2Vec loaded! Total %d pre-trained sentences, %d dims" % (len(vec), config.embed_size))
-    elif embed_mode == 'w2v':
-        vec = Word2VecEmbeddings(config.w2v_model, config.embed_size)  # WOrd2Vec Loader
-        if config.verbose:
-            print("[+] Word2Vec loaded! Total %d pre-trained words, %d dims" % (len(vec), config.embed_size))
-    else:
-        vec = Char2VecEmbeddings()
-        if config.verbose:
-            print("[+] Using Char2Vec, %d dims" % config.embed_size)
-    return vec
+    return load_embeddings(embed_mode, config)
 
 
-if __name__ == '__main__':
-    embed_type = config.use_pre_trained_embeds
+def build_model(s, vectors, embed_type='c2v', n_replicas=1, is_chief=True, model_name=None, summary_dir=None,
+                rnn_backend=None, fused_kmax=None, n_filters=None, se_ratio=None):
+    """
+    :param s: tf.Session
+    :param vectors: loaded embeddings, Word2VecEmbeddings or Doc2VecEmbeddings or Char2VecEmbeddings
+    :param embed_type: embedding type, str
+    :param n_replicas: the number of data-parallel workers, int
+    :param is_chief: chief worker or not, bool
+    :param model_name: charcnn or charrnn, default is config.model, str
+    :param summary_dir: where the summaries are written, default is config.pretrained, str
+    :param rnn_backend: GRU implementation of TextRNN, default is config.rnn_backend, str
+    :param fused_kmax: TextCNN k-max pooling before ThresholdReLU, default is config.fused_kmax, bool
+    :param n_filters: TextCNN conv filters per branch, default is config.filter_size, int
+    :param se_ratio: TextCNN SE module reduction ratio, default is config.se_ratio, int
+    :return: TextCNN or TextRNN
+    """
+    model_name = model_name or config.model
+    summary_dir = summary_dir or config.pretrained
+    rnn_backend = rnn_backend or config.rnn_backend
+    fused_kmax = config.fused_kmax if fused_kmax is None else fused_kmax
+    n_filters = n_filters or config.filter_size
+    se_ratio = se_ratio or config.se_ratio
+
+    if model_name == 'charcnn':
+        # Model Loaded
+        return TextCNN(s=s,
+                       mode=config.mode,
+                       w2v_embeds=vectors.embeds if not embed_type == 'c2v' else None,
+                       n_classes=config.n_classes,
+                       optimizer=config.optimizer,
+                       kernel_sizes=config.kernel_size,
+                       n_filters=n_filters,
+                       n_dims=config.embed_size,
+                       vocab_size=config.character_size if embed_type == 'c2v' else config.vocab_size + 1,
+                       sequence_length=config.sequence_length,
+                       lr=config.lr,
+                       lr_decay=config.lr_decay,
+                       lr_lower_boundary=config.lr_lower_boundary,
+                       fc_unit=config.fc_unit,
+                       th=config.act_threshold,
+                       grad_clip=config.grad_clip,
+                       summary=summary_dir,
+                       score_function=config.score_function,
+                       use_se_module=config.use_se_module,
+                       se_radio=se_ratio,
+                       se_type=config.se_type,
+                       use_multi_channel=config.use_multi_channel,
+                       fused_kmax=fused_kmax,
+                       n_replicas=n_replicas,
+                       is_chief=is_chief,
+                       grad_accum_steps=config.grad_accum_steps,
+                       embed_optimizer=config.embed_optimizer,
+                       distill_alpha=config.distill_alpha if config.distill_teacher else 0.,
+                       distill_temperature=config.distill_temperature)
+    elif model_name == 'charrnn':
+        return TextRNN(s=s,
+                       mode=config.mode,
+                       w2v_embeds=vectors.embeds if not embed_type == 'c2v' else None,
+                       n_classes=config.n_classes,
+                       optimizer=config.optimizer,
+                       n_gru_cells=config.n_gru_cells,
+                       n_gru_layers=config.n_gru_layers,
+                       n_attention_size=config.n_attention_size,
+                       rnn_backend=rnn_backend,
+                       pad_id=0 if embed_type == 'c2v' else config.vocab_size,
+                       n_dims=config.embed_size,
+                       vocab_size=config.character_size if embed_type == 'c2v' else config.vocab_size + 1,
+                       sequence_length=config.sequence_length,
+                       lr=config.lr,
+                       lr_decay=config.lr_decay,
+                       lr_lower_boundary=config.lr_lower_boundary,
+                       fc_unit=config.fc_unit,
+                       grad_clip=config.grad_clip,
+                       summary=summary_dir,
+                       n_replicas=n_replicas,
+                       is_chief=is_chief,
+                       grad_accum_steps=config.grad_accum_steps,
+                       embed_optimizer=config.embed_optimizer,
+                       distill_alpha=config.distill_alpha if config.distill_teacher else 0.,
+                       distill_temperature=config.distill_temperature)
+    else:
+        raise NotImplementedError("[-] Not Implemented Yet")
 
-    # Stage 1 : loading trained embeddings
-    vectors = load_trained_embeds(embed_type)
 
-    # Stage 2 : loading tokenize data
-    if config.use_pre_trained_embeds == 'c2v':  # Char2Vec
+def encode_dataset(vectors, embed_type):
+    """
+    :param vectors: loaded embeddings, Word2VecEmbeddings or Char2VecEmbeddings
+    :param embed_type: embedding type, str
+    :return: (x_data, y_data, duplicate counts (None without --use_dedup), pre-processing stage times)
+    """
+    if embed_type == 'c2v':  # Char2Vec
         if os.path.isfile(config.processed_dataset):
             ds = DataLoader(file=config.processed_dataset,
                             fn_to_save=None,
@@ -180,9 +205,7 @@ if __name__ == '__main__':
 
             sen_len.append(sentence_length)
 
-            sent = vectors.decompose_str_as_one_hot(sentence,
-                                                    warning=False)[:config.sequence_length]
-            x_data[i] = np.pad(sent, (0, config.sequence_length - len(sent)), 'constant', constant_values=0)
+            x_data[i] = c2v_encode(vectors, sentence, config.sequence_length)
 
         if config.verbose:
             print("[*] Total %d samples (training)" % x_data.shape[0])
@@ -202,13 +225,82 @@ if __name__ == '__main__':
 
         x_data = np.zeros((ds_len, config.sequence_length), dtype=np.int32)
         for i in tqdm(range(ds_len)):
-            sent = ds.sentences[i][:config.sequence_length]
-            x_data[i] = np.pad(vectors.words_to_index(sent),
-                               (0, config.sequence_length - len(sent)), 'constant', constant_values=config.vocab_size)
+            x_data[i] = w2v_encode(vectors, ds.sentences[i], config.sequence_length, pad_id=config.vocab_size)
 
     y_data = np.array(ds.labels).reshape(-1, config.n_classes)
+    w_data = ds.weights.astype(np.float32) if ds.weights is not None else None
+
+    preprocess_perf = ds.timer.summary(prefix='preprocess/')
 
-    ds = None
+    return x_data, y_data, w_data, preprocess_perf
+
+
+def load_dataset(vectors, embed_type, use_cache=None):
+    """
+    :param vectors: loaded embeddings, Word2VecEmbeddings or Char2VecEmbeddings
+    :param embed_type: embedding type, str
+    :param use_cache: keeping the encoded dataset as .npy files, default is config.use_data_cache, bool
+    :return: (x_data, y_data, sample weights, pre-processing stage times), memory-mapped when it's loaded from
+             the cache. the sample weights are the duplicate counts with --use_sample_weights, None otherwise
+    """
+    use_cache = config.use_data_cache if use_cache is None else use_cache
+
+    x_file, y_file, w_file, _ = data_cache_files(config, embed_type)
+    if use_cache and os.path.isfile(x_file) and os.path.isfile(y_file):
+        print("[+] encoded dataset loaded from %s, %s" % (x_file, y_file))
+        x_data, y_data, preprocess_perf = np.load(x_file, mmap_mode='r'), np.load(y_file, mmap_mode='r'), OrderedDict()
+        w_data = np.load(w_file, mmap_mode='r') if os.path.isfile(w_file) else None
+    else:
+        x_data, y_data, w_data, preprocess_perf = encode_dataset(vectors, embed_type)
+
+        if use_cache:
+            np.save(x_file, x_data)
+            np.save(y_file, y_data)
+            if w_data is not None:
+                np.save(w_file, w_data)
+            print("[+] encoded dataset is written to %s, %s" % (x_file, y_file))
+
+    if not config.use_sample_weights:
+        return x_data, y_data, None, preprocess_perf
+
+    if w_data is None or not len(w_data) == len(x_data):
+        print("[-] no duplicate counts of the dataset (--use_dedup), the samples are weighted equally")
+        w_data = None
+    return x_data, y_data, w_data, preprocess_perf
+
+
+if __name__ == '__main__':
+    # Stage 0 : (Optional) data-parallel training over the localhost cluster
+    n_workers = config.n_workers if config.is_train else 1
+    is_chief = not config.job_name or config.task_index == 0
+
+    if n_workers > 1:
+        cluster = local_cluster_spec(n_workers, base_port=config.cluster_port)
+
+        if not config.job_name:  # launcher, re-running this script as ps & workers
+            sys.exit(launch_local_cluster(n_workers))
+
+        server = tf.train.Server(cluster, job_name=config.job_name, task_index=config.task_index)
+        if config.job_name == 'ps':
+            server.join()  # serving the variables until the launcher terminates it
+    else:
+        cluster, server = None, None
+
+    embed_type = config.use_pre_trained_embeds
+
+    # Stage 1 : loading trained embeddings
+    vectors = load_trained_embeds(embed_type)
+
+    # Stage 2 : loading tokenize data, or the encoded dataset kept by the last run
+    x_data, y_data, w_data, preprocess_perf = load_dataset(vectors, embed_type)
+    x_file, _, _, t_file = data_cache_files(config, embed_type)
+
+    # Stage 2.1 : (Optional) teacher rates for the distillation, computed once & memory-mapped
+    teacher, t_data = None, None
+    if config.distill_teacher:
+        teacher = Teacher(config.distill_teacher, config.device)
+        t_data = teacher.predict(x_data, t_file, batch_size=config.batch_size * 8,
+                                 sources=[x_file if config.use_data_cache else config.processed_dataset])
 
     if config.verbose:
         print("[*] sentence to %s index conversion finish!" % config.use_pre_trained_embeds)
@@ -225,89 +317,92 @@ if __name__ == '__main__':
 
         x_data = np.delete(x_data, rand_idx, axis=0).reshape(-1, config.sequence_length)
         y_data = np.delete(y_data, rand_idx, axis=0).reshape(-1, config.n_classes)
+        if t_data is not None:
+            t_data = np.delete(t_data, rand_idx, axis=0)
+        if w_data is not None:
+            w_data = np.delete(w_data, rand_idx, axis=0)
 
         if config.verbose:
             print("[*] refined comment : ", x_data.shape)
             print("[*] refined rate    : ", y_data.shape)
 
-    # shuffle/split data
-    x_train, x_valid, y_train, y_valid = train_test_split(x_data, y_data, random_state=config.seed,
-                                                          test_size=config.test_size, shuffle=True)
+    # shuffle/split data, (x, y[, teacher rates][, sample weights])
+    data = [d for d in (x_data, y_data, t_data, w_data) if d is not None]
+    if isinstance(x_data, np.memmap):
+        # the same split by index, rows are gathered per batch & concurrent runs share the page cache (sweep.py)
+        train_idx, valid_idx = train_test_split(np.arange(len(x_data)), random_state=config.seed,
+                                                test_size=config.test_size, shuffle=True)
+        splits = [subset for d in data for subset in (MappedSubset(d, train_idx), MappedSubset(d, valid_idx))]
+    else:
+        splits = train_test_split(*data, random_state=config.seed, test_size=config.test_size, shuffle=True)
+
+    x_train, x_valid, y_train, y_valid = splits[:4]
+    t_train, t_valid = splits[4:6] if t_data is not None else (None, None)
+    w_train = splits[-2] if w_data is not None else None  # the valid loss is unweighted
     if config.verbose:
         print("[*] train/test %d/%d(%.1f/%.1f) split!" % (len(y_train), len(y_valid),
                                                           1. - config.test_size, config.test_size))
 
-    del x_data, y_data
+    del x_data, y_data, t_data, w_data, data, splits
+
+    if n_workers > 1:
+        # each worker takes its own, equally sized shard of the train data
+        shard_size = x_train.shape[0] // n_workers
+        x_train = x_train[config.task_index::n_workers][:shard_size]
+        y_train = y_train[config.task_index::n_workers][:shard_size]
+        if t_train is not None:
+            t_train = t_train[config.task_index::n_workers][:shard_size]
+        if w_train is not None:
+            w_train = w_train[config.task_index::n_workers][:shard_size]
+
+        if config.verbose:
+            print("[*] worker %d/%d takes %d train samples" % (config.task_index, n_workers, shard_size))
 
     data_size = x_train.shape[0]
 
     # DataSet Iterator
-    di = DataIterator(x=x_train, y=y_train, batch_size=config.batch_size)
+    di = DataIterator(x=x_train, y=y_train, batch_size=config.batch_size, t=t_train, w=w_train)
 
-    if config.device == 'gpu':
-        dev_config = tf.ConfigProto()
-        dev_config.gpu_options.allow_growth = True
-    else:
-        dev_config = None
-
-    with tf.Session(config=dev_config) as s:
-        if config.model == 'charcnn':
-            # Model Loaded
-            model = TextCNN(s=s,
-                            mode=config.mode,
-                            w2v_embeds=vectors.embeds if not embed_type == 'c2v' else None,
-                            n_classes=config.n_classes,
-                            optimizer=config.optimizer,
-                            kernel_sizes=config.kernel_size,
-                            n_filters=config.filter_size,
-                            n_dims=config.embed_size,
-                            vocab_size=config.character_size if embed_type == 'c2v' else config.vocab_size + 1,
-                            sequence_length=config.sequence_length,
-                            lr=config.lr,
-                            lr_decay=config.lr_decay,
-                            lr_lower_boundary=config.lr_lower_boundary,
-                            fc_unit=config.fc_unit,
-                            th=config.act_threshold,
-                            grad_clip=config.grad_clip,
-                            summary=config.pretrained,
-                            score_function=config.score_function,
-                            use_se_module=config.use_se_module,
-                            se_radio=config.se_ratio,
-                            se_type=config.se_type,
-                            use_multi_channel=config.use_multi_channel)
-        elif config.model == 'charrnn':
-            model = TextRNN(s=s,
-                            mode=config.mode,
-                            w2v_embeds=vectors.embeds if not embed_type == 'c2v' else None,
-                            n_classes=config.n_classes,
-                            optimizer=config.optimizer,
-                            n_gru_cells=config.n_gru_cells,
-                            n_gru_layers=config.n_gru_layers,
-                            n_attention_size=config.n_attention_size,
-                            n_dims=config.embed_size,
-                            vocab_size=config.character_size if embed_type == 'c2v' else config.vocab_size + 1,
-                            sequence_length=config.sequence_length,
-                            lr=config.lr,
-                            lr_decay=config.lr_decay,
-                            lr_lower_boundary=config.lr_lower_boundary,
-                            fc_unit=config.fc_unit,
-                            grad_clip=config.grad_clip,
-                            summary=config.pretrained)
-        else:
-            raise NotImplementedError("[-] Not Implemented Yet")
+    if is_chief and config.is_train and config.model == 'charrnn' and config.rnn_backend == 'cudnn':
+        # the checkpoints must restore into cudnn_compatible (CPU) by the canonical names
+        diff = cudnn_round_trip(config.pretrained + 'cudnn-round-trip.ckpt')
+        if diff > 1e-4:
+            raise ValueError("[-] cudnn checkpoint doesn't restore into cudnn_compatible, max abs diff %.6f" % diff)
+        if config.verbose:
+            print("[+] cudnn -> cudnn_compatible checkpoint round trip, max abs diff %.2e" % diff)
+
+    dev_config = session_config(config.device, config.tf_threads)
+
+    if n_workers > 1:
+        dev_config.device_filters.extend(['/job:ps', '/job:worker/task:%d' % config.task_index])
+
+    with tf.Session(server.target if server else '', config=dev_config) as s:
+        # variables are placed on the ps, ops on this worker
+        with tf.device(tf.train.replica_device_setter(worker_device='/job:worker/task:%d' % config.task_index,
+                                                      cluster=cluster) if cluster else None):
+            model = build_model(s, vectors, embed_type, n_replicas=n_workers, is_chief=is_chief)
+
+            # set by the chief once the shared variables are initialized & restored
+            ready = chief_ready_flag() if cluster else None
 
         if config.verbose:
-            print("[+] %s model loaded" % config.model)
+            print("[+] %s model loaded, GraphDef %.2f MB" %
+                  (config.model, s.graph.as_graph_def().ByteSize() / 2 ** 20))
 
         # Initializing
-        s.run(tf.global_variables_initializer())
+        if is_chief:
+            s.run(tf.global_variables_initializer())
+            model.init_embeddings()  # pre-trained embeddings, a checkpoint (if any) overrides them
 
-        # exporting config
-        export_config()
+            # exporting config
+            export_config(config.pretrained + 'config.txt')
+        else:
+            wait_for_variables(s, ready)
+        s.run(tf.local_variables_initializer())
 
         # loading checkpoint
         global_step = 0
-        if checkpoint:
+        if checkpoint and is_chief:
             print("[*] Reading checkpoints...")
 
             ckpt = tf.train.get_checkpoint_state(config.pretrained)
@@ -320,25 +415,86 @@ if __name__ == '__main__':
             else:
                 print('[-] No checkpoint file found')
 
+        if is_chief and ready is not None:
+            s.run(ready.initializer)  # the other workers start from here
+
+        if n_workers > 1:
+            sync_replicas_init(s, model.opt, is_chief)
+
+            if not is_chief:
+                global_step = s.run(model.global_step)  # shared with the (restored) chief
+
+        # step-level tracing, at the chosen steps only
+        profiler = StepProfiler([int(step) for step in config.profile_steps.split(',') if step],
+                                log_dir=config.profile_dir, writer=model.writer)
+
+        # JSON-lines & TensorBoard performance logs
+        metrics_logger = MetricsLogger(config.pretrained + config.metrics_file if is_chief else None,
+                                       writer=model.writer)
+        metrics_logger.log(global_step, preprocess_perf)
+
         start_time = time.time()
 
         if config.is_train:
             best_loss = 1e1  # initial value
             batch_size = config.batch_size
-            model.global_step.assign(tf.constant(global_step))
-            restored_epochs = global_step // (data_size // batch_size)
+            if is_chief:
+                # the op is built once, apply_gradients() increases the variable per applied update
+                s.run(model.global_step.assign(global_step))
+            # global_step counts the applied updates, grad_accum_steps micro-batches each
+            restored_epochs = global_step * config.grad_accum_steps // (data_size // batch_size)
+
+            # snapshots are written by a background thread, off the training thread
+            checkpointer = AsyncCheckpointer(model.saved_variables) if is_chief else None
+            ckpt_path = config.pretrained + '%s.ckpt' % config.model
+            best_ckpt_path = config.pretrained + '%s-best_loss.ckpt' % config.model
+
+            # throughput & stage-time instrumentation, flushed every logging_step
+            timer = StageTimer()
+            n_samples, n_steps, window_start = 0, 0, time.perf_counter()
+            micro_step = 0
             for epoch in range(restored_epochs, config.epochs):
-                for x_tr, y_tr in di.iterate():
-                    # training
-                    _, loss, acc = s.run([model.train_op, model.loss, model.accuracy],
-                                         feed_dict={
-                                             model.x: x_tr,
-                                             model.y: y_tr,
-                                             model.do_rate: config.drop_out,
-                                         })
-
-                    if global_step and global_step % config.logging_step == 0:
+                for batch in timer.iterate(di.iterate(), 'data_wait'):
+                    x_tr, y_tr = batch[0], batch[1]
+                    feed_dict = {
+                        model.x: x_tr,
+                        model.y: y_tr,
+                        model.do_rate: config.drop_out,
+                    }
+                    if model.y_teacher is not None:
+                        feed_dict[model.y_teacher] = batch[2]
+                    if di.w is not None:
+                        feed_dict[model.sample_weight] = batch[-1]
+
+                    # training, the host-to-device copy of feed_dict happens inside s.run(), so it's in compute
+                    with timer.stage('compute'):
+                        if model.accum_op is None:
+                            _, loss, acc = profiler.run(s, [model.train_op, model.loss, model.accuracy],
+                                                        feed_dict=feed_dict, step=global_step)
+                            is_applied = True
+                        else:
+                            # accumulating the micro-batch gradients, applying them every grad_accum_steps
+                            _, loss, acc = profiler.run(s, [model.accum_op, model.loss, model.accuracy],
+                                                        feed_dict=feed_dict, step=global_step)
+
+                            micro_step += 1
+                            is_applied = micro_step % config.grad_accum_steps == 0
+                            if is_applied:
+                                s.run(model.train_op)
+
+                    n_samples += len(x_tr)
+                    n_steps += 1
+
+                    if not is_applied:
+                        continue  # logging, checkpoints & global_step go by the optimizer steps
+
+                    if is_chief and global_step and global_step % config.logging_step == 0:
+                        # throughput of the train steps, validation & checkpoints below aren't in the window
+                        window = time.perf_counter() - window_start
+
                         # validation
+                        valid_start = time.perf_counter()
+
                         rand_idx = np.random.choice(np.arange(len(y_valid)), len(y_valid) // 20)  # 5% of valid data
 
                         x_va, y_va = x_valid[rand_idx], y_valid[rand_idx]
@@ -359,6 +515,8 @@ if __name__ == '__main__':
                         valid_loss /= valid_iter
                         valid_acc /= valid_iter
 
+                        timer.add('validation', time.perf_counter() - valid_start)
+
                         print("[*] epoch %03d global step %07d" % (epoch, global_step),
                               " train_loss : {:.8f} train_acc : {:.4f}".format(loss, acc),
                               " valid_loss : {:.8f} valid_acc : {:.4f}".format(valid_loss, valid_acc))
@@ -375,57 +533,87 @@ if __name__ == '__main__':
                         model.writer.add_summary(summary, global_step)
 
                         # Model save
-                        model.saver.save(s, config.pretrained + '%s.ckpt' % config.model,
-                                         global_step=global_step)
+                        with timer.stage('checkpoint'):
+                            checkpointer.save(s, ckpt_path, global_step)
+
+                            if valid_loss < best_loss:
+                                print("[+] model improved {:.7f} to {:.7f}".format(best_loss, valid_loss))
+                                best_loss = valid_loss
+
+                                checkpointer.save(s, best_ckpt_path, global_step)
+
+                        # throughput & stage-time
+                        perf = OrderedDict([
+                            ('valid_loss', valid_loss),
+                            ('valid_acc', valid_acc),
+                            ('samples_per_sec', n_samples / window),
+                            ('step_secs', window / n_steps),
+                            ('peak_rss_mb', peak_rss_mb()),
+                        ])
+                        perf.update(timer.summary())
+                        metrics_logger.log(global_step, perf)
+
+                        if config.verbose:
+                            print("[*] %.1f samples/s, %s" % (perf['samples_per_sec'], timer))
+                        print()
 
-                        if valid_loss < best_loss:
-                            print("[+] model improved {:.7f} to {:.7f}".format(best_loss, valid_loss))
-                            best_loss = valid_loss
+                        timer.reset()
+                        n_samples, n_steps, window_start = 0, 0, time.perf_counter()
 
-                            model.best_saver.save(s, config.pretrained + '%s-best_loss.ckpt' % config.model,
-                                                  global_step=global_step)
-                        print()
+                    elif is_chief and checkpointer.is_due(config.save_interval_secs):
+                        ckpt_start = time.perf_counter()
+                        with timer.stage('checkpoint'):
+                            checkpointer.save(s, ckpt_path, global_step)
+                        window_start += time.perf_counter() - ckpt_start  # out of the throughput window
 
-                    model.global_step.assign_add(tf.constant(1))
                     global_step += 1
 
+            if checkpointer:
+                checkpointer.close()  # the pending checkpoints
+
             end_time = time.time()
 
             print("[+] Training Done! Elapsed {:.8f}s".format(end_time - start_time))
+
+            metrics_logger.close()
         else:  # test
             x_train, y_train = None, None
-            x_va, y_va = x_valid, y_valid
-
-            valid_loss, valid_acc = 0., 0.
 
             batch_size = config.batch_size
-            valid_iter = len(y_va) // config.batch_size
 
-            v_rates = []
-            for i in tqdm(range(0, valid_iter)):
-                v_loss, v_acc, v_rate = s.run([model.loss, model.accuracy, model.rates],
+            # every sample, including the tail batch
+            evaluator = Evaluator(len(y_valid), config.n_classes)
+            for i in tqdm(range(0, len(y_valid), batch_size)):
+                x_va, y_va = x_valid[i:i + batch_size], y_valid[i:i + batch_size]
+
+                v_loss, v_rate = profiler.run(s, [model.loss, model.rates],
                                               feed_dict={
-                                                  model.x: x_va[batch_size * i:batch_size * (i + 1)],
-                                                  model.y: y_va[batch_size * i:batch_size * (i + 1)],
+                                                  model.x: x_va,
+                                                  model.y: y_va,
                                                   model.do_rate: .0,
-                                              })
-                valid_acc += v_acc
-                valid_loss += v_loss
-
-                for j in v_rate:
-                    v_rates.append(j)
-
-            valid_loss /= valid_iter
-            valid_acc /= valid_iter
+                                              }, step=i // batch_size, tag='test')
+                evaluator.add(v_rate, y_va, v_loss)
 
             print("[+] Validation Result (%s model %d global steps), total %d samples" %
                   (config.model, global_step, x_valid.shape[0]))
-            print("    => valid_loss (MSE) : {:.8f} valid_acc (th=1.0) : {:.4f}".format(valid_loss, valid_acc))
+            print(evaluator.report(config.pretrained + 'eval.json'))
 
-            """
-            with open('pred.txt', 'w') as f:
-                f.writelines([str("{:.4f}\n".format(rate[0])) for rate in v_rates])
-            """
+            eval_summary = evaluator.summary()
+            metrics_logger.log(global_step,
+                               OrderedDict((k, eval_summary[k]) for k in ('loss', 'mse', 'mae', 'accuracy')),
+                               prefix='eval/')
+            metrics_logger.close()
 
             # confusion matrix
-            data_confusion_matrix(v_rates, y_va, ["bad", "normal", "good"])
+            evaluator.plot_confusion_matrix("./confusion_matrix.png", show=args.show_plots)
+
+        if teacher is not None and is_chief:
+            # accuracy & latency of this (student) model against the teacher
+            print("[+] Distillation Result (%s model, teacher %s), total %d samples" %
+                  (config.model, config.distill_teacher, len(y_valid)))
+            print(distill_report(lambda x: s.run(model.rates, feed_dict={model.x: x, model.do_rate: 0.}),
+                                 teacher, x_valid, y_valid, t_valid, config.batch_size, config.n_classes,
+                                 config.pretrained + 'distill.json'))
+
+    if teacher is not None:
+        teacher.close()
@@ -0,0 +1,155 @@
+import sys
+import json
+import time
+
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict, deque
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of this process in MB, 0 if it's not supported (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.  # bytes on macOS, KB on Linux
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.elapsed = OrderedDict()
+        self.counts = defaultdict(int)
+
+    def add(self, name, seconds, count=1):
+        """
+        :param name: stage name, str
+        :param seconds: elapsed time, float
+        :param count: the number of calls, int
+        :return: None
+        """
+        self.elapsed[name] = self.elapsed.get(name, 0.) + seconds
+        self.counts[name] += count
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def iterate(self, iterable, name):
+        """
+        timing how long it takes to get each item from the iterable
+        :param iterable: iterable, like DataIterator.iterate()
+        :param name: stage name, str
+        :return: generator
+        """
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def summary(self, prefix=''):
+        """
+        :param prefix: key prefix, str
+        :return: dict, stage : elapsed seconds
+        """
+        return OrderedDict((prefix + name + '_secs', t) for name, t in self.elapsed.items())
+
+    def reset(self):
+        self.elapsed.clear()
+        self.counts.clear()
+
+    def __str__(self):
+        total = sum(self.elapsed.values()) or 1.
+        return ', '.join("%s %.3fs (%.1f%%)" % (name, t, 100. * t / total) for name, t in self.elapsed.items())
+
+
+class MetricsLogger:
+
+    def __init__(self, log_file=None, writer=None):
+        """
+        :param log_file: (Optional) JSON-lines file to append, str
+        :param writer: (Optional) tf.summary.FileWriter
+        """
+        self.log_file = open(log_file, 'a', encoding='utf8') if log_file else None
+        self.writer = writer
+
+    def log(self, step, metrics, prefix='perf/'):
+        """
+        :param step: global step, int
+        :param metrics: dict, name : number
+        :param prefix: TensorBoard tag prefix, str
+        :return: None
+        """
+        if self.log_file:
+            record = OrderedDict([('step', int(step)), ('time', time.time())])
+            record.update((k, float(v)) for k, v in metrics.items())
+
+            self.log_file.write(json.dumps(record) + '\n')
+            self.log_file.flush()
+
+        if self.writer:
+            import tensorflow as tf
+
+            summary = tf.Summary(value=[tf.Summary.Value(tag=prefix + k, simple_value=float(v))
+                                        for k, v in metrics.items()])
+            self.writer.add_summary(summary, step)
+
+    def close(self):
+        if self.log_file:
+            self.log_file.close()
+
+
+class LatencyTracker:
+
+    def __init__(self, window=10000):
+        """
+        :param window: the number of recent latencies kept for the percentiles, int
+        """
+        self.latencies = deque(maxlen=window)
+        self.start_time = time.time()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_batched_items = 0
+
+    def add(self, seconds, count=1):
+        """
+        :param seconds: latency of a request, float
+        :param count: the number of items in the request, int
+        :return: None
+        """
+        self.latencies.append(seconds)
+        self.n_requests += count
+
+    def add_batch(self, batch_size):
+        self.n_batches += 1
+        self.n_batched_items += batch_size
+
+    def summary(self):
+        """
+        :return: dict, p50/p99 latency (ms), throughput, mean batch size
+        """
+        import numpy as np
+
+        lat = np.asarray(self.latencies) * 1e3
+        uptime = time.time() - self.start_time
+        return OrderedDict([
+            ('requests', self.n_requests),
+            ('uptime_secs', uptime),
+            ('throughput_per_sec', self.n_requests / uptime if uptime else 0.),
+            ('latency_p50_ms', float(np.percentile(lat, 50)) if len(lat) else 0.),
+            ('latency_p99_ms', float(np.percentile(lat, 99)) if len(lat) else 0.),
+            ('mean_batch_size', self.n_batched_items / self.n_batches if self.n_batches else 0.),
+        ])
@@ -1,6 +1,9 @@
 import numpy as np
 import tensorflow as tf
 
+from tfutil import accumulate_gradients, sparse_optimizer, SplitOptimizer, distillation_loss
+from tfutil import checkpoint_var_list, weighted_mean
+
 
 class TextCNN:
 
@@ -9,7 +12,9 @@ class TextCNN:
                  kernel_sizes=(1, 2, 3, 4), n_filters=256, fc_unit=1024,
                  lr=5e-4, lr_lower_boundary=1e-5, lr_decay=.95, l2_reg=1e-3, th=1e-6, grad_clip=5.,
                  summary=None, mode='static', w2v_embeds=None,
-                 use_se_module=False, se_radio=16, se_type='A', use_multi_channel=False, score_function='tanh'):
+                 use_se_module=False, se_radio=16, se_type='A', use_multi_channel=False, score_function='tanh',
+                 n_replicas=1, is_chief=True, grad_accum_steps=1, embed_optimizer='dense', fused_kmax=True,
+                 distill_alpha=0., distill_temperature=1.):
         self.s = s
         self.n_dims = n_dims
         self.n_classes = n_classes
@@ -26,14 +31,25 @@ class TextCNN:
         self.fc_unit = fc_unit
         self.l2_reg = l2_reg
         self.th = th
+        self.fused_kmax = fused_kmax
         self.grad_clip = grad_clip
+        self.grad_accum_steps = grad_accum_steps
+
+        # knowledge distillation, the weight of the teacher rates in the train loss
+        self.distill_alpha = distill_alpha
+        self.distill_temperature = distill_temperature
 
         self.optimizer = optimizer
+        self.embed_optimizer = embed_optimizer
 
         self.summary = summary
         self.mode = mode
         self.w2v_embeds = w2v_embeds
 
+        # data-parallel training
+        self.n_replicas = n_replicas
+        self.is_chief = is_chief
+
         # score function
         self.score_function = score_function
 
@@ -59,40 +75,50 @@ class TextCNN:
                                            initializer=self.he_uni, trainable=False if self.mode == 'static' else True)
                            for i in range(self.n_embeds)]
 
-        if not self.mode == 'rand':
-            if self.w2v_embeds:
-                for i in range(self.n_embeds):
-                    self.embeddings[i] = self.embeddings[i].assign(self.w2v_embeds)
+        # pre-trained embeddings are fed once by init_embeddings(), not baked into the GraphDef as constants
+        self.embeds_init = None
+        if not self.mode == 'rand' and isinstance(self.w2v_embeds, np.ndarray):
+            self.embeds_ph = tf.placeholder(tf.float32, shape=[self.vocab_size, self.n_dims], name='embeds-init')
+            self.embeds_init = tf.group(*[embedding.assign(self.embeds_ph) for embedding in self.embeddings])
 
-                print("[+] Word2Vec pre-trained model loaded!")
+        is_c2v = isinstance(self.w2v_embeds, str) and self.w2v_embeds == 'c2v'
 
-        self.x = tf.placeholder(tf.uint8 if self.w2v_embeds == 'c2v' else tf.int32,
+        self.x = tf.placeholder(tf.uint8 if is_c2v else tf.int32,
                                 shape=[None, self.sequence_length], name='x-sentence')
         self.y = tf.placeholder(tf.float32, shape=[None, self.n_classes], name='y-label')  # one-hot or int
         self.do_rate = tf.placeholder(tf.float32, name='do-rate')
+        # (Optional) duplicate counts (--use_sample_weights), the validation loss stays unweighted
+        self.sample_weight = tf.placeholder_with_default(tf.ones_like(self.y[:, 0]), shape=[None],
+                                                         name='sample-weight')
 
         # build CharCNN Model
         self.feat, self.rates = self.build_model()
 
         # loss
         if self.n_classes == 1:
-            self.loss = tf.reduce_mean(tf.losses.mean_squared_error(
-                labels=self.y,
-                predictions=self.rates
-            ))  # MSE loss
+            self.loss = weighted_mean(tf.reduce_mean(tf.squared_difference(self.y, self.rates), axis=-1),
+                                      self.sample_weight)  # MSE loss
 
             self.prediction = self.rates
 
             self.accuracy = tf.reduce_mean(tf.cast((tf.abs(self.y - self.prediction) <= 1.0), dtype=tf.float32))
         else:
-            self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(
+            self.loss = weighted_mean(tf.nn.softmax_cross_entropy_with_logits_v2(
                 logits=self.feat,
                 labels=self.y
-            ))  # softmax cross-entropy
+            ), self.sample_weight)  # softmax cross-entropy
 
             self.prediction = tf.argmax(self.rates, axis=1)
             self.accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(self.y, 1), self.prediction), dtype=tf.float32))
 
+        # the loss to minimize, mixed with the teacher rates when distilling. self.loss stays on the true rates
+        self.y_teacher = None
+        self.train_loss = self.loss
+        if self.distill_alpha > 0.:
+            self.y_teacher = tf.placeholder(tf.float32, shape=[None, self.n_classes], name='y-teacher')
+            self.train_loss = (1. - self.distill_alpha) * self.loss + self.distill_alpha * \
+                distillation_loss(self.feat, self.rates, self.y_teacher, self.distill_temperature)
+
         # Optimizer
         self.global_step = tf.Variable(0, name="global_step", trainable=False)
         learning_rate = tf.train.exponential_decay(lr,
@@ -105,7 +131,7 @@ class TextCNN:
                                    clip_value_max=1e-3,
                                    name='lr-clipped')
 
-        if self.w2v_embeds == 'c2v':
+        if is_c2v:
             try:
                 assert not self.optimizer == 'adadelta'
             except AssertionError:
@@ -120,9 +146,30 @@ class TextCNN:
         else:
             raise NotImplementedError("[-] only Adam, SGD are supported!")
 
-        gradients, variables = zip(*self.opt.compute_gradients(self.loss))
-        gradients, _ = tf.clip_by_global_norm(gradients, self.grad_clip)
-        self.train_op = self.opt.apply_gradients(zip(gradients, variables), global_step=self.global_step)
+        if self.n_replicas > 1:
+            # synchronous gradient averaging over the worker replicas
+            self.opt = tf.train.SyncReplicasOptimizer(self.opt,
+                                                      replicas_to_aggregate=self.n_replicas,
+                                                      total_num_replicas=self.n_replicas)
+
+        gradients, variables = zip(*self.opt.compute_gradients(self.train_loss))
+        gradients, _ = tf.clip_by_global_norm(gradients, self.grad_clip)  # IndexedSlices (embeddings) stay sparse
+
+        opt = self.opt
+        if not self.embed_optimizer == 'dense':
+            if self.n_replicas > 1:
+                raise NotImplementedError("[-] embed_optimizer is not supported with data-parallel training")
+
+            # only the looked up rows (and their slots) of the embeddings are updated
+            opt = SplitOptimizer(self.opt, sparse_optimizer(self.embed_optimizer, self.lr), self.embeddings)
+
+        if self.grad_accum_steps > 1:
+            # run accum_op for every micro-batch, train_op for every grad_accum_steps micro-batches
+            self.accum_op, self.train_op = accumulate_gradients(opt, zip(gradients, variables),
+                                                                self.grad_accum_steps, self.global_step)
+        else:
+            self.accum_op = None
+            self.train_op = opt.apply_gradients(zip(gradients, variables), global_step=self.global_step)
 
         # Mode Saver/Summary
         tf.summary.scalar('loss/loss', self.loss)
@@ -132,14 +179,30 @@ class TextCNN:
         # Merge summary
         self.merged = tf.summary.merge_all()
 
-        # Model savers
-        self.saver = tf.train.Saver(max_to_keep=1)
-        self.best_saver = tf.train.Saver(max_to_keep=1)
-        self.writer = tf.summary.FileWriter(self.summary, self.s.graph)
+        # Model savers, frozen pre-trained embeddings are fed by init_embeddings(), not saved
+        static = set()
+        if self.mode == 'static' and self.embeds_init is not None:
+            static = {v.op.name for v in self.embeddings}
+        self.saved_variables = checkpoint_var_list(excluded=static)
+
+        self.saver = tf.train.Saver(var_list=self.saved_variables, max_to_keep=1)
+        self.best_saver = tf.train.Saver(var_list=self.saved_variables, max_to_keep=1)
+        self.writer = tf.summary.FileWriter(self.summary, self.s.graph) if self.is_chief else None
 
         # print total param of the model
         self.count_params()
 
+    def init_embeddings(self):
+        """
+        feeding the pre-trained embeddings, after the variables are initialized & before restoring a checkpoint
+        :return: None
+        """
+        if self.embeds_init is None:
+            return
+
+        self.s.run(self.embeds_init, feed_dict={self.embeds_ph: self.w2v_embeds})
+        print("[+] Word2Vec pre-trained model loaded!")
+
     @staticmethod
     def count_params():
         from functools import reduce
@@ -179,6 +242,20 @@ class TextCNN:
 
             return skip_conn * x
 
+    def threshold_relu(self, x):
+        return tf.where(tf.less(x, self.th), tf.zeros_like(x), x)
+
+    @staticmethod
+    def k_max_pool(x, k=3):
+        """
+        :param x: (batch, steps, n_filters) tf.Tensor
+        :param k: int
+        :return: (batch, k, n_filters) tf.Tensor, the k largest values over the steps in descending order
+        """
+        # sorted, the order of unsorted top_k differs between the devices (and the NumPy engine)
+        x = tf.nn.top_k(tf.transpose(x, [0, 2, 1]), k=k, sorted=True)[0]
+        return tf.transpose(x, [0, 2, 1])
+
     def build_model(self):
         embeds = []
         pooled_outs = []
@@ -208,13 +285,19 @@ class TextCNN:
                         padding='VALID',
                         name='conv1d'
                     )
-                    x = tf.where(tf.less(x, self.th), tf.zeros_like(x), x)  # TresholdReLU
 
-                    if self.use_se_module and not self.se_type == 'B':
-                        x = self.se_module(x, x.get_shape()[-1])
+                    use_branch_se = self.use_se_module and not self.se_type == 'B'
+                    if self.fused_kmax and not use_branch_se:
+                        # ThresholdReLU is monotone, so it commutes with k-max pooling (the same outputs & grads).
+                        # it runs on the pooled (batch, 3, 256) instead of the (batch, steps, 256) activations
+                        x = self.threshold_relu(self.k_max_pool(x))
+                    else:
+                        x = self.threshold_relu(x)  # TresholdReLU
+
+                        if use_branch_se:
+                            x = self.se_module(x, x.get_shape()[-1])
 
-                    x = tf.nn.top_k(tf.transpose(x, [0, 2, 1]), k=3, sorted=False)[0]
-                    x = tf.transpose(x, [0, 2, 1])
+                        x = self.k_max_pool(x)
 
                     pooled_outs.append(x)
 
@@ -234,7 +317,7 @@ class TextCNN:
                 kernel_regularizer=self.reg,
                 name='fc1'
             )
-            x = tf.where(tf.less(x, self.th), tf.zeros_like(x), x)  # TresholdReLU
+            x = self.threshold_relu(x)  # TresholdReLU
 
             x = tf.layers.dense(
                 x,
@@ -254,4 +337,5 @@ class TextCNN:
                     rate = rate * 9. + 1.
             else:
                 rate = tf.nn.softmax(x)
+            rate = tf.identity(rate, name='rates')  # 'outputs/rates', the output of the exported graph
             return x, rate
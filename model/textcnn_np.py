@@ -0,0 +1,303 @@
+import json
+import numpy as np
+
+from numpy.lib.stride_tricks import as_strided
+
+
+def branch_scopes(kernel_sizes, n_embeds=1):
+    """
+    :param kernel_sizes: conv kernel sizes, list
+    :param n_embeds: 2 for the multi-channel mode, int
+    :return: list, (embedding index, kernel size, variable scope) of each conv branch, in TextCNN order
+    """
+    return [(idx, fs, "conv_layer-%d-%d-%d" % (idx, fs, i) if n_embeds > 1 else "conv_layer-%d-%d" % (fs, i))
+            for idx in range(n_embeds) for i, fs in enumerate(kernel_sizes)]
+
+
+def export_weights(s, hparams, fn=None, use_int8=False):
+    """
+    collecting the TextCNN inference weights from a (restored) session
+    :param s: tf.Session
+    :param hparams: dict, kernel_sizes, th, score_function, use_multi_channel
+    :param fn: (Optional) .npz file to save, str
+    :param use_int8: int8 kernels & embeddings, with their per-channel scales under '<name>/scale', bool
+    :return: dict, variable name : numpy array
+    """
+    import tensorflow as tf
+
+    n_embeds = 2 if hparams['use_multi_channel'] else 1
+
+    prefixes = ['embeddings', 'se-module/', 'outputs/fc1/', 'outputs/fc2/']
+    prefixes += [scope + '/' for _, _, scope in branch_scopes(hparams['kernel_sizes'], n_embeds)]
+
+    # optimizer slots (kernel/Adam, ...) are skipped
+    variables = [v for v in tf.global_variables()
+                 if any(v.op.name.startswith(p) for p in prefixes) and v.op.name.split('/')[-1] in
+                 ('kernel', 'bias', 'embeddings', 'embeddings-0', 'embeddings-1')]
+
+    weights = dict(zip([v.op.name for v in variables], s.run(variables)))
+    if use_int8:
+        for name in [name for name in weights if not name.endswith('bias')]:
+            weights[name], weights[name + '/scale'] = quantize(weights[name], axis=channel_axis(name))
+    weights['hparams'] = np.array(json.dumps(hparams))
+
+    if fn:
+        np.savez(fn, **weights)
+    return weights
+
+
+def quantize(w, axis=-1):
+    """
+    symmetric int8 quantization, a scale per channel
+    :param w: float weights, numpy array
+    :param axis: channel axis, int
+    :return: (int8 weights, float32 scales)
+    """
+    reduce_axes = tuple(i for i in range(w.ndim) if not i == axis % w.ndim)
+    scale = np.max(np.abs(w), axis=reduce_axes, keepdims=True) / 127.
+    scale[scale == 0.] = 1.
+    return np.round(w / scale).astype(np.int8), scale.astype(np.float32)
+
+
+def channel_axis(name):
+    """
+    :param name: weight name, str
+    :return: int, a scale per row (token) of the embeddings, per output channel of the kernels
+    """
+    return 0 if name.split('/')[-1].startswith('embeddings') else -1
+
+
+def load_weight(weights, name, use_int8=False):
+    """
+    :param weights: dict made by export_weights(), or a loaded .npz
+    :param name: weight name, str
+    :param use_int8: quantizing the fp32 weights, an int8 export is always kept int8, bool
+    :return: (int8 weights, float32 scales), or (float32 weights, None)
+    """
+    if name + '/scale' in weights:
+        return weights[name], weights[name + '/scale'].astype(np.float32)
+    if use_int8:
+        return quantize(weights[name], axis=channel_axis(name))
+    return weights[name].astype(np.float32), None
+
+
+class Dense:
+
+    def __init__(self, kernel, bias, scale=None):
+        """
+        :param kernel: (n_inputs, n_outputs) float32 or int8 numpy array
+        :param bias: (n_outputs,) numpy array
+        :param scale: (Optional) per output channel scales of the int8 kernel, numpy array
+        """
+        self.kernel = kernel
+        self.bias = bias.astype(np.float32)
+        self.scale = None if scale is None else scale.reshape(-1)
+
+    def __call__(self, x):
+        if self.scale is None:
+            return x @ self.kernel + self.bias
+        # NumPy has no int8 GEMM (integer matmuls don't go through BLAS), the matmul is fp32 over the int8 values
+        # & the scales are applied to its outputs
+        return (x @ self.kernel.astype(np.float32)) * self.scale + self.bias
+
+    def dequantized(self):
+        """
+        :return: float32 numpy array, the kernel (times its scales)
+        """
+        return self.kernel if self.scale is None else self.kernel.astype(np.float32) * self.scale
+
+    @property
+    def nbytes(self):
+        return self.kernel.nbytes + self.bias.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+
+class TextCNNEngine:
+
+    def __init__(self, weights, use_int8=False, max_im2col_mb=64, max_table_vocab=4096):
+        """
+        TensorFlow-free TextCNN forward pass, the same as TextCNN.build_model() at drop out 0
+        :param weights: dict made by export_weights(), or a loaded .npz
+        :param use_int8: int8 per-channel weight quantization, the weights are kept int8 in memory, bool
+        :param max_im2col_mb: memory bound of an im2col buffer (MB), the batch is split into chunks, int
+        :param max_table_vocab: for small vocabs (Char2Vec), embedding @ kernel is pre-computed per token, int
+        """
+        self.hparams = json.loads(str(weights['hparams']))
+        self.use_int8 = use_int8 or any(name.endswith('/scale') for name in weights)
+        self.max_im2col_bytes = max_im2col_mb * 2 ** 20
+
+        self.th = self.hparams['th']
+        self.score_function = self.hparams['score_function']
+
+        n_embeds = 2 if self.hparams['use_multi_channel'] else 1
+
+        # embeddings, (weights, a scale per row (token) when it's quantized)
+        self.embeddings = [load_weight(weights, 'embeddings' if n_embeds == 1 else 'embeddings-%d' % i, use_int8)
+                           for i in range(n_embeds)]
+        self.vocab_size = min(embed.shape[0] for embed, _ in self.embeddings)
+
+        self.branches = []
+        for idx, fs, scope in branch_scopes(self.hparams['kernel_sizes'], n_embeds):
+            kernel, scale = load_weight(weights, scope + '/conv1d/kernel', use_int8)  # (fs, n_dims, n_filters)
+            conv = Dense(kernel.reshape(-1, kernel.shape[-1]), weights[scope + '/conv1d/bias'], scale)
+
+            # conv1d becomes fs gathers & adds of (vocab, n_filters) fp32 tables
+            table = None
+            n_vocab = self.embeddings[idx][0].shape[0]
+            if n_vocab <= max_table_vocab:
+                table = np.einsum('vd,kdf->kvf', self.embed(idx, np.arange(n_vocab)),
+                                  conv.dequantized().reshape(kernel.shape))
+
+            self.branches.append((idx, fs, conv, table, self.load_se(weights, scope + '/se-module/')))
+
+        self.se = self.load_se(weights, 'se-module/')
+
+        self.fc1 = self.load_dense(weights, 'outputs/fc1/')
+        self.fc2 = self.load_dense(weights, 'outputs/fc2/')
+
+        self.n_classes = self.fc2.bias.shape[0]
+
+    @classmethod
+    def load(cls, fn, use_int8=False):
+        """
+        :param fn: .npz file made by export_weights(), str
+        :param use_int8: quantizing a fp32 export at load time, bool
+        :return: TextCNNEngine
+        """
+        with np.load(fn) as weights:
+            return cls(dict(weights), use_int8=use_int8)
+
+    def load_dense(self, weights, scope):
+        kernel, scale = load_weight(weights, scope + 'kernel', self.use_int8)
+        return Dense(kernel, weights[scope + 'bias'], scale)
+
+    def load_se(self, weights, scope):
+        if scope + 'squeeze/kernel' not in weights:
+            return None
+        return self.load_dense(weights, scope + 'squeeze/'), self.load_dense(weights, scope + 'excitation/')
+
+    def embed(self, idx, x):
+        # only the gathered rows are dequantized
+        embed, scale = self.embeddings[idx]
+        return embed[x] if scale is None else embed[x].astype(np.float32) * scale[x]
+
+    @property
+    def nbytes(self):
+        """
+        :return: int, bytes of the weights & the pre-computed tables held in memory
+        """
+        dense = [self.fc1, self.fc2] + [conv for _, _, conv, _, _ in self.branches]
+        dense += [d for se in [self.se] + [se for *_, se in self.branches] if se is not None for d in se]
+        tables = [table for _, _, _, table, _ in self.branches if table is not None]
+        return (sum(d.nbytes for d in dense) + sum(t.nbytes for t in tables) +
+                sum(e.nbytes + (0 if s is None else s.nbytes) for e, s in self.embeddings))
+
+    def threshold_relu(self, x):
+        x[x < self.th] = 0.
+        return x
+
+    @staticmethod
+    def se_module(x, se):
+        """ GAP-fc-fc-sigmoid """
+        squeeze, excitation = se
+        w = np.maximum(squeeze(x.mean(axis=1)), 0.)
+        w = 1. / (1. + np.exp(-excitation(w)))
+        return x * w[:, None, :]
+
+    def conv1d(self, embed, fs, conv):
+        """
+        VALID conv1d as im2col & a matmul, the windows are strided views of the embeddings
+        :param embed: (n, sequence_length, n_dims) numpy array
+        :param fs: kernel size, int
+        :param conv: Dense, (fs * n_dims, n_filters)
+        :return: (n, sequence_length - fs + 1, n_filters) numpy array
+        """
+        embed = np.ascontiguousarray(embed)
+        n, length, n_dims = embed.shape
+        steps = length - fs + 1
+
+        windows = as_strided(embed, shape=(n, steps, fs, n_dims),
+                             strides=(embed.strides[0], embed.strides[1], embed.strides[1], embed.strides[2]),
+                             writeable=False)
+
+        # each chunk copies (chunk, steps, fs * n_dims) at most
+        chunk = max(1, int(self.max_im2col_bytes // (steps * fs * n_dims * embed.itemsize)))
+
+        out = np.empty((n, steps, conv.bias.shape[0]), dtype=np.float32)
+        for i in range(0, n, chunk):
+            cols = windows[i:i + chunk].reshape(-1, fs * n_dims)
+            out[i:i + chunk] = conv(cols).reshape(-1, steps, conv.bias.shape[0])
+        return out
+
+    @staticmethod
+    def table_conv1d(x, fs, conv, table):
+        """
+        :param x: encoded comments, (n, sequence_length) numpy array
+        :param fs: kernel size, int
+        :param conv: Dense, only its bias is used
+        :param table: (fs, vocab, n_filters) numpy array, embedding @ kernel of each kernel offset
+        :return: (n, sequence_length - fs + 1, n_filters) numpy array
+        """
+        steps = x.shape[1] - fs + 1
+
+        out = table[0][x[:, :steps]] + conv.bias
+        for j in range(1, fs):
+            out += table[j][x[:, j:j + steps]]
+        return out
+
+    @staticmethod
+    def k_max_pool(x, k=3):
+        """
+        :param x: (n, steps, n_filters) numpy array
+        :param k: int
+        :return: (n, k, n_filters) numpy array, the k largest values over the steps in descending order
+        """
+        top_k = -np.partition(-x, k - 1, axis=1)[:, :k]
+        return -np.sort(-top_k, axis=1)
+
+    def pool(self, x):
+        """
+        :param x: encoded comments, (n, sequence_length) numpy array
+        :return: list of (n, 3, n_filters) numpy arrays, the k-max pooled outputs of each conv branch
+        """
+        x = np.asarray(x, dtype=np.int64)
+        embeds = [self.embed(i, x) if any(idx == i and table is None for idx, _, _, table, _ in self.branches)
+                  else None for i in range(len(self.embeddings))]
+
+        pooled_outs = []
+        for idx, fs, conv, table, se in self.branches:
+            if table is None:
+                out = self.conv1d(embeds[idx], fs, conv)
+            else:
+                out = self.table_conv1d(x, fs, conv, table)
+
+            if se is None:
+                # ThresholdReLU commutes with k-max pooling, the same as TextCNN(fused_kmax=True)
+                pooled_outs.append(self.threshold_relu(self.k_max_pool(out)))
+                continue
+
+            out = self.se_module(self.threshold_relu(out), se)
+            pooled_outs.append(self.k_max_pool(out))
+        return pooled_outs
+
+    def predict(self, x):
+        """
+        :param x: encoded comments, (n, sequence_length) numpy array
+        :return: (n, n_classes) numpy array, rates
+        """
+        out = np.concatenate(self.pool(x), axis=1)  # (n, 3 * n_branches, n_filters)
+        if self.se is not None:
+            out = self.se_module(out, self.se)
+
+        out = self.threshold_relu(self.fc1(out.reshape(out.shape[0], -1)))
+        out = self.fc2(out)
+
+        if self.n_classes == 1:
+            if self.score_function == 'tanh':
+                return (np.tanh(out) * 9. + 11.) / 2.
+            return 1. / (1. + np.exp(-out)) * 9. + 1.
+
+        out = np.exp(out - out.max(axis=-1, keepdims=True))
+        return out / out.sum(axis=-1, keepdims=True)
+
+    def __call__(self, x):
+        return self.predict(x)
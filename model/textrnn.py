@@ -1,8 +1,11 @@
 import numpy as np
 import tensorflow as tf
 
+from tfutil import accumulate_gradients, sparse_optimizer, SplitOptimizer, distillation_loss
+from tfutil import checkpoint_var_list, session_config, weighted_mean
 
-def attention(inputs, attention_size, time_major=False, return_alphas=False):
+
+def attention(inputs, attention_size, time_major=False, return_alphas=False, mask=None):
     """
     Attention mechanism layer which reduces RNN/Bi-RNN outputs with Attention vector.
     The idea was proposed in the article by Z. Yang et al., "Hierarchical Attention Networks
@@ -39,6 +42,8 @@ def attention(inputs, attention_size, time_major=False, return_alphas=False):
             accepts input and emits output in batch-major form.
         return_alphas: Whether to return attention coefficients variable along with layer's output.
             Used for visualization purpose.
+        mask: (Optional) `[batch_size, max_time]` float `Tensor`, 1 for the valid and 0 for the padded timestamps.
+            The padded timestamps get zero attention.
     Returns:
         The Attention output `Tensor`.
         In case of RNN, this will be a `Tensor` shaped:
@@ -69,6 +74,8 @@ def attention(inputs, attention_size, time_major=False, return_alphas=False):
 
     # For each of the timestamps its vector of size A from `v` is reduced with `u` vector
     vu = tf.tensordot(v, u_omega, axes=1, name='vu')  # (B,T) shape
+    if mask is not None:
+        vu += (1. - mask) * -1e9  # the padded timestamps are excluded from the softmax
     alphas = tf.nn.softmax(vu, name='alphas')  # (B,T) shape
 
     # Output of (Bi-)RNN is reduced with attention vector; the result has (B,D) shape
@@ -80,20 +87,102 @@ def attention(inputs, attention_size, time_major=False, return_alphas=False):
         return output, alphas
 
 
-def biGRU(inputs, n_gru_cells, n_gru_layers, do_rate, k_init=None):
+RNN_BACKENDS = ['gru', 'block', 'cudnn', 'cudnn_compatible']
+
+
+def gru_cell(n_gru_cells, do_rate, k_init=None, backend='gru'):
+    """
+    :param n_gru_cells: the number of GRU units, int
+    :param do_rate: drop out rate, tf.Tensor
+    :param k_init: kernel initializer
+    :param backend: gru, block or cudnn_compatible, str
+    :return: tf.nn.rnn_cell.RNNCell
+    """
+    if backend == 'gru':
+        cell = tf.nn.rnn_cell.GRUCell(num_units=n_gru_cells, kernel_initializer=k_init)
+    elif backend == 'block':
+        # one fused kernel per time step, the same variables as GRUCell (checkpoints are interchangeable)
+        # its kernels take the initializer of the enclosing variable scope
+        cell = tf.contrib.rnn.GRUBlockCellV2(num_units=n_gru_cells)
+    elif backend == 'cudnn_compatible':
+        cell = tf.contrib.cudnn_rnn.CudnnCompatibleGRUCell(num_units=n_gru_cells, kernel_initializer=k_init)
+    else:
+        raise NotImplementedError("[-] only %s are supported! (%s)" % (', '.join(RNN_BACKENDS), backend))
+    return tf.nn.rnn_cell.DropoutWrapper(cell, 1 - do_rate)
+
+
+def cudnn_biGRU(inputs, n_gru_cells, n_gru_layers, do_rate, k_init=None, backend='cudnn', seq_len=None):
+    """
+    CudnnGRU (GPU only) & its CPU counterpart, the canonical weights of CudnnGRU are saved under
+    the variable names of CudnnCompatibleGRUCell in 'biGRU' scope, so both restore the same checkpoint
+    """
+    if backend == 'cudnn':
+        gru = tf.contrib.cudnn_rnn.CudnnGRU(num_layers=n_gru_layers, num_units=n_gru_cells,
+                                            direction='bidirectional', kernel_initializer=k_init, name='biGRU')
+        # time-major, (sequence_length, ?, 2 * n_gru_cells)
+        x, _ = gru(tf.transpose(inputs, [1, 0, 2]), sequence_lengths=seq_len)
+        return tf.nn.dropout(tf.transpose(x, [1, 0, 2]), keep_prob=1. - do_rate)
+
+    with tf.variable_scope('biGRU'):
+        cells_fw = [gru_cell(n_gru_cells, do_rate, k_init, backend) for _ in range(n_gru_layers)]
+        cells_bw = [gru_cell(n_gru_cells, do_rate, k_init, backend) for _ in range(n_gru_layers)]
+
+        x, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(cells_fw, cells_bw, inputs, dtype=tf.float32,
+                                                                 sequence_length=seq_len)
+    return x
+
+
+def cudnn_round_trip(path, n_gru_cells=8, n_gru_layers=2, n_dims=4, sequence_length=5, batch_size=3, seed=1337):
+    """
+    saving a CudnnGRU (GPU only) checkpoint & restoring it into CudnnCompatibleGRUCell by the canonical names
+    :param path: checkpoint prefix to write, str
+    :return: max abs difference of the two outputs on the same inputs, float
+    """
+    x = np.random.RandomState(seed).uniform(-1., 1., (batch_size, sequence_length, n_dims)).astype(np.float32)
+
+    outputs = []
+    for backend in ('cudnn', 'cudnn_compatible'):
+        with tf.Graph().as_default(), tf.Session(config=session_config('gpu')) as s:
+            tf.set_random_seed(seed)
+            y = cudnn_biGRU(tf.constant(x), n_gru_cells, n_gru_layers, 0., backend=backend)
+
+            saver = tf.train.Saver(var_list=checkpoint_var_list())
+            if backend == 'cudnn':
+                s.run(tf.global_variables_initializer())
+                saver.save(s, path)
+            else:
+                saver.restore(s, path)
+            outputs.append(s.run(y))
+    return float(np.max(np.abs(outputs[0] - outputs[1])))
+
+
+def biGRU(inputs, n_gru_cells, n_gru_layers, do_rate, k_init=None, backend='gru', seq_len=None):
+    """
+    :param inputs: (?, sequence_length, n_dims) tf.Tensor
+    :param n_gru_cells: the number of GRU units, int
+    :param n_gru_layers: the number of bi-directional layers, int
+    :param do_rate: drop out rate, tf.Tensor
+    :param k_init: kernel initializer
+    :param backend: gru, block, cudnn or cudnn_compatible, str
+    :param seq_len: (Optional) (?,) valid lengths, nothing is computed past each of them & the outputs are zeros
+    :return: (?, sequence_length, 2 * n_gru_cells) tf.Tensor
+    """
+    if backend in ('cudnn', 'cudnn_compatible'):
+        return cudnn_biGRU(inputs, n_gru_cells, n_gru_layers, do_rate, k_init, backend, seq_len)
+
     x = inputs
 
     for i in range(n_gru_layers):
-        with tf.device('/gpu:0'), tf.variable_scope("biGRU-%d" % i) as scope:
-            cell_fw = tf.nn.rnn_cell.GRUCell(num_units=n_gru_cells, kernel_initializer=k_init)
-            cell_fw = tf.nn.rnn_cell.DropoutWrapper(cell_fw, 1 - do_rate)
-
-            cell_bw = tf.nn.rnn_cell.GRUCell(num_units=n_gru_cells, kernel_initializer=k_init)
-            cell_bw = tf.nn.rnn_cell.DropoutWrapper(cell_bw, 1 - do_rate)
+        # the fused block kernel is placed by TF, CPU or GPU
+        with tf.device('/gpu:0' if backend == 'gru' else None), \
+                tf.variable_scope("biGRU-%d" % i, initializer=k_init) as scope:
+            cell_fw = gru_cell(n_gru_cells, do_rate, k_init, backend)
+            cell_bw = gru_cell(n_gru_cells, do_rate, k_init, backend)
 
             outs, stat = tf.nn.bidirectional_dynamic_rnn(cell_fw=cell_fw,
                                                          cell_bw=cell_bw,
                                                          inputs=x,
+                                                         sequence_length=seq_len,
                                                          dtype=tf.float32,
                                                          scope=scope)
             x = tf.concat(outs, axis=2)
@@ -107,11 +196,14 @@ class TextRNN:
                  vocab_size=122351 + 1, sequence_length=400, n_dims=300, seed=1337, optimizer='adam',
                  n_gru_layers=2, n_gru_cells=256, n_attention_size=128, fc_unit=1024,
                  lr=5e-4, lr_lower_boundary=1e-5, lr_decay=.9, l2_reg=5e-4, th=1e-6, grad_clip=5.,
-                 summary=None, mode='static', w2v_embeds=None):
+                 summary=None, mode='static', w2v_embeds=None,
+                 n_replicas=1, is_chief=True, grad_accum_steps=1, embed_optimizer='dense', rnn_backend='gru',
+                 pad_id=0, distill_alpha=0., distill_temperature=1.):
         self.s = s
         self.n_dims = n_dims
         self.n_classes = n_classes
         self.vocab_size = vocab_size
+        self.pad_id = pad_id  # 0 for Char2Vec, vocab_size - 1 for Word2Vec
         self.sequence_length = sequence_length
 
         self.batch_size = batch_size
@@ -122,17 +214,28 @@ class TextRNN:
         self.n_gru_layers = n_gru_layers
         self.n_gru_cells = n_gru_cells
         self.n_attention_size = n_attention_size
+        self.rnn_backend = rnn_backend
         self.fc_unit = fc_unit
         self.l2_reg = l2_reg
         self.th = th
         self.grad_clip = grad_clip
+        self.grad_accum_steps = grad_accum_steps
+
+        # knowledge distillation, the weight of the teacher rates in the train loss
+        self.distill_alpha = distill_alpha
+        self.distill_temperature = distill_temperature
 
         self.optimizer = optimizer
+        self.embed_optimizer = embed_optimizer
 
         self.summary = summary
         self.mode = mode
         self.w2v_embeds = w2v_embeds
 
+        # data-parallel training
+        self.n_replicas = n_replicas
+        self.is_chief = is_chief
+
         # set random seed
         np.random.seed(self.seed)
         tf.set_random_seed(self.seed)
@@ -150,37 +253,46 @@ class TextRNN:
         else:
             raise NotImplementedError("[-] static or non-static or rand only! (%s)" % self.mode)
 
-        if not self.mode == 'rand':
-            if self.w2v_embeds:
-                self.embeddings = self.embeddings.assign(self.w2v_embeds)
-
-                print("[+] Word2Vec pre-trained model loaded!")
+        # pre-trained embeddings are fed once by init_embeddings(), not baked into the GraphDef as constants
+        self.embeds_init = None
+        if not self.mode == 'rand' and isinstance(self.w2v_embeds, np.ndarray):
+            self.embeds_ph = tf.placeholder(tf.float32, shape=[self.vocab_size, self.n_dims], name='embeds-init')
+            self.embeds_init = self.embeddings.assign(self.embeds_ph)
 
         self.x = tf.placeholder(tf.int32, shape=[None, self.sequence_length], name='x-sentence')
         self.y = tf.placeholder(tf.float32, shape=[None, self.n_classes], name='y-label')  # one-hot or int
         self.do_rate = tf.placeholder(tf.float32, name='do-rate')
+        # (Optional) duplicate counts (--use_sample_weights), the validation loss stays unweighted
+        self.sample_weight = tf.placeholder_with_default(tf.ones_like(self.y[:, 0]), shape=[None],
+                                                         name='sample-weight')
 
         # build CharCNN Model
-        self.feat, self.rate = self.build_model()
+        self.feat, self.rates = self.build_model()
 
         # loss
         if self.n_classes == 1:
-            self.loss = tf.reduce_mean(tf.losses.mean_squared_error(
-                labels=self.y,
-                predictions=self.rate
-            ))  # MSE loss
+            self.loss = weighted_mean(tf.reduce_mean(tf.squared_difference(self.y, self.rates), axis=-1),
+                                      self.sample_weight)  # MSE loss
 
-            self.prediction = self.rate
+            self.prediction = self.rates
             self.accuracy = tf.reduce_mean(tf.cast((tf.abs(self.y - self.prediction) <= 1.0), dtype=tf.float32))
         else:
-            self.loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(
+            self.loss = weighted_mean(tf.nn.softmax_cross_entropy_with_logits_v2(
                 logits=self.feat,
                 labels=self.y
-            ))  # softmax cross-entropy
+            ), self.sample_weight)  # softmax cross-entropy
 
-            self.prediction = tf.argmax(self.rate, axis=1)
+            self.prediction = tf.argmax(self.rates, axis=1)
             self.accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(self.y, 1), self.prediction), dtype=tf.float32))
 
+        # the loss to minimize, mixed with the teacher rates when distilling. self.loss stays on the true rates
+        self.y_teacher = None
+        self.train_loss = self.loss
+        if self.distill_alpha > 0.:
+            self.y_teacher = tf.placeholder(tf.float32, shape=[None, self.n_classes], name='y-teacher')
+            self.train_loss = (1. - self.distill_alpha) * self.loss + self.distill_alpha * \
+                distillation_loss(self.feat, self.rates, self.y_teacher, self.distill_temperature)
+
         # Optimizer
         self.global_step = tf.Variable(0, name="global_step", trainable=False)
         learning_rate = tf.train.exponential_decay(learning_rate=lr,
@@ -193,7 +305,7 @@ class TextRNN:
                                    clip_value_max=1e-3,
                                    name='lr-clipped')
 
-        if self.w2v_embeds == 'c2v':
+        if isinstance(self.w2v_embeds, str) and self.w2v_embeds == 'c2v':
             try:
                 assert not self.optimizer == 'adadelta'
             except AssertionError:
@@ -208,9 +320,30 @@ class TextRNN:
         else:
             raise NotImplementedError("[-] only Adam, SGD are supported!")
 
-        gradients, variables = zip(*self.opt.compute_gradients(self.loss))
-        gradients, _ = tf.clip_by_global_norm(gradients, self.grad_clip)
-        self.train_op = self.opt.apply_gradients(zip(gradients, variables), global_step=self.global_step)
+        if self.n_replicas > 1:
+            # synchronous gradient averaging over the worker replicas
+            self.opt = tf.train.SyncReplicasOptimizer(self.opt,
+                                                      replicas_to_aggregate=self.n_replicas,
+                                                      total_num_replicas=self.n_replicas)
+
+        gradients, variables = zip(*self.opt.compute_gradients(self.train_loss))
+        gradients, _ = tf.clip_by_global_norm(gradients, self.grad_clip)  # IndexedSlices (embeddings) stay sparse
+
+        opt = self.opt
+        if not self.embed_optimizer == 'dense':
+            if self.n_replicas > 1:
+                raise NotImplementedError("[-] embed_optimizer is not supported with data-parallel training")
+
+            # only the looked up rows (and their slots) of the embeddings are updated
+            opt = SplitOptimizer(self.opt, sparse_optimizer(self.embed_optimizer, self.lr), [self.embeddings])
+
+        if self.grad_accum_steps > 1:
+            # run accum_op for every micro-batch, train_op for every grad_accum_steps micro-batches
+            self.accum_op, self.train_op = accumulate_gradients(opt, zip(gradients, variables),
+                                                                self.grad_accum_steps, self.global_step)
+        else:
+            self.accum_op = None
+            self.train_op = opt.apply_gradients(zip(gradients, variables), global_step=self.global_step)
 
         # Mode Saver/Summary
         tf.summary.scalar('loss/loss', self.loss)
@@ -220,41 +353,66 @@ class TextRNN:
         # Merge summary
         self.merged = tf.summary.merge_all()
 
-        # Model savers
-        self.saver = tf.train.Saver(max_to_keep=1)
-        self.best_saver = tf.train.Saver(max_to_keep=1)
-        self.writer = tf.summary.FileWriter(self.summary, self.s.graph)
+        # Model savers, frozen pre-trained embeddings are fed by init_embeddings(), not saved
+        static = set()
+        if self.mode == 'static' and self.embeds_init is not None:
+            static = {v.op.name for v in [self.embeddings]}
+        self.saved_variables = checkpoint_var_list(excluded=static)
+
+        self.saver = tf.train.Saver(var_list=self.saved_variables, max_to_keep=1)
+        self.best_saver = tf.train.Saver(var_list=self.saved_variables, max_to_keep=1)
+        self.writer = tf.summary.FileWriter(self.summary, self.s.graph) if self.is_chief else None
+
+    def init_embeddings(self):
+        """
+        feeding the pre-trained embeddings, after the variables are initialized & before restoring a checkpoint
+        :return: None
+        """
+        if self.embeds_init is None:
+            return
+
+        self.s.run(self.embeds_init, feed_dict={self.embeds_ph: self.w2v_embeds})
+        print("[+] Word2Vec pre-trained model loaded!")
+
+    def sequence_lengths(self):
+        """
+        :return: (?,) int32 tf.Tensor, the position after the last non-padding token, at least 1
+        """
+        # only the trailing pads count, 0 (Char2Vec padding) is also a valid char in the middle
+        positions = tf.range(1, self.sequence_length + 1, dtype=tf.int32)
+        valid = tf.cast(tf.not_equal(self.x, self.pad_id), tf.int32)
+        return tf.maximum(tf.reduce_max(valid * positions, axis=1), 1)
 
     def build_model(self):
         outs = []
 
+        with tf.name_scope('sequence_length'):
+            self.seq_len = self.sequence_lengths()
+            mask = tf.sequence_mask(self.seq_len, maxlen=self.sequence_length, dtype=tf.float32)  # (?, 400)
+
         with tf.device('/cpu:0'), tf.name_scope('embeddings'):
             embeds = tf.nn.embedding_lookup(self.embeddings, self.x)
 
         spatial_drop_out = tf.keras.layers.SpatialDropout1D(self.do_rate)
         embeds = spatial_drop_out(embeds)
 
-        """
-        gru = tf.contrib.cudnn_rnn.CudnnGRU(num_layers=self.n_gru_layers, num_units=self.n_gru_cells,
-                                            direction='bidirectional',
-                                            seed=self.seed, kernel_initializer=self.he_uni, name='bigru1')
-        x, _ = gru(embeds)  # (?, 140, 512)
-        """
-
         x = biGRU(embeds, n_gru_cells=self.n_gru_cells, n_gru_layers=self.n_gru_layers, k_init=self.he_uni,
-                  do_rate=self.do_rate)
+                  do_rate=self.do_rate, backend=self.rnn_backend, seq_len=self.seq_len)
 
-        # 1. lambda : get last hidden state
-        outs.append(tf.reshape(x[:, -1, :], (-1, x.get_shape()[-1])))  # (?, 512)
+        # the pads are excluded from every pooling
+        # 1. lambda : get last (valid) hidden state
+        last = tf.stack([tf.range(tf.shape(x)[0]), self.seq_len - 1], axis=1)
+        outs.append(tf.gather_nd(x, last))  # (?, 512)
 
         # 2. GlobalMaxPooling1d
-        outs.append(tf.reduce_max(x, axis=1))  # (?, 512)
+        outs.append(tf.reduce_max(x + tf.expand_dims((1. - mask) * -1e9, -1), axis=1))  # (?, 512)
 
         # 3. GlobalAvgPooling1d
-        outs.append(tf.reduce_mean(x, axis=1))  # (?, 512)
+        outs.append(tf.reduce_sum(x * tf.expand_dims(mask, -1), axis=1) /
+                    tf.expand_dims(tf.cast(self.seq_len, tf.float32), -1))  # (?, 512)
 
         # 4. AttentionWeightedAverage
-        outs.append(attention(x, self.n_attention_size))  # (?, 512)
+        outs.append(attention(x, self.n_attention_size, mask=mask))  # (?, 512)
 
         x = tf.concat(outs, axis=-1)
         x = tf.layers.flatten(x)  # (?, 2048)
@@ -284,4 +442,5 @@ class TextRNN:
                 rate = rate * 9. + 1.  # To-Do : replace with another scale function to avoid saturation
             else:
                 rate = tf.nn.softmax(x)
+            rate = tf.identity(rate, name='rates')  # 'outputs/rates', the output of the exported graph
             return x, rate
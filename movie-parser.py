@@ -2,6 +2,7 @@
 # original link : http://bab2min.tistory.com/556
 
 from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from config import get_config
 from tqdm import tqdm
 
@@ -12,89 +13,131 @@ import urllib.request
 import re
 import os
 import bs4
+import glob
 import time
+import asyncio
+import argparse
+import tempfile
+import threading
 
 
+parser = argparse.ArgumentParser(description='NAVER movie review crawler')
+parser.add_argument('--base_url', type=str, help='pointWriteFormList page, or a local stand-in server',
+                    default='http://movie.naver.com/movie/bi/mi/pointWriteFormList.nhn')
+parser.add_argument('--start', type=int, help='the first movie code', default=10000)
+parser.add_argument('--end', type=int, help='the last movie code (exclusive)', default=200000)
+parser.add_argument('--concurrency', type=int, help='movies crawled at once, also the max pooled connections',
+                    default=16)
+parser.add_argument('--delay', type=float, help='sleep (secs) of a crawler after each movie', default=.5)
+parser.add_argument('--timeout', type=float, help='timeout (secs) of a page request', default=10.)
+parser.add_argument('--record_dir', type=str, help='(Optional) saving the fetched pages, <code>-<page>.html',
+                    default=None)
+parser.add_argument('--use_threads', type=bool, help='the old ThreadPoolExecutor & urllib crawler', default=False)
+parser.add_argument('--bench', type=bool, help='pages/s against a local stand-in server', default=False)
+parser.add_argument('--bench_pages_dir', type=str, help='recorded pages for the --bench, synthetic if not given',
+                    default=None)
+parser.add_argument('--bench_movies', type=int, help='synthetic movies for the --bench', default=200)
+parser.add_argument('--bench_pages', type=int, help='synthetic pages per movie for the --bench', default=5)
+args, _ = parser.parse_known_args()
+
 # get configuration
 cfg, _ = get_config()
 
 
-def get_comments(code):
-    def make_args(c, p):
-        params = {
-            'code': c,
-            'type': 'after',
-            'isActualPointWriteExecute': 'false',
-            'isMileageSubscriptionAlready': 'false',
-            'isMileageSubscriptionReject': 'false',
-            'page': p
-        }
-        return urllib.parse.urlencode(params)
- 
-    def inner_html(s, sl=0):
-        ret = ''
-        for idx in s.contents[sl:]:
-            ret += idx.strip() if idx is str else str(idx)
-        return ret
- 
-    def f_text(s):
-        return inner_html(s[0]).strip() if len(s) else ''
+def make_args(c, p):
+    params = {
+        'code': c,
+        'type': 'after',
+        'isActualPointWriteExecute': 'false',
+        'isMileageSubscriptionAlready': 'false',
+        'isMileageSubscriptionReject': 'false',
+        'page': p
+    }
+    return urllib.parse.urlencode(params)
+
+
+def inner_html(s, sl=0):
+    ret = ''
+    for idx in s.contents[sl:]:
+        ret += idx.strip() if idx is str else str(idx)
+    return ret
+
+
+def f_text(s):
+    return inner_html(s[0]).strip() if len(s) else ''
+
+
+def parse_page(data, page=0):
+    """
+    :param data: pointWriteFormList page, str
+    :param page: page number, for the error message, int
+    :return: list, (comment id, rate, comment) of the page
+    """
+    soup = bs4.BeautifulSoup(re.sub("&#(?![0-9])", "", data), "html.parser")
+
+    rows = []
+    for link in soup.select(".score_result li"):
+        try:
+            url = link.select('.score_reple em a')[0].get('onclick')
+        except ValueError:
+            raise ValueError("[-] %d :" % page, data)
+
+        m = re.search('[0-9]+', url)
+        url = m.group(0) if m else ''
+
+        cat = f_text(link.select('.star_score em'))
+        cont = f_text(link.select('.score_reple p'))
+        cont = re.sub('<span [^>]+>.+?</span>', '', cont)
+        rows.append((url, cat, cont))
+    return rows
+
+
+def add_rows(rows, ret_list, col_set):
+    """
+    :return: bool, the page is already seen (the last page is served again past the end)
+    """
+    for url, cat, cont in rows:
+        if url in col_set:
+            return True
+
+        col_set.add(url)
+        ret_list.append((url, cat, cont))
+    return False
+
 
+def get_comments(code, base_url=args.base_url):
     page = 1
     ret_list = []
     col_set = set()
 
     while 1:
         try:
-            f = urllib.request.urlopen(
-                "http://movie.naver.com/movie/bi/mi/pointWriteFormList.nhn?" + make_args(code, page))
+            f = urllib.request.urlopen(base_url + "?" + make_args(code, page))
             data = f.read().decode('utf-8')
         except Exception as e:
             print(e)
             break
 
-        soup = bs4.BeautifulSoup(re.sub("&#(?![0-9])", "", data), "html.parser")
-        cs = soup.select(".score_result li")
-        if not len(cs):
+        rows = parse_page(data, page)
+        if not len(rows) or add_rows(rows, ret_list, col_set):
             break
+        page += 1
+    return ret_list
 
-        for link in cs:
-            try:
-                url = link.select('.score_reple em a')[0].get('onclick')
-            except ValueError:
-                raise ValueError("[-] %d :" % page, data)
-
-            m = re.search('[0-9]+', url)
-            url = m.group(0) if m else ''
 
-            if url in col_set:
-                return ret_list
+def out_file(idx_, out_dir):
+    return os.path.join(out_dir, '%d.sql' % idx_)
 
-            col_set.add(url)
-
-            cat = f_text(link.select('.star_score em'))
-            cont = f_text(link.select('.score_reple p'))
-            cont = re.sub('<span [^>]+>.+?</span>', '', cont)
-            ret_list.append((url, cat, cont))
-        page += 1
-    return ret_list
- 
- 
-def fetch(idx_):
-    out_name = cfg.query_path + '%d.sql' % idx_
 
+def is_done(idx_, out_dir):
     try:
-        if os.stat(out_name).st_size > 0:
-            return
-    except Exception as e:
-        print(e)
+        return os.stat(out_file(idx_, out_dir)).st_size > 0
+    except OSError:
+        return False
 
-    rs = get_comments(idx_)
 
-    if not len(rs):
-        return
-
-    with open(out_name, 'w', encoding='utf-8') as f:
+def write_sql(idx_, rs, out_dir):
+    with open(out_file(idx_, out_dir), 'w', encoding='utf-8') as f:
         f.write('INSERT IGNORE INTO movie VALUES ')
 
         for idx, r in enumerate(rs):
@@ -103,12 +146,220 @@ def fetch(idx_):
             f.write("(%d,%s,%s,'%s')" % (idx_, r[0], r[1], r[2].replace("'", "''").replace("\\", "\\\\")))
 
         f.write(';\n')
-        f.close()
 
-    time.sleep(0.5)
+
+def fetch(idx_, out_dir=cfg.query_path, base_url=args.base_url, delay=.5):
+    if is_done(idx_, out_dir):
+        return
+
+    rs = get_comments(idx_, base_url)
+
+    if not len(rs):
+        return
+
+    write_sql(idx_, rs, out_dir)
+
+    time.sleep(delay)
+
+
+async def get_comments_async(session, code, base_url, stats, record_dir=None):
+    """
+    the same pagination as get_comments(), over a pooled keep-alive session
+    :param session: aiohttp.ClientSession
+    :param code: movie code, int
+    :param base_url: str
+    :param stats: dict, the number of fetched pages
+    :param record_dir: (Optional) the fetched pages are saved as <code>-<page>.html, str
+    :return: list, (comment id, rate, comment)
+    """
+    page = 1
+    ret_list = []
+    col_set = set()
+
+    while 1:
+        try:
+            async with session.get(base_url + "?" + make_args(code, page)) as resp:
+                data = await resp.text(encoding='utf-8')
+        except Exception as e:
+            print(e)
+            break
+
+        stats['pages'] += 1
+        if record_dir:
+            with open(os.path.join(record_dir, '%d-%d.html' % (code, page)), 'w', encoding='utf-8') as f:
+                f.write(data)
+
+        rows = parse_page(data, page)
+        if not len(rows) or add_rows(rows, ret_list, col_set):
+            break
+        page += 1
+    return ret_list
+
+
+async def crawl(codes, out_dir, base_url, concurrency=16, delay=.5, timeout=10., record_dir=None):
+    """
+    crawlers take the movie codes from a bounded queue, sharing a keep-alive connection pool
+    :param codes: movie codes, iterable
+    :param out_dir: where <code>.sql files are written, str
+    :param base_url: str
+    :param concurrency: the number of crawlers & the max connections, int
+    :param delay: sleep (secs) of a crawler after each movie, float
+    :param timeout: timeout (secs) of a page request, float
+    :param record_dir: (Optional) str
+    :return: dict, the number of movies, comments & pages
+    """
+    import aiohttp
+
+    stats = {'movies': 0, 'comments': 0, 'pages': 0}
+    queue = asyncio.Queue(maxsize=concurrency * 2)  # codes aren't queued all at once
+
+    async def produce():
+        for code in codes:
+            if not is_done(code, out_dir):
+                await queue.put(code)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def work(session, bar):
+        while True:
+            code = await queue.get()
+            if code is None:
+                break
+
+            rs = await get_comments_async(session, code, base_url, stats, record_dir)
+            if len(rs):
+                write_sql(code, rs, out_dir)
+                stats['movies'] += 1
+                stats['comments'] += len(rs)
+            bar.update(1)
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency, keepalive_timeout=30.)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        with tqdm() as bar:
+            await asyncio.gather(produce(), *[work(session, bar) for _ in range(concurrency)])
+    return stats
+
+
+def render_page(rows):
+    """
+    :param rows: list, (comment id, rate, comment)
+    :return: str, a pointWriteFormList-like page
+    """
+    items = ''.join('<li><div class="star_score"><em>%s</em></div>'
+                    '<div class="score_reple"><p>%s</p>'
+                    '<dl><dt><em><a href="#" onclick="javascript:showPointListByNid(%s, \'after\');">user</a>'
+                    '</em></dt></dl></div></li>' % (rate, comment, url)
+                    for url, rate, comment in rows)
+    return '<html><body><div class="score_result"><ul>%s</ul></div></body></html>' % items
+
+
+def synthetic_pages(n_movies, n_pages, per_page=10, seed=1337):
+    """
+    :return: dict, (code, page) : page
+    """
+    from synthetic import SyntheticReviews
+
+    reviews = SyntheticReviews(seed=seed)
+
+    pages, comment_id = {}, 1
+    for code in range(n_movies):
+        for page in range(1, n_pages + 1):
+            rows = []
+            for review in reviews.generate(per_page):
+                rows.append((str(comment_id), str(review['rate']), review['comment'].replace('<', '')))
+                comment_id += 1
+            pages[(code, page)] = render_page(rows)
+    return pages
+
+
+def recorded_pages(pages_dir):
+    """
+    :param pages_dir: pages saved by --record_dir, <code>-<page>.html, str
+    :return: dict, (code, page) : page
+    """
+    pages = {}
+    for fn in glob.glob(os.path.join(pages_dir, '*-*.html')):
+        code, page = os.path.splitext(os.path.basename(fn))[0].split('-')
+        with open(fn, 'r', encoding='utf-8') as f:
+            pages[(int(code), int(page))] = f.read()
+    return pages
+
+
+def serve_pages(pages):
+    """
+    a local stand-in of pointWriteFormList, keep-alive (HTTP/1.1), an empty list past the last page
+    :param pages: dict, (code, page) : page
+    :return: (ThreadingHTTPServer, base url)
+    """
+    empty = render_page([]).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            key = (int(query.get('code', ['0'])[0]), int(query.get('page', ['1'])[0]))
+            body = pages[key].encode('utf-8') if key in pages else empty
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/movie/bi/mi/pointWriteFormList.nhn' % server.server_address[1]
+
+
+def bench():
+    pages = recorded_pages(args.bench_pages_dir) if args.bench_pages_dir else \
+        synthetic_pages(args.bench_movies, args.bench_pages)
+    codes = sorted({code for code, _ in pages})
+    print("[*] %d movies, %d pages are served locally" % (len(codes), len(pages)))
+
+    server, base_url = serve_pages(pages)
+    try:
+        # the empty page past the end is fetched as well
+        n_requests = len(pages) + len(codes)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=cfg.n_threads) as executor:
+                for code in codes:
+                    executor.submit(fetch, code, tmp, base_url, 0.)
+            secs = time.perf_counter() - start
+            print("[+] threads (%d), urllib : %.1f pages/s" % (cfg.n_threads, n_requests / secs))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            stats = asyncio.run(crawl(codes, tmp, base_url, args.concurrency, 0., args.timeout))
+            secs = time.perf_counter() - start
+            print("[+] asyncio (%d), keep-alive : %.1f pages/s, %d movies, %d comments" %
+                  (args.concurrency, stats['pages'] / secs, stats['movies'], stats['comments']))
+    finally:
+        server.shutdown()
 
 
 if __name__ == '__main__':
-    with ThreadPoolExecutor(max_workers=cfg.n_threads) as executor:
-        for i in tqdm(range(10000, 200000)):
-            executor.submit(fetch, i)
+    if args.bench:
+        bench()
+    elif args.use_threads:
+        with ThreadPoolExecutor(max_workers=cfg.n_threads) as executor:
+            for i in tqdm(range(args.start, args.end)):
+                executor.submit(fetch, i, cfg.query_path, args.base_url, args.delay)
+    else:
+        if args.record_dir:
+            os.makedirs(args.record_dir, exist_ok=True)
+
+        stats = asyncio.run(crawl(range(args.start, args.end), cfg.query_path, args.base_url,
+                                  args.concurrency, args.delay, args.timeout, args.record_dir))
+        print("[+] %d movies, %d comments, %d pages" % (stats['movies'], stats['comments'], stats['pages']))
@@ -3,16 +3,17 @@ import argparse
 
 from tqdm import tqdm
 from config import get_config
-from dataloader import DataLoader
+from dataloader import DataLoader, CompressedVocab
 from collections import namedtuple
 
 
 # Argument parser
 parser = argparse.ArgumentParser(description='Pre-Processing NAVER Movie Review Comment')
 parser.add_argument('--load_from', type=str, help='load DataSet from db or csv', default='db', choices=['db', 'csv'])
-parser.add_argument('--vector', type=str, help='d2v or w2v', choices=['d2v', 'w2v'], default='w2v')
+parser.add_argument('--vector', type=str, help='d2v or w2v, or vocab for building the compressed vocab',
+                    choices=['d2v', 'w2v', 'vocab'], default='w2v')
 parser.add_argument('--is_analyzed', type=bool, help='already analyzed data', default=False)
-args = parser.parse_args()
+args, _ = parser.parse_known_args()
 
 config, _ = get_config()  # global configuration
 
@@ -54,6 +55,21 @@ def w2v_training(data):
     return True
 
 
+def vocab_building(data):
+    """
+    :param data: list containing words
+    :return: bool, success or fail
+    """
+    global config
+
+    vocab = CompressedVocab.build(data, top_n=config.vocab_top_n, n_buckets=config.vocab_buckets)
+    vocab.save(config.vocab_file)
+
+    print(vocab.report(dims=config.embed_size, n_slots=0 if config.optimizer == 'sgd' else 2))
+    print("[+] compressed vocab is saved at %s, train with --use_compressed_vocab True" % config.vocab_file)
+    return True
+
+
 def d2v_training(sentences, rates, epochs=10):
     """
     :param sentences: list, x-data
@@ -121,6 +137,8 @@ def main():
         d2v_training(x_data, y_data)  # d2v Training
     elif vec == 'w2v':
         w2v_training(x_data)          # w2v Training
+    elif vec == 'vocab':
+        vocab_building(x_data)        # top-N words + hashed OOV buckets
 
 
 if __name__ == "__main__":
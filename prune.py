@@ -0,0 +1,241 @@
+import os
+import sys
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+from config import get_config
+from distill import latency
+from evaluation import Evaluator
+from tfutil import session_config, find_checkpoint
+from main import load_trained_embeds, build_model, load_dataset
+from export import engine_hparams
+from model.textcnn_np import TextCNNEngine, branch_scopes, export_weights
+from sklearn.model_selection import train_test_split
+
+
+parser = argparse.ArgumentParser(description='structured filter pruning of the TextCNN conv branches')
+parser.add_argument('--ckpt_path', type=str, help='checkpoint to prune, default is the best one', default=None)
+parser.add_argument('--output_dir', type=str, help='where the pruned checkpoint is saved', default='./ml_model/pruned/')
+parser.add_argument('--ratio', type=float, help='the ratio of the filters to remove in each branch', default=.5)
+parser.add_argument('--method', type=str, help='l1 : kernel L1 norm, activation : pooled activation * fc1 weights',
+                    default='activation', choices=['l1', 'activation'])
+parser.add_argument('--n_samples', type=int, help='validation samples for the activation stats & latency',
+                    default=4096)
+parser.add_argument('--fine_tune_epochs', type=int, help='fine-tuning the pruned model with main.py, 0 to skip',
+                    default=0)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+
+def main_argv(argv):
+    """
+    :param argv: prune.py arguments, list
+    :return: list, the arguments without the prune.py options, the same architecture for main.py
+    """
+    own = {opt for action in parser._actions if not action.dest == 'help' for opt in action.option_strings}
+
+    forwarded, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in own:
+            skip = True  # & its value
+        elif not arg.split('=', 1)[0] in own:
+            forwarded.append(arg)
+    return forwarded
+
+
+def filter_scores(weights, hparams, method='l1', engine=None, x_sample=None):
+    """
+    :param weights: dict made by export_weights()
+    :param hparams: dict made by engine_hparams()
+    :param method: l1 or activation, str
+    :param engine: TextCNNEngine, only for activation
+    :param x_sample: encoded validation samples, only for activation
+    :return: list of (n_filters,) numpy arrays, importance of each filter per conv branch
+    """
+    branches = branch_scopes(hparams['kernel_sizes'], 2 if hparams['use_multi_channel'] else 1)
+
+    if method == 'l1':
+        return [np.abs(weights[scope + '/conv1d/kernel']).sum(axis=(0, 1)) for _, _, scope in branches]
+
+    # mean k-max pooled activation (after ThresholdReLU), weighted by the norm of its fc1 input rows
+    pooled = [np.zeros(p.shape[-1]) for p in engine.pool(x_sample[:1])]
+    for i in range(0, len(x_sample), config.batch_size):
+        for j, p in enumerate(engine.pool(x_sample[i:i + config.batch_size])):
+            pooled[j] += p.sum(axis=(0, 1))
+
+    n_filters = len(pooled[0])
+    fc1 = weights['outputs/fc1/kernel'].reshape(len(branches), 3, n_filters, -1)  # (branch, k, filter, fc_unit)
+    fc1_norm = np.sqrt((fc1 ** 2).sum(axis=(1, 3)))
+
+    return [p / (3 * len(x_sample)) * fc1_norm[j] for j, p in enumerate(pooled)]
+
+
+def select_filters(scores, n_keep, shared=False):
+    """
+    :param scores: importance of each filter per branch, list of numpy arrays
+    :param n_keep: the number of filters to keep per branch, the same for every branch (they're concatenated), int
+    :param shared: the same filters for every branch, needed by the global SE module, bool
+    :return: list of sorted filter indices to keep, per branch
+    """
+    if shared:
+        keep = np.sort(np.argsort(-np.sum(scores, axis=0))[:n_keep])
+        return [keep] * len(scores)
+    return [np.sort(np.argsort(-score)[:n_keep]) for score in scores]
+
+
+def prune_weights(weights, hparams, keep):
+    """
+    removing the conv filters & the matching SE / fc1 weights
+    :param weights: dict made by export_weights()
+    :param hparams: dict made by engine_hparams()
+    :param keep: filter indices to keep per branch, list
+    :return: dict, the same names with the pruned weights
+    """
+    pruned = dict(weights)
+
+    def prune_se(scope, idx):
+        if scope + 'squeeze/kernel' not in weights:
+            return
+        pruned[scope + 'squeeze/kernel'] = weights[scope + 'squeeze/kernel'][idx]
+        pruned[scope + 'excitation/kernel'] = weights[scope + 'excitation/kernel'][:, idx]
+        pruned[scope + 'excitation/bias'] = weights[scope + 'excitation/bias'][idx]
+
+    branches = branch_scopes(hparams['kernel_sizes'], 2 if hparams['use_multi_channel'] else 1)
+
+    n_filters = weights[branches[0][2] + '/conv1d/bias'].shape[0]
+    rows = []
+    for i, ((_, _, scope), idx) in enumerate(zip(branches, keep)):
+        pruned[scope + '/conv1d/kernel'] = weights[scope + '/conv1d/kernel'][:, :, idx]
+        pruned[scope + '/conv1d/bias'] = weights[scope + '/conv1d/bias'][idx]
+        prune_se(scope + '/se-module/', idx)
+
+        # fc1 inputs are the flattened (branch * 3 + k, filter) pooled outputs
+        rows.extend((i * 3 + k) * n_filters + idx for k in range(3))
+
+    prune_se('se-module/', keep[0])
+    pruned['outputs/fc1/kernel'] = weights['outputs/fc1/kernel'][np.concatenate(rows)]
+    return pruned
+
+
+def flops(hparams, n_filters, n_dims, sequence_length, fc_unit):
+    """
+    :return: int, multiply-adds * 2 of the conv branches & fc1 per sample
+    """
+    branches = branch_scopes(hparams['kernel_sizes'], 2 if hparams['use_multi_channel'] else 1)
+    conv = sum(2 * (sequence_length - fs + 1) * fs * n_dims * n_filters for _, fs, _ in branches)
+    return conv + 2 * 3 * len(branches) * n_filters * fc_unit
+
+
+def validation_sample(vectors, embed_type):
+    """
+    :return: (x, y), the first n_samples of the same valid split as main.py (without refine_data)
+    """
+    x_data, y_data, _, _ = load_dataset(vectors, embed_type)
+
+    valid_idx = train_test_split(np.arange(len(x_data)), random_state=config.seed,
+                                 test_size=config.test_size, shuffle=True)[1]
+    valid_idx = np.sort(valid_idx[:args.n_samples])
+    return np.asarray(x_data[valid_idx]), np.asarray(y_data[valid_idx])
+
+
+def evaluate(engine, x, y):
+    """
+    :return: dict, Evaluator summary of the engine over (x, y)
+    """
+    evaluator = Evaluator(len(y), config.n_classes)
+    for i in range(0, len(y), config.batch_size):
+        evaluator.add(engine(x[i:i + config.batch_size]), y[i:i + config.batch_size])
+    return evaluator.summary()
+
+
+def main():
+    if not config.model == 'charcnn':
+        raise NotImplementedError("[-] only TextCNN is supported")
+
+    embed_type = config.use_pre_trained_embeds
+    vectors = load_trained_embeds(embed_type)
+    hparams = engine_hparams()
+
+    # Stage 1 : the trained weights
+    with tf.Session(config=session_config(config.device)) as s:
+        model = build_model(s, vectors, embed_type, summary_dir=args.output_dir)
+
+        ckpt = args.ckpt_path or find_checkpoint(config.pretrained, config.model, best=True)
+        if not ckpt:
+            raise FileNotFoundError("[-] No checkpoint file found in %s" % config.pretrained)
+
+        model.init_embeddings()  # static pre-trained embeddings aren't in the checkpoint
+        model.saver.restore(s, ckpt)
+        print("[+] %s restored" % ckpt)
+
+        weights = export_weights(s, hparams)
+
+    # Stage 2 : scoring & selecting the filters
+    x_sample, y_sample = validation_sample(vectors, embed_type)
+    engine = TextCNNEngine(weights)
+
+    n_filters = config.filter_size
+    n_keep = max(1, int(round(n_filters * (1. - args.ratio))))
+
+    se_ratio = config.se_ratio
+    if config.use_se_module:
+        # the SE hidden units (n_filters // se_ratio) are kept, n_keep is rounded to a multiple of them
+        n_hidden = n_filters // config.se_ratio
+        n_keep = max(n_hidden, n_keep // n_hidden * n_hidden)
+        se_ratio = n_keep // n_hidden
+
+    scores = filter_scores(weights, hparams, args.method, engine, x_sample)
+    keep = select_filters(scores, n_keep, shared=config.use_se_module and not config.se_type == 'A')
+
+    pruned = prune_weights(weights, hparams, keep)
+    pruned_engine = TextCNNEngine(pruned)
+
+    # Stage 3 : FLOPs, latency & accuracy before/after (not fine-tuned yet)
+    print("[*] %d -> %d filters per branch (%s), se_ratio %d" % (n_filters, n_keep, args.method, se_ratio))
+    print("    %-8s %10s %10s %11s %9s %7s" % ('', 'MFLOPs', 'ms/batch', 'samples/s', 'MSE', 'acc'))
+    for name, e, n in (('original', engine, n_filters), ('pruned', pruned_engine, n_keep)):
+        ms, samples_per_sec = latency(e, x_sample, config.batch_size)
+        summary = evaluate(e, x_sample, y_sample)
+        print("    %-8s %10.1f %10.2f %11.1f %9.4f %7.4f" %
+              (name, flops(hparams, n, config.embed_size, config.sequence_length, config.fc_unit) / 1e6,
+               ms, samples_per_sec, summary['mse'], summary['accuracy']))
+
+    # Stage 4 : the slimmer checkpoint, a TextCNN built with n_keep filters
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    tf.reset_default_graph()
+    with tf.Session(config=session_config(config.device)) as s:
+        model = build_model(s, vectors, embed_type, summary_dir=args.output_dir, n_filters=n_keep, se_ratio=se_ratio)
+        s.run(tf.global_variables_initializer())
+
+        loaded = set()
+        for v in tf.global_variables():
+            if v.op.name in pruned:
+                v.load(pruned[v.op.name], s)
+                loaded.add(v.op.name)
+        assert loaded == set(pruned.keys()) - {'hparams'}
+
+        model.saver.save(s, os.path.join(args.output_dir, '%s.ckpt' % config.model), global_step=0)
+        ckpt = model.best_saver.save(s, os.path.join(args.output_dir, '%s-best_loss.ckpt' % config.model),
+                                     global_step=0)
+    print("[+] pruned checkpoint is saved at %s" % ckpt)
+
+    # main.py restores the latest checkpoint of --pretrained (given --checkpoint) & keeps training there
+    output_dir = os.path.join(args.output_dir, '')
+    cmd = [sys.executable, 'main.py'] + main_argv(sys.argv[1:]) + \
+          ['--checkpoint', output_dir, '--pretrained', output_dir,
+           '--filter_size', str(n_keep), '--se_ratio', str(se_ratio)]
+    if args.fine_tune_epochs > 0:
+        cmd += ['--epochs', str(args.fine_tune_epochs)]
+        print("[*] fine-tuning : %s" % ' '.join(cmd))
+        sys.exit(subprocess.call(cmd))
+    print("[*] fine-tune it with : %s --epochs N" % ' '.join(cmd[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+import os
+import csv
+import json
+import time
+import queue
+import argparse
+import tempfile
+import threading
+import numpy as np
+import multiprocessing as mp
+
+from config import get_config
+from dataloader import TextEncoder
+from main import load_trained_embeds
+from server import Predictor, to_rates
+from cache import PredictionCache, cached_predict, checkpoint_fingerprint
+
+
+parser = argparse.ArgumentParser(description='bulk scoring the movie table or csv files')
+parser.add_argument('--source', type=str, help='where the comments come from', default='db', choices=['db', 'csv'])
+parser.add_argument('--input', type=str, help='csv file with id, movieid, comment columns', default=None)
+parser.add_argument('--output', type=str, help='write predicted rates back to the db or csv shards',
+                    default='db', choices=['db', 'shards'])
+parser.add_argument('--output_dir', type=str, help='where csv shards are written', default='./scores/')
+parser.add_argument('--shard_size', type=int, help='rows per csv shard', default=1000000)
+parser.add_argument('--ckpt_path', type=str, help='checkpoint to restore, default is the best one', default=None)
+parser.add_argument('--frozen', type=str, help='frozen graph made by export.py, instead of a checkpoint', default=None)
+parser.add_argument('--score_batch_size', type=int, help='session run batch size', default=2048)
+parser.add_argument('--chunk_size', type=int, help='rows encoded by a worker at once', default=10000)
+parser.add_argument('--prefetch', type=int, help='encoded chunks kept ahead of the session', default=4)
+parser.add_argument('--cache_size', type=int, help='max cached predictions (on the encoded ids), 0 to disable',
+                    default=1000000)
+parser.add_argument('--cascade', type=str, help='stage-1 model made by cascade.py, the neural model scores '
+                                                'only the comments it is unsure about', default=None)
+parser.add_argument('--report_every', type=int, help='reporting rows/s every N rows', default=100000)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+encoder = None  # made once before the workers are forked, they share its embeddings (copy-on-write)
+
+
+def db_connect(cursor_class=None):
+    import pymysql
+
+    db_info = {
+        'host': config.host,
+        'user': config.user,
+        'password': config.password,
+        'db': config.db,
+        'charset': config.charset,
+    }
+    if cursor_class:
+        db_info['cursorclass'] = cursor_class
+    return pymysql.connect(**db_info)
+
+
+def stream_db(last_key=None):
+    """
+    streaming the rows with a server-side cursor, in primary key order
+    :param last_key: (id, movieid), rows after it are read, tuple
+    :return: generator, ((id, movieid), comment)
+    """
+    import pymysql
+
+    db_conn = db_connect(pymysql.cursors.SSCursor)
+    try:
+        with db_conn.cursor() as cur:
+            if last_key:
+                cur.execute("select id, movieid, comment from movie "
+                            "where id > %s or (id = %s and movieid > %s) order by id, movieid",
+                            (last_key[0], last_key[0], last_key[1]))
+            else:
+                cur.execute("select id, movieid, comment from movie order by id, movieid")
+
+            for id_, movieid, comment in cur:
+                yield (id_, movieid), comment
+    finally:
+        db_conn.close()
+
+
+def stream_csv(fn, last_key=None):
+    """
+    :param fn: csv file, with a header, str
+    :param last_key: (id, movieid), rows up to it are skipped, tuple
+    :return: generator, ((id, movieid), comment), (row number, 0) is the key if there's no id column
+    """
+    with open(fn, 'r', encoding='utf8', newline='') as f:
+        for row_no, row in enumerate(csv.DictReader(f)):
+            key = (int(row['id']), int(row['movieid'])) if 'id' in row and 'movieid' in row else (row_no, 0)
+            if last_key and key <= tuple(last_key):
+                continue
+            yield key, row['comment']
+
+
+def chunked(rows, size, semaphore):
+    """
+    :param rows: iterable
+    :param size: chunk size, int
+    :param semaphore: bounds the number of chunks in flight, threading.Semaphore
+    :return: generator, list
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            semaphore.acquire()
+            yield chunk
+            chunk = []
+    if chunk:
+        semaphore.acquire()
+        yield chunk
+
+
+def init_encoder(vectors, embed_type):
+    global encoder
+
+    encoder = TextEncoder(vectors, config.sequence_length,
+                          pad_id=0 if embed_type == 'c2v' else vectors.vocab_size - 1,
+                          use_normalize=config.use_normalize)
+
+
+def encode_chunk(chunk):
+    """
+    :param chunk: list, ((id, movieid), comment)
+    :return: (keys, encoded comments)
+    """
+    return [key for key, _ in chunk], encoder.encode_batch([comment for _, comment in chunk])
+
+
+class DBWriter:
+
+    def __init__(self):
+        self.db_conn = db_connect()
+
+        with self.db_conn.cursor() as cur:
+            cur.execute("create table if not exists prediction ("
+                        "id int not null, movieid int not null, rate float not null, primary key (id, movieid))")
+        self.db_conn.commit()
+
+    def last_key(self):
+        with self.db_conn.cursor() as cur:
+            cur.execute("select id, movieid from prediction order by id desc, movieid desc limit 1")
+            row = cur.fetchone()
+        return tuple(row) if row else None
+
+    def write(self, keys, rates):
+        # pymysql turns executemany() of an INSERT ... VALUES into multi-row INSERTs
+        with self.db_conn.cursor() as cur:
+            cur.executemany("insert into prediction (id, movieid, rate) values (%s, %s, %s) "
+                            "on duplicate key update rate = values(rate)",
+                            [(k[0], k[1], r) for k, r in zip(keys, rates)])
+        self.db_conn.commit()
+
+    def close(self):
+        self.db_conn.close()
+
+
+class ShardWriter:
+
+    def __init__(self, output_dir, shard_size):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+
+        self.progress_file = os.path.join(self.output_dir, 'progress.json')
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        progress = self.load_progress()
+        self.key = progress.get('last_key')
+
+        self.f, self.w, self.n_rows = None, None, 0
+        if 'offset' in progress and progress['n_rows'] < self.shard_size:
+            # appending to the last shard, the rows written after the last commit are dropped (scored again)
+            self.shard_idx = progress['shard']
+            self.open_shard(offset=progress['offset'], n_rows=progress['n_rows'])
+        else:
+            self.shard_idx = progress.get('shard', -1) + 1
+
+    def load_progress(self):
+        if not os.path.isfile(self.progress_file):
+            return {}
+        with open(self.progress_file, 'r') as f:
+            return json.load(f)
+
+    def last_key(self):
+        return tuple(self.key) if self.key else None
+
+    def open_shard(self, offset=None, n_rows=0):
+        """
+        :param offset: (Optional) committed size (bytes) of the shard to resume, a new shard otherwise, int
+        :param n_rows: committed rows of the shard to resume, int
+        :return: None
+        """
+        fn = os.path.join(self.output_dir, 'scores-%05d.csv' % self.shard_idx)
+        if offset is None:
+            self.f = open(fn, 'w', encoding='utf8', newline='')
+            self.w = csv.writer(self.f)
+            self.w.writerow(['id', 'movieid', 'rate'])
+        else:
+            self.f = open(fn, 'r+', encoding='utf8', newline='')
+            self.f.truncate(offset)
+            self.f.seek(offset)
+            self.w = csv.writer(self.f)
+        self.n_rows = n_rows
+
+    def commit(self):
+        # the shard rows are on disk before the progress file (shard, offset, last key) is replaced atomically,
+        # so a crash never leaves rows in a shard past the recorded cursor
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+        tmp_file = self.progress_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'shard': self.shard_idx, 'offset': self.f.tell(), 'n_rows': self.n_rows,
+                       'last_key': list(self.key)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.progress_file)
+
+    def write(self, keys, rates):
+        if self.f is None:
+            self.open_shard()
+
+        self.w.writerows([(k[0], k[1], r) for k, r in zip(keys, rates)])
+        self.n_rows += len(keys)
+        self.key = keys[-1]
+        self.commit()
+
+        if self.n_rows >= self.shard_size:
+            self.f.close()
+            self.f = None
+            self.shard_idx += 1
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+
+def main():
+    embed_type = config.use_pre_trained_embeds
+    if embed_type == 'd2v':
+        raise NotImplementedError("[-] only Char2Vec, Word2Vec are supported")
+
+    writer = DBWriter() if args.output == 'db' else ShardWriter(args.output_dir, args.shard_size)
+
+    last_key = writer.last_key()
+    if last_key:
+        print("[*] resuming after (id, movieid) = %s" % (last_key,))
+
+    if args.source == 'db':
+        rows = stream_db(last_key)
+    else:
+        assert args.input
+        rows = stream_csv(args.input, last_key)
+
+    # bounded pipeline : reading -> encoding (workers) -> prefetch queue -> session -> bulk writes
+    in_flight = threading.Semaphore(args.prefetch + config.n_threads)
+    encoded = queue.Queue(maxsize=args.prefetch)
+
+    # the embeddings are loaded once, the forked workers & the session share them
+    vectors = load_trained_embeds(embed_type)
+    init_encoder(vectors, embed_type)
+
+    pool = mp.get_context('fork').Pool(config.n_threads)
+
+    def produce():
+        try:
+            for item in pool.imap(encode_chunk, chunked(rows, args.chunk_size, in_flight)):
+                encoded.put(item)
+        finally:
+            encoded.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    n_rows, start, last_report = 0, time.perf_counter(), 0
+    with tempfile.TemporaryDirectory() as tmp:
+        predictor = Predictor(vectors, embed_type, tmp, frozen=args.frozen, ckpt_path=args.ckpt_path)
+        print("[+] %s loaded" % predictor.checkpoint)
+
+        model, fingerprint = predictor, predictor.fingerprint
+        if args.cascade:
+            from cascade import HashedNGramModel, Cascade
+
+            model = Cascade(HashedNGramModel.load(args.cascade), predictor)
+            fingerprint = (fingerprint, checkpoint_fingerprint(args.cascade))
+            print("[+] %s loaded, threshold %.4f" % (args.cascade, model.threshold))
+
+        # duplicated comments are scored once, the model is fixed during the run
+        cache = PredictionCache(args.cache_size, fingerprint) if args.cache_size > 0 else None
+
+        def predict(x_batch):
+            if not cache:
+                return model(x_batch)
+
+            def encode_fn(idx):
+                return x_batch[idx]
+
+            return np.stack(cached_predict(cache, [row.tobytes() for row in x_batch], encode_fn, model))
+
+        try:
+            while True:
+                item = encoded.get()
+                if item is None:
+                    break
+
+                keys, x = item
+                for i in range(0, len(keys), args.score_batch_size):
+                    rates = to_rates(predict(x[i:i + args.score_batch_size]))
+                    writer.write(keys[i:i + args.score_batch_size], rates)
+
+                in_flight.release()
+
+                n_rows += len(keys)
+                if n_rows - last_report >= args.report_every:
+                    last_report = n_rows
+                    print("[*] %d rows scored, %.1f rows/s%s" %
+                          (n_rows, n_rows / (time.perf_counter() - start),
+                           ", cache hit rate %.3f" % cache.stats()['cache_hit_rate'] if cache else ''))
+        finally:
+            predictor.close()
+            writer.close()
+            pool.terminate()
+
+    elapsed = time.perf_counter() - start
+    print("[+] Total %d rows scored, %.1fs, %.1f rows/s" % (n_rows, elapsed, n_rows / elapsed if elapsed else 0.))
+    if args.cascade:
+        print("[*] %.1f%% of the scored rows went to the neural model" % (model.defer_rate() * 100.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+import json
+import time
+import queue
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+from socketserver import ThreadingMixIn
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from config import get_config
+from metrics import LatencyTracker
+from cache import PredictionCache, checkpoint_fingerprint, cached_predict
+from dataloader import TextEncoder, load_embeddings
+
+
+parser = argparse.ArgumentParser(description='HTTP/JSON movie rate scoring server')
+parser.add_argument('--bind', type=str, help='address to bind (--host is the DB host in config.py)',
+                    default='127.0.0.1')
+parser.add_argument('--port', type=int, help='port to bind', default=8080)
+parser.add_argument('--ckpt_path', type=str, help='checkpoint to restore, default is the best one', default=None)
+parser.add_argument('--frozen', type=str, help='frozen graph made by export.py, instead of a checkpoint', default=None)
+parser.add_argument('--numpy', type=str, help='TextCNN weights (.npz) made by export.py, served without TensorFlow',
+                    default=None)
+parser.add_argument('--use_int8', type=bool,
+                    help='int8 per-channel weights for the NumPy engine, an int8 export is always int8', default=False)
+parser.add_argument('--max_batch_size', type=int, help='max micro-batch size', default=128)
+parser.add_argument('--max_latency_ms', type=float, help='max time to wait for filling a micro-batch', default=5.)
+parser.add_argument('--cache_size', type=int, help='max cached predictions, 0 to disable', default=100000)
+parser.add_argument('--cache_key', type=str, help='cache on the normalized text or the encoded ids',
+                    default='text', choices=['text', 'ids'])
+parser.add_argument('--reload_secs', type=float, help='checking for a new checkpoint every N secs, 0 to disable',
+                    default=30.)
+args, _ = parser.parse_known_args()
+
+config, _ = get_config()
+
+
+class MicroBatcher:
+
+    def __init__(self, predict_fn, max_batch_size=128, max_latency=5e-3, tracker=None):
+        """
+        gathering concurrent requests into one session run
+        :param predict_fn: function, (n, sequence_length) numpy array to (n, n_classes) rates
+        :param max_batch_size: int
+        :param max_latency: max time (secs) the 1st request of a batch waits for the others, float
+        :param tracker: (Optional) LatencyTracker
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.tracker = tracker
+
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        """
+        :param x: encoded comments, numpy array
+        :return: Future, rates of x
+        """
+        future = Future()
+        self.queue.put((x, future))
+        return future
+
+    def gather(self):
+        items = [self.queue.get()]
+        n_items = len(items[0][0])
+
+        deadline = time.perf_counter() + self.max_latency
+        while n_items < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            items.append(item)
+            n_items += len(item[0])
+        return items
+
+    def loop(self):
+        while True:
+            items = self.gather()
+
+            x = np.concatenate([x for x, _ in items], axis=0)
+            try:
+                rates = self.predict_fn(x)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            if self.tracker:
+                self.tracker.add_batch(len(x))
+
+            offset = 0
+            for x, future in items:
+                future.set_result(rates[offset:offset + len(x)])
+                offset += len(x)
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            stats = self.server.tracker.summary()
+            if self.server.cache:
+                stats.update(self.server.cache.stats())
+            self.reply(200, stats)
+        elif self.path == '/health':
+            self.reply(200, {'status': 'ok', 'checkpoint': self.server.predictor.checkpoint})
+        else:
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if not self.path == '/predict':
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+            return
+
+        start = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8'))
+            comments = body['comments'] if 'comments' in body else [body['comment']]
+            if not isinstance(comments, list) or not comments or \
+                    not all(isinstance(comment, str) for comment in comments):
+                raise TypeError("comments must be a non-empty list of str")
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {'error': 'expected {"comments": [...]} or {"comment": "..."}, %s' % e})
+            return
+
+        try:
+            rates = self.predict(comments)
+        except Exception as e:
+            self.reply(500, {'error': 'prediction failed, %s: %s' % (type(e).__name__, e)})
+            return
+
+        self.server.tracker.add(time.perf_counter() - start, count=len(comments))
+        self.reply(200, {'rates': to_rates(rates)})
+
+    def predict(self, comments):
+        """
+        :param comments: raw comments, list
+        :return: numpy array, (len(comments), n_classes)
+        """
+        encoder, batcher, cache = self.server.encoder, self.server.batcher, self.server.cache
+        if not cache:
+            return batcher.submit(encoder.encode_batch(comments)).result()
+
+        # predictions of the previous checkpoint are dropped
+        fingerprint = self.server.predictor.fingerprint
+        cache.validate(fingerprint)
+
+        if self.server.cache_key == 'text':
+            keys = [encoder.normalize(comment) for comment in comments]
+
+            def encode_fn(idx):
+                return encoder.encode_batch([keys[i] for i in idx], normalized=True)
+        else:
+            x = encoder.encode_batch(comments)
+            keys = [row.tobytes() for row in x]
+
+            def encode_fn(idx):
+                return x[idx]
+
+        def predict_fn(x_batch):
+            return batcher.submit(x_batch).result()
+
+        return np.stack(cached_predict(cache, keys, encode_fn, predict_fn, fingerprint))
+
+    def log_message(self, fmt, *args_):
+        if config.verbose:
+            super().log_message(fmt, *args_)
+
+
+class ScoringServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, encoder, batcher, tracker, predictor, cache=None, cache_key='text'):
+        super().__init__(address, ScoringHandler)
+        self.encoder = encoder
+        self.batcher = batcher
+        self.tracker = tracker
+        self.predictor = predictor
+        self.cache = cache
+        self.cache_key = cache_key
+
+
+def to_rates(rates):
+    """
+    :param rates: model outputs, (n, n_classes) numpy array
+    :return: list, rate (1 ~ 10) of each comment
+    """
+    if rates.shape[-1] == 1:
+        return [float(r[0]) for r in rates]
+    return [int(r) + 1 for r in np.argmax(rates, axis=-1)]
+
+
+class Reloadable:
+
+    checkpoint = None
+    reload_errors = (OSError, ValueError)
+
+    def reload(self):
+        raise NotImplementedError
+
+    def watch(self, interval):
+        """
+        :param interval: secs between the checks, float
+        :return: threading.Thread
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.reload():
+                        print("[+] %s reloaded" % self.checkpoint)
+                except self.reload_errors as e:  # the checkpoint may be half-written
+                    print("[-] failed to reload %s, %s" % (self.checkpoint, e))
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+
+class Predictor(Reloadable):
+
+    def __init__(self, vectors, embed_type, summary_dir, frozen=None, ckpt_path=None):
+        """
+        :param vectors: loaded embeddings
+        :param embed_type: c2v or w2v, str
+        :param summary_dir: where the model summary goes to, str
+        :param frozen: (Optional) frozen graph made by export.py, str
+        :param ckpt_path: (Optional) checkpoint to restore, default is the best one, str
+        """
+        import tensorflow as tf
+        from tfutil import session_config, load_frozen_graph
+        from main import build_model
+
+        self.ckpt_path = ckpt_path
+        self.lock = threading.Lock()
+        self.reload_errors = (tf.errors.OpError, ValueError)
+
+        if frozen:
+            # inference-only graph made by export.py, no training graph is built
+            graph, self.x, self.rates = load_frozen_graph(frozen)
+            self.s = tf.Session(graph=graph, config=session_config(config.device))
+            self.model = None
+            self.feed = {}
+
+            self.checkpoint = frozen
+        else:
+            self.s = tf.Session(config=session_config(config.device))
+            self.model = build_model(self.s, vectors, embed_type, summary_dir=summary_dir)
+            self.x, self.rates = self.model.x, self.model.rates
+            self.feed = {self.model.do_rate: 0.}
+
+            self.checkpoint = self.latest_checkpoint()
+            if not self.checkpoint:
+                raise FileNotFoundError("[-] No checkpoint file found in %s" % config.pretrained)
+
+            self.model.init_embeddings()  # static pre-trained embeddings aren't in the checkpoint
+            self.model.saver.restore(self.s, self.checkpoint)
+
+        self.fingerprint = checkpoint_fingerprint(self.checkpoint)
+
+    def latest_checkpoint(self):
+        from tfutil import find_checkpoint
+        return self.ckpt_path or find_checkpoint(config.pretrained, config.model, best=True)
+
+    def __call__(self, x_batch):
+        with self.lock:
+            return self.s.run(self.rates, feed_dict=dict(self.feed, **{self.x: x_batch}))
+
+    def reload(self):
+        """
+        restoring the checkpoint again if it's changed since, frozen graphs are never reloaded
+        :return: bool, reloaded or not
+        """
+        if self.model is None:
+            return False
+
+        ckpt = self.latest_checkpoint()
+        if not ckpt:
+            return False
+
+        fingerprint = checkpoint_fingerprint(ckpt)
+        if fingerprint == self.fingerprint:
+            return False
+
+        with self.lock:
+            self.model.saver.restore(self.s, ckpt)
+            self.checkpoint, self.fingerprint = ckpt, fingerprint
+        return True
+
+    def close(self):
+        self.s.close()
+
+
+class NumpyPredictor(Reloadable):
+
+    def __init__(self, weights, use_int8=False):
+        """
+        TextCNN served by the NumPy engine, TensorFlow isn't loaded at all
+        :param weights: .npz file made by export.py --format npz, str
+        :param use_int8: int8 per-channel weights, bool
+        """
+        from model.textcnn_np import TextCNNEngine
+
+        self.engine_cls = TextCNNEngine
+        self.use_int8 = use_int8
+
+        self.checkpoint = weights
+        self.fingerprint = checkpoint_fingerprint(weights)
+        self.engine = TextCNNEngine.load(weights, use_int8=use_int8)
+
+    def __call__(self, x_batch):
+        return self.engine(x_batch)
+
+    def reload(self):
+        """
+        loading the weights again if the file is re-written
+        :return: bool, reloaded or not
+        """
+        fingerprint = checkpoint_fingerprint(self.checkpoint)
+        if fingerprint == self.fingerprint:
+            return False
+
+        self.engine = self.engine_cls.load(self.checkpoint, use_int8=self.use_int8)
+        self.fingerprint = fingerprint
+        return True
+
+    def close(self):
+        pass
+
+
+def main():
+    embed_type = config.use_pre_trained_embeds
+    if embed_type == 'd2v':
+        raise NotImplementedError("[-] only Char2Vec, Word2Vec are supported")
+
+    vectors = load_embeddings(embed_type, config)
+    encoder = TextEncoder(vectors, config.sequence_length,
+                          pad_id=0 if embed_type == 'c2v' else vectors.vocab_size - 1,
+                          use_normalize=config.use_normalize)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        if args.numpy:
+            predictor = NumpyPredictor(args.numpy, use_int8=args.use_int8)
+        else:
+            predictor = Predictor(vectors, embed_type, tmp, frozen=args.frozen, ckpt_path=args.ckpt_path)
+        print("[+] %s loaded, %.3fs" % (predictor.checkpoint, time.perf_counter() - start))
+
+        if args.reload_secs > 0 and not args.frozen:
+            predictor.watch(args.reload_secs)
+
+        tracker = LatencyTracker()
+        batcher = MicroBatcher(predictor, max_batch_size=args.max_batch_size,
+                               max_latency=args.max_latency_ms / 1e3, tracker=tracker)
+
+        cache = PredictionCache(args.cache_size, predictor.fingerprint) if args.cache_size > 0 else None
+
+        httpd = ScoringServer((args.bind, args.port), encoder, batcher, tracker, predictor,
+                              cache=cache, cache_key=args.cache_key)
+        print("[*] serving on http://%s:%d (POST /predict, GET /metrics)" % (args.bind, args.port))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            predictor.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import multiprocessing as mp
+
+from collections import OrderedDict
+from config import get_config, args_list, str2bool
+from dataloader import DATA_CACHE_ARGS
+
+
+parser = argparse.ArgumentParser(description='grid/random hyper-parameter sweep, concurrent main.py runs')
+parser.add_argument('--space', type=str, help='JSON (or a .json file), arg : [values] or {"min", "max", "log"}',
+                    default='{"filter_size": [128, 256], "lr": [1e-4, 2e-4]}')
+parser.add_argument('--search', type=str, help='every combination or random samples of the space',
+                    default='grid', choices=['grid', 'random'])
+parser.add_argument('--n_trials', type=int, help='the number of random samples', default=8)
+parser.add_argument('--n_parallel', type=int, help='concurrent training runs', default=2)
+parser.add_argument('--sweep_dir', type=str, help='a directory per run & the results', default='./sweeps/')
+args, forwarded = parser.parse_known_args()
+
+config, _ = get_config()
+
+# every run maps the same encoded dataset, so these (& what the dataset depends on) can't be swept
+SHARED_ARGS = {'use_pre_trained_embeds', 'processed_dataset', 'pretrained', 'tf_threads'} | \
+              {name for names in DATA_CACHE_ARGS.values() for name in names}
+
+
+def config_args():
+    """
+    :return: dict, dest : (argument group, type) of the config.py arguments
+    """
+    return {action.dest: (group.title, action.type) for group in args_list for action in group._group_actions}
+
+
+def load_space(space):
+    """
+    :param space: JSON string or .json file, str
+    :return: OrderedDict, arg : list of values or {"min", "max", "log"}
+    """
+    if os.path.isfile(space):
+        with open(space, 'r') as f:
+            space = f.read()
+    space = json.loads(space, object_pairs_hook=OrderedDict)
+
+    known = config_args()
+    for name, values in space.items():
+        if name not in known:
+            raise ValueError("[-] %s is not an argument of config.py" % name)
+        if name in SHARED_ARGS:
+            raise ValueError("[-] %s is shared by every run, it can't be swept" % name)
+        if isinstance(values, dict) and args.search == 'grid':
+            raise ValueError("[-] %s : ranges are only for the random search" % name)
+    return space
+
+
+def trials(space, search='grid', n_trials=8, seed=1337):
+    """
+    :param space: OrderedDict made by load_space()
+    :param search: grid or random, str
+    :param n_trials: the number of random samples, int
+    :param seed: int
+    :return: list of OrderedDict, arg : value
+    """
+    if search == 'grid':
+        return [OrderedDict(zip(space.keys(), values)) for values in itertools.product(*space.values())]
+
+    rng = np.random.RandomState(seed)
+
+    def sample(values):
+        if not isinstance(values, dict):
+            return values[rng.randint(len(values))]
+        lo, hi = values['min'], values['max']
+        if values.get('log'):
+            return float(np.exp(rng.uniform(np.log(lo), np.log(hi))))
+        return float(rng.uniform(lo, hi)) if isinstance(lo, float) else int(rng.randint(lo, hi + 1))
+
+    return [OrderedDict((name, sample(values)) for name, values in space.items()) for _ in range(n_trials)]
+
+
+def to_argv(params):
+    """
+    :param params: OrderedDict, arg : value
+    :return: list, main.py arguments
+    """
+    known = config_args()
+
+    argv = []
+    for name, value in params.items():
+        if known[name][1] is str2bool:
+            value = 'True' if value else 'False'
+        elif isinstance(value, (list, tuple)):
+            # type=list splits the string into chars, like --kernel_size 9753
+            if any(len(str(v)) > 1 for v in value):
+                raise ValueError("[-] %s : only single-char items can be passed, %s" % (name, value))
+            value = ''.join(str(v) for v in value)
+        argv += ['--' + name, str(value)]
+    return argv
+
+
+def read_run(run_dir):
+    """
+    :param run_dir: str
+    :return: OrderedDict, the exported config & the best valid loss of a run
+    """
+    result = OrderedDict()
+
+    config_file = os.path.join(run_dir, 'config.txt')
+    if os.path.isfile(config_file):
+        with open(config_file, 'r') as f:
+            result['config'] = OrderedDict(line.rstrip('\n').split(' : ', 1) for line in f if ' : ' in line)
+
+    best = None
+    metrics_file = os.path.join(run_dir, config.metrics_file)
+    if os.path.isfile(metrics_file):
+        with open(metrics_file, 'r', encoding='utf8') as f:
+            for line in f:
+                record = json.loads(line)
+                if 'valid_loss' in record and (best is None or record['valid_loss'] < best['valid_loss']):
+                    best = record
+
+    result['best_valid_loss'] = best['valid_loss'] if best else None
+    result['best_valid_acc'] = best['valid_acc'] if best else None
+    result['best_step'] = best['step'] if best else None
+    result['samples_per_sec'] = best['samples_per_sec'] if best else None
+    return result
+
+
+def ensure_data_cache():
+    """
+    encoding the dataset once, every run memory-maps the .npy files read-only
+    :return: None
+    """
+    from main import load_trained_embeds, load_dataset
+
+    # the same code path as the runs, the cache key needs the loaded embeddings (the compressed vocab size)
+    embed_type = config.use_pre_trained_embeds
+    load_dataset(load_trained_embeds(embed_type), embed_type, use_cache=True)
+
+
+def launch(run_dir, params, n_threads):
+    """
+    :return: (subprocess.Popen, log file)
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, 'params.json'), 'w') as f:
+        json.dump(params, f, indent=2)
+
+    cmd = [sys.executable, 'main.py'] + forwarded + to_argv(params) + \
+          ['--use_data_cache', 'True', '--pretrained', run_dir, '--tf_threads', str(n_threads)]
+
+    env = dict(os.environ, OMP_NUM_THREADS=str(n_threads))
+
+    log = open(os.path.join(run_dir, 'train.log'), 'w', encoding='utf8')
+    return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env), log
+
+
+def main():
+    space = load_space(args.space)
+    runs = trials(space, args.search, args.n_trials, config.seed)
+
+    n_parallel = max(1, min(args.n_parallel, len(runs)))
+    n_threads = max(1, mp.cpu_count() // n_parallel)
+    print("[*] %d runs, %d at once, %d threads each" % (len(runs), n_parallel, n_threads))
+
+    ensure_data_cache()
+
+    os.makedirs(args.sweep_dir, exist_ok=True)
+
+    queued = [(i, os.path.join(args.sweep_dir, 'run-%03d' % i, ''), params) for i, params in enumerate(runs)]
+    running, status = {}, {}
+    start = time.time()
+    while queued or running:
+        while queued and len(running) < n_parallel:
+            i, run_dir, params = queued.pop(0)
+
+            # finished runs of an interrupted sweep are kept
+            done_file = os.path.join(run_dir, 'done.json')
+            if os.path.isfile(done_file):
+                with open(done_file, 'r') as f:
+                    status[i] = json.load(f)
+                print("[*] run-%03d is already done, skipped" % i)
+                continue
+
+            proc, log = launch(run_dir, params, n_threads)
+            running[i] = (proc, log, run_dir, time.time())
+            print("[*] run-%03d started, %s" % (i, ' '.join(to_argv(params))))
+
+        time.sleep(1.)
+
+        for i, (proc, log, run_dir, run_start) in list(running.items()):
+            if proc.poll() is None:
+                continue
+
+            log.close()
+            del running[i]
+
+            status[i] = {'returncode': proc.returncode, 'secs': time.time() - run_start}
+            if proc.returncode == 0:
+                with open(os.path.join(run_dir, 'done.json'), 'w') as f:
+                    json.dump(status[i], f)
+            print("[%s] run-%03d finished, exit code %d, %.1fs" %
+                  ('+' if proc.returncode == 0 else '-', i, proc.returncode, status[i]['secs']))
+
+    # results table, the best valid loss of the finished runs first
+    results = []
+    for i, params in enumerate(runs):
+        run_dir = os.path.join(args.sweep_dir, 'run-%03d' % i, '')
+        result = OrderedDict([('run', 'run-%03d' % i), ('params', params)])
+        result.update(status.get(i, {}))
+        result.update(read_run(run_dir))
+        results.append(result)
+    results.sort(key=lambda r: (not r.get('returncode') == 0,
+                                float('inf') if r['best_valid_loss'] is None else r['best_valid_loss']))
+
+    with open(os.path.join(args.sweep_dir, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    names = list(space.keys())
+
+    def fmt(value):
+        return ('%.4g' % value if isinstance(value, float) else str(value))[:14]
+
+    print("[+] sweep done, %.1fs, results are saved at %s" %
+          (time.time() - start, os.path.join(args.sweep_dir, 'results.json')))
+    print("    %-8s " % 'run' + ' '.join('%14s' % n[:14] for n in names) +
+          " %12s %9s %8s %10s %6s" % ('valid_loss', 'valid_acc', 'step', 'samples/s', 'exit'))
+    for r in results:
+        print("    %-8s " % r['run'] + ' '.join('%14s' % fmt(r['params'][n]) for n in names) +
+              " %12s %9s %8s %10s %6s" %
+              ('%.6f' % r['best_valid_loss'] if r['best_valid_loss'] is not None else '-',
+               '%.4f' % r['best_valid_acc'] if r['best_valid_acc'] is not None else '-',
+               r['best_step'] if r['best_step'] is not None else '-',
+               '%.1f' % r['samples_per_sec'] if r['samples_per_sec'] is not None else '-',
+               r.get('returncode', '-')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+# building blocks of the NAVER movie review comments
+WORDS = {
+    'good': ['최고', '재밌어요', '명작', '감동', '추천', '대박', '인생영화', '좋아요', '또 보고 싶다', '강추', '연기 짱'],
+    'normal': ['그냥', '무난', '볼만함', '나쁘지 않다', '시간 때우기', '기대 이하', '평범', '그럭저럭'],
+    'bad': ['별로', '재미없다', '쓰레기', '시간 아깝다', '지루', '최악', '돈 아깝다', '알바 꺼져', '노잼'],
+    'common': ['영화', '진짜', '너무', '정말', '완전', '배우', '연기', '스토리', '결말', '감독', '음악', '연출',
+               '내용', '액션', '로맨스', '공포', '코미디', '다시', '보고', '평점', '이거', '하는', '이다', '는', '가'],
+}
+JAMO = ['ㅋㅋ', 'ㅋㅋㅋㅋㅋㅋ', 'ㅎㅎ', 'ㅠㅠ', 'ㅜㅜㅜ', 'ㄷㄷ', 'ㅡㅡ', 'ㅇㅇ', 'ㄱㄱ']
+ASCII = ['good', 'best', 'CG', 'OST', '10점', '1점', '!!', '...', '^^', '?', 'lol', '3D', '2', 'bb', ':)']
+SYMBOLS = ['♡', '♥', '★', '☆', '★★★★★', '♡♡♡', '☆☆']
+HTML = ['&lt;3', '<br>', '&quot;', '&amp;', '<b>', '</b>']
+POS_TAGS = ['NNG', 'NNP', 'VV', 'VA', 'MAG', 'EC', 'EF', 'JKS', 'JX', 'IC', 'SF', 'SL', 'SN', 'XSV']
+
+# rate 1 ~ 10, skewed to 10 (and 1) like the real data distribution
+RATE_PROBS = [.09, .015, .015, .02, .03, .035, .05, .085, .08, .58]
+
+
+class SyntheticReviews:
+
+    def __init__(self, seed=1337, mean_length=30, max_length=140, rate_probs=None,
+                 url_ratio=.005, html_ratio=.02):
+        """
+        :param seed: random seed, int
+        :param mean_length: mean length (chars) of a comment, int
+        :param max_length: max length (chars) of a comment, NAVER allows 140, int
+        :param rate_probs: probabilities of rate 1 ~ 10, list
+        :param url_ratio: ratio of url-only comments, which are dropped while cleaning, float
+        :param html_ratio: ratio of comments containing html tags/entities, float
+        """
+        self.rng = np.random.RandomState(seed)
+
+        self.mean_length = mean_length
+        self.max_length = max_length
+        self.rate_probs = np.asarray(rate_probs or RATE_PROBS) / np.sum(rate_probs or RATE_PROBS)
+        self.url_ratio = url_ratio
+        self.html_ratio = html_ratio
+
+    def choice(self, items):
+        return items[self.rng.randint(len(items))]
+
+    def syllable(self):
+        return chr(0xAC00 + self.rng.randint(11172))  # any of 가 ~ 힣
+
+    def token(self, rate):
+        p = self.rng.rand()
+        if p < .45:
+            sentiment = 'good' if rate >= 8 else 'bad' if rate <= 4 else 'normal'
+            return self.choice(WORDS[sentiment] if self.rng.rand() < .5 else WORDS['common'])
+        elif p < .65:
+            return ''.join(self.syllable() for _ in range(self.rng.randint(1, 4)))
+        elif p < .8:
+            return self.choice(JAMO)
+        elif p < .92:
+            return self.choice(ASCII)
+        return self.choice(SYMBOLS)
+
+    def comment(self, rate):
+        """
+        :param rate: rate, int
+        :return: raw comment, str
+        """
+        if self.rng.rand() < self.url_ratio:
+            return 'http://movie.naver.com/%d' % self.rng.randint(1e6)
+
+        # log-normal length, lots of short comments and a long tail up to max_length
+        length = int(np.clip(self.rng.lognormal(np.log(self.mean_length) - .32, .8), 1, self.max_length))
+
+        tokens, n_chars = [], 0
+        while n_chars < length:
+            tok = self.token(rate)
+            tokens.append(tok)
+            n_chars += len(tok) + 1
+
+        comment = ' '.join(tokens)[:self.max_length]
+        if self.rng.rand() < self.html_ratio:
+            comment = comment + self.choice(HTML)
+        return comment
+
+    def rate(self):
+        return int(self.rng.choice(10, p=self.rate_probs)) + 1
+
+    def generate(self, n):
+        """
+        :param n: the number of reviews, int
+        :return: list of dict, like the rows of the 'movie' table ({'rate', 'comment'})
+        """
+        data = []
+        for _ in range(n):
+            rate = self.rate()
+            data.append({'rate': rate, 'comment': self.comment(rate)})
+        return data
+
+    def tagged(self, comment):
+        """
+        Mecab-like analyzed words, word/POS
+        :param comment: str
+        :return: list
+        """
+        return ['%s/%s' % (word, self.choice(POS_TAGS)) for word in comment.split(' ') if word]
@@ -1 +1,538 @@
-# init
+import os
+import sys
+import time
+import queue
+import threading
+import subprocess
+import tensorflow as tf
+
+from collections import defaultdict
+
+
+def session_config(device='gpu', n_threads=0):
+    """
+    :param device: gpu or cpu, str
+    :param n_threads: intra/inter-op threads, 0 for all the cores, int
+    :return: tf.ConfigProto, ops pinned on '/gpu:0' fall back to the cpu when there's no gpu
+    """
+    cfg = tf.ConfigProto(allow_soft_placement=True)
+    if device == 'gpu':
+        cfg.gpu_options.allow_growth = True
+    if n_threads > 0:
+        cfg.intra_op_parallelism_threads = n_threads
+        cfg.inter_op_parallelism_threads = max(1, n_threads // 2)
+    return cfg
+
+
+def local_cluster_spec(n_workers, n_ps=1, base_port=2222, host='localhost'):
+    """
+    :param n_workers: the number of worker tasks, int
+    :param n_ps: the number of parameter server tasks, int
+    :param base_port: the first port of the cluster, int
+    :param host: host name, str
+    :return: tf.train.ClusterSpec
+    """
+    ps_hosts = ['%s:%d' % (host, base_port + i) for i in range(n_ps)]
+    worker_hosts = ['%s:%d' % (host, base_port + n_ps + i) for i in range(n_workers)]
+    return tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+
+
+def launch_local_cluster(n_workers, n_ps=1, argv=None):
+    """
+    spawning parameter server(s) and workers on the localhost, each of them re-runs the given script
+    :param n_workers: the number of worker processes, int
+    :param n_ps: the number of parameter server processes, int
+    :param argv: script & its arguments, list
+    :return: exit code, int
+    """
+    argv = argv if argv is not None else sys.argv
+
+    def spawn(job_name, task_index):
+        return subprocess.Popen([sys.executable] + argv + ['--job_name', job_name, '--task_index', str(task_index)])
+
+    ps_procs = [spawn('ps', i) for i in range(n_ps)]
+    worker_procs = [spawn('worker', i) for i in range(n_workers)]
+
+    print("[*] %d ps, %d workers are launched on the localhost" % (n_ps, n_workers))
+
+    exit_code = 0
+    try:
+        for proc in worker_procs:
+            exit_code = max(exit_code, proc.wait())
+    finally:
+        # parameter servers never end by themselves
+        for proc in ps_procs + worker_procs:
+            if proc.poll() is None:
+                proc.terminate()
+    return exit_code
+
+
+def sync_replicas_init(s, opt, is_chief):
+    """
+    what SyncReplicasOptimizer's session hook does, but for a plain tf.Session
+    :param s: tf.Session connected to the cluster
+    :param opt: tf.train.SyncReplicasOptimizer, after apply_gradients() is called
+    :param is_chief: chief worker or not, bool
+    :return: list of started queue runner threads
+    """
+    s.run(opt.chief_init_op if is_chief else opt.local_step_init_op)
+
+    threads = []
+    if is_chief:
+        s.run(opt.get_init_tokens_op())
+        threads = opt.get_chief_queue_runner().create_threads(s, daemon=True, start=True)
+    return threads
+
+
+def chief_ready_flag(name='chief_ready'):
+    """
+    a variable (on the ps) the chief initializes only after its variables are initialized and restored
+    :param name: str
+    :return: tf.Variable, out of every collection, so neither the initializers nor the savers touch it
+    """
+    return tf.Variable(True, trainable=False, collections=[], name=name)
+
+
+def wait_for_variables(s, ready, poll_secs=1.):
+    """
+    non-chief workers wait until the chief initializes and restores the shared variables
+    :param s: tf.Session connected to the cluster
+    :param ready: tf.Variable made by chief_ready_flag(), the chief runs its initializer after the restore
+    :param poll_secs: polling interval, float
+    :return: None
+    """
+    is_ready = tf.is_variable_initialized(ready)
+    while not s.run(is_ready):
+        print("[*] waiting for the chief to initialize & restore variables...")
+        time.sleep(poll_secs)
+
+
+def accumulate_gradients(opt, grads_and_vars, n_steps, global_step=None):
+    """
+    accumulating (already clipped) gradients over n_steps micro-batches before one apply_gradients()
+    :param opt: tf.train.Optimizer
+    :param grads_and_vars: list of (gradient, variable)
+    :param n_steps: the number of micro-batches to accumulate, int
+    :param global_step: tf.Variable, increased once per applying
+    :return: (accum_op, train_op), train_op applies the averaged gradients and resets the accumulators
+    """
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+
+    accum_ops, accum_grads, reset_ops = [], [], []
+    for g, v in grads_and_vars:
+        # local variables, kept out of the checkpoints. pinned to the device of the gradient (this worker),
+        # otherwise replica_device_setter puts them on the ps, shared by every worker
+        with tf.device(g.device):
+            if isinstance(g, tf.IndexedSlices):
+                accum_op, accum_grad, reset_op = accumulate_indexed_slices(g, v, n_steps)
+            else:
+                accum = tf.get_variable(v.op.name + '/grad_accum', shape=v.get_shape(), dtype=v.dtype.base_dtype,
+                                        initializer=tf.zeros_initializer(), trainable=False,
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                accum_op, accum_grad = tf.assign_add(accum, g / n_steps), accum.value()
+                reset_op = tf.assign(accum, tf.zeros_like(accum))
+
+        accum_ops.append(accum_op)
+        accum_grads.append(accum_grad)
+        reset_ops.append(reset_op)
+
+    accum_op = tf.group(*accum_ops, name='accumulate_gradients')
+
+    apply_op = opt.apply_gradients([(grad, v) for grad, (_, v) in zip(accum_grads, grads_and_vars)],
+                                   global_step=global_step)
+    with tf.control_dependencies([apply_op]):
+        train_op = tf.group(*reset_ops, name='apply_accumulated_gradients')
+    return accum_op, train_op
+
+
+def accumulate_indexed_slices(g, v, n_steps):
+    """
+    embedding lookup gradients stay sparse, the touched rows are concatenated & summed per row (tf.unique),
+    so the memory is bounded by the rows touched in n_steps micro-batches & sparse optimizers update only them
+    :param g: tf.IndexedSlices
+    :param v: tf.Variable, the embeddings
+    :param n_steps: the number of micro-batches to accumulate, int
+    :return: (accum_op, accumulated tf.IndexedSlices, reset_op)
+    """
+    n_dims = v.get_shape().as_list()[1:]
+
+    def empty():
+        return tf.zeros([0] + n_dims, dtype=v.dtype.base_dtype), tf.zeros([0], dtype=g.indices.dtype)
+
+    # (rows, n_dims) & (rows,) of a variable size
+    init_values, init_indices = empty()
+    values = tf.Variable(init_values, trainable=False, validate_shape=False, name=v.op.name + '/grad_accum_values',
+                         collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    indices = tf.Variable(init_indices, trainable=False, validate_shape=False,
+                          name=v.op.name + '/grad_accum_indices', collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    rows, pos = tf.unique(tf.concat([indices.value(), g.indices], axis=0))
+    summed = tf.unsorted_segment_sum(tf.concat([values.value(), g.values / n_steps], axis=0), pos, tf.size(rows))
+
+    accum_op = tf.group(tf.assign(values, summed, validate_shape=False),
+                        tf.assign(indices, rows, validate_shape=False))
+    reset_op = tf.group(*[tf.assign(var, init, validate_shape=False)
+                          for var, init in zip((values, indices), empty())])
+    return accum_op, tf.IndexedSlices(values.value(), indices.value(), g.dense_shape), reset_op
+
+
+def weighted_mean(losses, weights):
+    """
+    :param losses: per-sample losses, (batch,) tf.Tensor
+    :param weights: per-sample weights, (batch,) tf.Tensor
+    :return: tf.Tensor, sum(weights * losses) / sum(weights), the plain mean for the weights of ones
+    """
+    return tf.reduce_sum(weights * losses) / tf.maximum(tf.reduce_sum(weights), 1e-8)
+
+
+def distillation_loss(logits, rates, teacher_rates, temperature=1.):
+    """
+    :param logits: student outputs before the score function, tf.Tensor
+    :param rates: student rates, tf.Tensor
+    :param teacher_rates: teacher rates, (batch, n_classes) tf.Tensor
+    :param temperature: softening both distributions, classification only, float
+    :return: tf.Tensor, MSE to the teacher rates (regression) or soft-target cross-entropy (classification)
+    """
+    if teacher_rates.get_shape()[-1] == 1:
+        return tf.reduce_mean(tf.losses.mean_squared_error(labels=teacher_rates, predictions=rates))
+
+    # log of the softmax outputs are the teacher logits up to a constant
+    soft_targets = tf.nn.softmax(tf.log(teacher_rates + 1e-8) / temperature)
+    return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(
+        logits=logits / temperature,
+        labels=soft_targets
+    )) * temperature ** 2  # keeps the gradient scale of the soft targets
+
+
+def sparse_optimizer(name, lr):
+    """
+    :param name: lazy_adam or adagrad, str
+    :param lr: learning rate, float or tf.Tensor
+    :return: tf.train.Optimizer, updating (and keeping the slots of) only the rows in IndexedSlices gradients
+    """
+    if name == 'lazy_adam':
+        return tf.contrib.opt.LazyAdamOptimizer(learning_rate=lr)
+    elif name == 'adagrad':
+        return tf.train.AdagradOptimizer(learning_rate=lr)
+    raise NotImplementedError("[-] only lazy_adam, adagrad are supported! (%s)" % name)
+
+
+class SplitOptimizer:
+
+    def __init__(self, opt, sparse_opt, sparse_vars):
+        """
+        sparse row updates for the embedding variables, dense updates for the rest
+        :param opt: tf.train.Optimizer, for the rest
+        :param sparse_opt: tf.train.Optimizer, see sparse_optimizer()
+        :param sparse_vars: embedding variables, list
+        """
+        self.opt = opt
+        self.sparse_opt = sparse_opt
+        self.sparse_ids = {id(v) for v in sparse_vars}
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+
+        dense = [(g, v) for g, v in grads_and_vars if id(v) not in self.sparse_ids]
+        sparse = [(g, v) for g, v in grads_and_vars if id(v) in self.sparse_ids]
+
+        ops = [self.opt.apply_gradients(dense, global_step=global_step)]
+        if sparse:
+            ops.append(self.sparse_opt.apply_gradients(sparse))
+        return tf.group(*ops, name=name)
+
+
+def checkpoint_var_list(excluded=()):
+    """
+    the variables & the saveable objects of the default graph to checkpoint,
+    CudnnGRU's opaque params are saved by its saveable object under the canonical (CudnnCompatibleGRUCell) names,
+    so the opaque buffer itself is left out
+    :param excluded: op names not to save, like the frozen pre-trained embeddings, set
+    :return: list of tf.Variable & saveable objects, a Saver's var_list
+    """
+    saveables = tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)
+    # CudnnOpaqueParamsSaveable keeps its opaque variable in _variables
+    opaque = {s._variables.op.name for s in saveables if isinstance(getattr(s, '_variables', None), tf.Variable)}
+    return [v for v in tf.global_variables() if v.op.name not in set(excluded) | opaque] + saveables
+
+
+class AsyncCheckpointer:
+
+    def __init__(self, variables, max_pending=1):
+        """
+        the variables are copied to the host memory on the training thread, then written by a background thread
+        :param variables: variables & saveable objects to save, like model.saved_variables, list
+        :param max_pending: snapshots waiting to be written, save() blocks when it's full, int
+        """
+        # a saveable object (CudnnGRU) is snapshotted by its canonical tensors, under their checkpoint names
+        self.names, self.tensors = [], []
+        for v in variables:
+            if isinstance(v, tf.Variable):
+                self.names.append(v.op.name)
+                self.tensors.append(v)
+            else:
+                for spec in v.specs:
+                    self.names.append(spec.name)
+                    self.tensors.append(spec.tensor() if callable(spec.tensor) else spec.tensor)
+
+        # a CPU-only graph of the same checkpoint names, the checkpoints are restored by the model savers as usual
+        # its variables are created from the first snapshot, the canonical shapes aren't static
+        self.graph = tf.Graph()
+        self.copies = None
+        self.s = tf.Session(graph=self.graph, config=session_config('cpu'))
+        self.savers = {}
+
+        self.snapshot, self.snapshot_step = None, None
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.last_save = time.time()
+
+        self.writer = threading.Thread(target=self.write_forever, daemon=True)
+        self.writer.start()
+
+    def mirror(self, values):
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.copies = [tf.get_variable(name, shape=value.shape, dtype=tf.as_dtype(value.dtype),
+                                           initializer=tf.zeros_initializer(), trainable=False)
+                           for name, value in zip(self.names, values)]
+
+    def saver(self, path):
+        # a Saver per checkpoint prefix, each keeps its own max_to_keep
+        if path not in self.savers:
+            with self.graph.as_default():
+                self.savers[path] = tf.train.Saver(var_list=dict(zip(self.names, self.copies)), max_to_keep=1)
+        return self.savers[path]
+
+    def save(self, s, path, global_step):
+        """
+        :param s: tf.Session of the training graph
+        :param path: checkpoint prefix, like model.saver.save(), str
+        :param global_step: int
+        :return: the stall (secs) of the training thread, float
+        """
+        if self.error:
+            raise self.error
+
+        start = time.perf_counter()
+
+        # the saver & the best_saver share a snapshot at the same step
+        if not self.snapshot_step == global_step:
+            self.snapshot, self.snapshot_step = s.run(self.tensors), global_step
+
+        self.pending.put((path, global_step, self.snapshot))
+        self.last_save = time.time()
+        return time.perf_counter() - start
+
+    def is_due(self, secs):
+        """
+        :param secs: time-based checkpoint interval, 0 to disable, int
+        :return: bool
+        """
+        return secs > 0 and time.time() - self.last_save >= secs
+
+    def write_forever(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+
+            path, global_step, values = item
+            try:
+                if self.copies is None:
+                    self.mirror(values)
+                for v, value in zip(self.copies, values):
+                    v.load(value, self.s)
+                self.saver(path).save(self.s, path, global_step=global_step)
+            except Exception as e:  # re-raised on the training thread
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def close(self):
+        """
+        waiting for the pending checkpoints to be written
+        :return: None
+        """
+        self.pending.put(None)
+        self.writer.join()
+        self.s.close()
+
+        if self.error:
+            raise self.error
+
+
+class StepProfiler:
+
+    def __init__(self, steps, log_dir='./profile/', writer=None, top_n=20):
+        """
+        :param steps: steps to trace, list of int
+        :param log_dir: where timelines & op tables are written to, str
+        :param writer: (Optional) tf.summary.FileWriter, run metadata is also added to TensorBoard
+        :param top_n: the number of ops to print, int
+        """
+        self.steps = set(steps)
+        self.log_dir = log_dir
+        self.writer = writer
+        self.top_n = top_n
+
+        if self.steps:
+            os.makedirs(self.log_dir, exist_ok=True)
+
+    def run(self, s, fetches, feed_dict=None, step=0, tag='train'):
+        """
+        same as s.run(), but fully traced at the chosen steps
+        :param s: tf.Session
+        :param fetches: fetches for s.run()
+        :param feed_dict: feed_dict for s.run()
+        :param step: current step, int
+        :param tag: train or test, str
+        :return: the result of s.run()
+        """
+        if step not in self.steps:
+            return s.run(fetches, feed_dict=feed_dict)
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+
+        results = s.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+        self.export(run_metadata, step, tag)
+        return results
+
+    def export(self, run_metadata, step, tag='train'):
+        """
+        :param run_metadata: traced tf.RunMetadata
+        :param step: step, int
+        :param tag: train or test, str
+        :return: None
+        """
+        from tensorflow.python.client import timeline
+
+        prefix = os.path.join(self.log_dir, '%s-%07d' % (tag, step))
+
+        # chrome://tracing timeline
+        with open(prefix + '-timeline.json', 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
+        # per-op summary table
+        op_stats = self.op_stats(run_metadata.step_stats)
+        total = sum(t for _, t in op_stats.values()) or 1
+
+        rows = sorted(op_stats.items(), key=lambda x: x[1][1], reverse=True)
+        with open(prefix + '-ops.txt', 'w') as f:
+            f.write("%-64s %-24s %8s %12s %7s\n" % ('scope', 'op', 'count', 'time (us)', '%'))
+            for (scope, op), (cnt, t) in rows:
+                f.write("%-64s %-24s %8d %12d %6.2f%%\n" % (scope, op, cnt, t, 100. * t / total))
+
+        if self.writer:
+            self.writer.add_run_metadata(run_metadata, '%s-step%07d' % (tag, step), step)
+
+        print("[*] %s step %d traced, total %d us, top %d ops" % (tag, step, total, self.top_n))
+        for (scope, op), (cnt, t) in rows[:self.top_n]:
+            print("  [*] %-48s %-20s %10d us (%.2f%%)" % (scope, op, t, 100. * t / total))
+
+    @staticmethod
+    def op_stats(step_stats):
+        """
+        :param step_stats: tf.StepStats
+        :return: dict, (top-level scope, op type) : [count, total micros]
+        """
+        stats = defaultdict(lambda: [0, 0])
+        for dev_stats in step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                # timeline_label looks like 'name = OpType(inputs)'
+                label = node.timeline_label
+                op = label.split(' = ')[1].split('(')[0] if ' = ' in label else node.node_name
+                scope = node.node_name.split('/')[0]
+
+                stats[(scope, op)][0] += 1
+                stats[(scope, op)][1] += node.all_end_rel_micros
+        return stats
+
+
+def find_checkpoint(path, model_name, best=True):
+    """
+    :param path: checkpoint directory, str
+    :param model_name: charcnn or charrnn, str
+    :param best: the best (valid loss) checkpoint rather than the latest one, bool
+    :return: checkpoint prefix, str, None if there's nothing
+    """
+    from glob import glob
+
+    if best:
+        # best_saver & saver share the 'checkpoint' state file, so look up the files directly
+        indices = glob(os.path.join(path, '%s-best_loss.ckpt-*.index' % model_name))
+        if indices:
+            steps = [int(fn[:-len('.index')].split('-')[-1]) for fn in indices]
+            return os.path.join(path, '%s-best_loss.ckpt-%d' % (model_name, max(steps)))
+    return tf.train.latest_checkpoint(path)
+
+
+def freeze_graph(s, output_names, constant_inputs=None):
+    """
+    :param s: tf.Session, variables are already restored
+    :param output_names: output node names, list
+    :param constant_inputs: dict, placeholder name : fixed value, like {'do-rate': 0.}
+    :return: inference-only tf.GraphDef, variables are converted into constants
+    """
+    from tensorflow.core.framework import attr_value_pb2
+    from tensorflow.python.framework import tensor_util
+
+    # only the path from the inputs to the outputs is kept
+    graph_def = tf.graph_util.convert_variables_to_constants(s, s.graph.as_graph_def(), output_names)
+
+    constant_inputs = constant_inputs or {}
+    for node in graph_def.node:
+        if node.name not in constant_inputs and not node.op == 'PlaceholderWithDefault':
+            continue
+
+        dtype = attr_value_pb2.AttrValue()
+        dtype.CopyFrom(node.attr['dtype'])
+        node.ClearField('attr')
+
+        if node.name in constant_inputs:
+            node.op = 'Const'
+            node.ClearField('input')
+            node.attr['dtype'].CopyFrom(dtype)
+            node.attr['value'].CopyFrom(attr_value_pb2.AttrValue(
+                tensor=tensor_util.make_tensor_proto(constant_inputs[node.name], dtype=dtype.type)))
+        else:
+            # i.e. keras_learning_phase, fixed to its default value
+            node.op = 'Identity'
+            node.attr['T'].CopyFrom(dtype)
+    return graph_def
+
+
+def optimize_graph(graph_def, input_names, output_names):
+    """
+    :param graph_def: frozen tf.GraphDef
+    :param input_names: input node names, list
+    :param output_names: output node names, list
+    :return: tf.GraphDef, constants folded & unused nodes stripped
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    transforms = [
+        'remove_nodes(op=CheckNumerics)',
+        'fold_constants(ignore_errors=true)',
+        'strip_unused_nodes',
+        'sort_by_execution_order',
+    ]
+    return TransformGraph(graph_def, input_names, output_names, transforms)
+
+
+def load_frozen_graph(fn, input_name='x-sentence', output_name='outputs/rates'):
+    """
+    :param fn: frozen GraphDef (.pb) file, str
+    :param input_name: input node name, str
+    :param output_name: output node name, str
+    :return: (tf.Graph, input tensor, output tensor)
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(fn, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        x, rates = tf.import_graph_def(graph_def, return_elements=[input_name + ':0', output_name + ':0'], name='')
+    return graph, x, rates